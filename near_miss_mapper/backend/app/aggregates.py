@@ -0,0 +1,435 @@
+# Incrementally maintained per-cell event counts for hotspot analyses
+import asyncio
+import math
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from app.geo import mercator_xy
+
+# Cell sizes (metres, Web Mercator) kept up to date on every insert/delete
+AGGREGATE_CELL_SIZES = [
+    float(v) for v in os.getenv("AGGREGATE_CELL_SIZES", "50,100,250,500,1000").split(",") if v.strip()
+]
+AGGREGATES_ENABLED = os.getenv("AGGREGATES_ENABLED", "true").lower() in ("1", "true", "yes")
+# A rebuild holds a lease renewed after every batch; a holder silent for
+# this long is presumed dead and another process may take over
+AGGREGATES_LEASE_S = float(os.getenv("AGGREGATES_LEASE_S", "300"))
+# Upper bound on how long a write may take between reading the rebuild
+# flag and updating the aggregates (see rebuild)
+AGGREGATES_WRITE_GRACE_S = float(os.getenv("AGGREGATES_WRITE_GRACE_S", "5"))
+# Full rebuilds to reconcile drift, by age of the last one (0 disables)
+AGGREGATES_RECONCILE_HOURS = float(os.getenv("AGGREGATES_RECONCILE_HOURS", "24"))
+
+META_ID = "meta"
+LEASE_ID = "rebuild_lease"
+
+
+def cell_indices(lon, lat, cell_size_m: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Global lattice indices (floor(x / cell), floor(y / cell)) of lon/lat points."""
+    x, y = mercator_xy(lon, lat)
+    return np.floor(x / cell_size_m).astype(np.int64), np.floor(y / cell_size_m).astype(np.int64)
+
+
+def _event_day(ts: Any) -> Optional[datetime]:
+    if isinstance(ts, datetime):
+        return datetime(ts.year, ts.month, ts.day)
+    return None
+
+
+def _event_coords(event: dict) -> Optional[Tuple[float, float]]:
+    coords = (event.get("location") or {}).get("coordinates")
+    try:
+        lon, lat = float(coords[0]), float(coords[1])
+    except (TypeError, ValueError, IndexError):
+        return None
+    if not (math.isfinite(lon) and math.isfinite(lat)):
+        return None
+    return lon, lat
+
+
+def _updates(events: Iterable[dict], sign: int) -> List[UpdateOne]:
+    """
+    One $inc per touched aggregate: a 'total' row per cell and a 'detail'
+    row per cell, day and incident_type, merged across the batch. A lone
+    event thus costs 2 * len(AGGREGATE_CELL_SIZES) upserts (10 by default);
+    events sharing a cell, day and type share them.
+    """
+    lons, lats, days, types = [], [], [], []
+    type_codes: Dict[Any, int] = {}
+    for event in events:
+        coords = _event_coords(event)
+        if coords is None:
+            continue
+        day = _event_day(event.get("timestamp"))
+        lons.append(coords[0])
+        lats.append(coords[1])
+        days.append(day.toordinal() if day else -1)
+        types.append(type_codes.setdefault(event.get("incident_type"), len(type_codes)))
+    if not lons:
+        return []
+    type_names = {code: name for name, code in type_codes.items()}
+    days_arr = np.asarray(days, dtype=np.int64)
+    types_arr = np.asarray(types, dtype=np.int64)
+
+    updates = []
+    for cell_size in AGGREGATE_CELL_SIZES:
+        ix, iy = cell_indices(lons, lats, cell_size)
+        totals, total_counts = np.unique(np.column_stack([ix, iy]), axis=0, return_counts=True)
+        for (cx, cy), n in zip(totals.tolist(), total_counts.tolist()):
+            updates.append(_inc(cell_size, cx, cy, "total", None, None, sign * n))
+        details, detail_counts = np.unique(np.column_stack([ix, iy, days_arr, types_arr]), axis=0, return_counts=True)
+        for (cx, cy, d, t), n in zip(details.tolist(), detail_counts.tolist()):
+            day = datetime.fromordinal(d) if d >= 0 else None
+            updates.append(_inc(cell_size, cx, cy, "detail", day, type_names[t], sign * n))
+    return updates
+
+
+def _inc(cell_size: float, ix: int, iy: int, level: str, day: Optional[datetime],
+         incident_type: Optional[str], amount: int) -> UpdateOne:
+    return UpdateOne(
+        {"cell_size": cell_size, "ix": ix, "iy": iy, "level": level, "day": day, "incident_type": incident_type},
+        {"$inc": {"count": amount}},
+        upsert=True,
+    )
+
+
+async def apply_events(collection, events: List[dict], sign: int = 1) -> None:
+    """Add (sign=1) or remove (sign=-1) events from the aggregates."""
+    updates = _updates(events, sign)
+    if updates:
+        await collection.bulk_write(updates, ordered=False)
+
+
+async def create_aggregate_indexes(collection) -> None:
+    await collection.create_index(
+        [("cell_size", 1), ("level", 1), ("ix", 1), ("iy", 1), ("day", 1), ("incident_type", 1)],
+        unique=True,
+    )
+    await collection.create_index([("cell_size", 1), ("level", 1), ("day", 1), ("incident_type", 1)])
+
+
+def _meta(collection):
+    return collection.database.aggregates_meta
+
+
+def _journal(collection):
+    return collection.database.aggregates_journal
+
+
+async def is_ready(collection) -> bool:
+    """True once a full rebuild for the configured cell sizes has completed."""
+    meta = await _meta(collection).find_one({"_id": META_ID})
+    return bool(meta and meta.get("ready") and meta.get("cell_sizes") == AGGREGATE_CELL_SIZES)
+
+
+async def needs_rebuild(collection) -> bool:
+    """Not ready (never built, marked stale or other cell sizes), or due for the periodic reconcile."""
+    meta = await _meta(collection).find_one({"_id": META_ID})
+    if not (meta and meta.get("ready") and meta.get("cell_sizes") == AGGREGATE_CELL_SIZES):
+        return True
+    built_at = meta.get("built_at")
+    return (AGGREGATES_RECONCILE_HOURS > 0 and isinstance(built_at, datetime)
+            and datetime.utcnow() - built_at > timedelta(hours=AGGREGATES_RECONCILE_HOURS))
+
+
+async def mark_stale(collection) -> None:
+    """Stop serving aggregates until the next rebuild (e.g. after a failed live update)."""
+    await _meta(collection).update_one({"_id": META_ID}, {"$set": {"ready": False}}, upsert=True)
+
+
+def _journal_event(event: dict) -> dict:
+    return {
+        "_id": event.get("_id"),
+        "location": {"coordinates": (event.get("location") or {}).get("coordinates")},
+        "timestamp": event.get("timestamp"),
+        "incident_type": event.get("incident_type"),
+    }
+
+
+async def apply_live(collection, events: List[dict], sign: int = 1) -> None:
+    """
+    Update the aggregates for events just written to (sign=1) or deleted
+    from (sign=-1) the events collection; call it after that write. While a
+    rebuild runs the change is journaled for it to replay instead.
+
+    Each call is one unordered bulk_write of the _updates upserts, so
+    batching events (as ingest does per chunk) amortises the per-event
+    write amplification across cells they share.
+    """
+    meta = await _meta(collection).find_one({"_id": META_ID}, projection={"rebuild": 1})
+    rebuild = (meta or {}).get("rebuild")
+    if rebuild and rebuild.get("expires_at") and rebuild["expires_at"] > datetime.utcnow():
+        await _journal(collection).insert_one({
+            "rebuild": rebuild["id"], "sign": sign, "events": [_journal_event(e) for e in events],
+        })
+        return
+    await apply_events(collection, events, sign)
+
+
+class RebuildLeaseLost(Exception):
+    """Another process took over the rebuild lease (this one stalled past AGGREGATES_LEASE_S)."""
+
+
+class _Lease:
+    """
+    Rebuild lease held in one aggregates_meta document: its owner renews it
+    while working; once it expires any process may take it over.
+    """
+
+    def __init__(self, meta, ttl_s: float):
+        self.meta = meta
+        self.ttl_s = ttl_s
+        self.owner = str(ObjectId())
+        self.expires_at: Optional[datetime] = None
+
+    async def acquire(self) -> bool:
+        expires_at = datetime.utcnow() + timedelta(seconds=self.ttl_s)
+        try:
+            await self.meta.find_one_and_update(
+                {"_id": LEASE_ID, "$or": [{"expires_at": {"$lt": datetime.utcnow()}}, {"owner": self.owner}]},
+                {"$set": {"owner": self.owner, "expires_at": expires_at}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            # Held by a live owner: the upsert collided with its document
+            return False
+        self.expires_at = expires_at
+        return True
+
+    async def renew(self) -> None:
+        expires_at = datetime.utcnow() + timedelta(seconds=self.ttl_s)
+        renewed = await self.meta.find_one_and_update(
+            {"_id": LEASE_ID, "owner": self.owner}, {"$set": {"expires_at": expires_at}},
+        )
+        if renewed is None:
+            raise RebuildLeaseLost("Aggregates rebuild lease was taken over by another process")
+        self.expires_at = expires_at
+        await self.meta.update_one({"_id": META_ID, "rebuild.id": self.owner},
+                                   {"$set": {"rebuild.expires_at": expires_at}})
+
+    async def release(self) -> None:
+        await self.meta.delete_one({"_id": LEASE_ID, "owner": self.owner})
+
+
+def _id_keys(ids: Iterable[Any]) -> np.ndarray:
+    """Fixed-width byte keys of event ids, for a sorted membership array."""
+    return np.array([i.binary if isinstance(i, ObjectId) else str(i).encode() for i in ids], dtype="S24")
+
+
+class _Replay:
+    """
+    Writes journaled during one rebuild, applied on top of its scan. Per
+    event id the scan counted it once if it read it, so the correction is
+    (0 if deleted else 1) - (1 if read else 0), applied once.
+    """
+
+    def __init__(self, collection, rebuild_id: str, scanned: np.ndarray):
+        self.journal = _journal(collection)
+        self.rebuild_id = rebuild_id
+        self.scanned = scanned
+        self.seen: List[Any] = []
+        self.events: Dict[str, dict] = {}
+        self.deleted: Set[str] = set()
+        self.applied: Dict[str, int] = {}
+
+    def _read(self, event_id: Any) -> bool:
+        key = _id_keys([event_id])
+        pos = int(np.searchsorted(self.scanned, key)[0])
+        return pos < len(self.scanned) and self.scanned[pos] == key[0]
+
+    async def apply(self, target) -> None:
+        """Apply the entries journaled since the last call to ``target``."""
+        entries = await self.journal.find({"rebuild": self.rebuild_id, "_id": {"$nin": self.seen}}).to_list(length=None)
+        touched = set()
+        for entry in entries:
+            self.seen.append(entry["_id"])
+            for event in entry.get("events") or []:
+                if event.get("_id") is None:
+                    continue
+                key = str(event["_id"])
+                self.events.setdefault(key, event)
+                if entry["sign"] < 0:
+                    self.deleted.add(key)
+                touched.add(key)
+        changes: Dict[int, List[dict]] = {1: [], -1: []}
+        for key in touched:
+            event = self.events[key]
+            wanted = (0 if key in self.deleted else 1) - (1 if self._read(event["_id"]) else 0)
+            delta = wanted - self.applied.get(key, 0)
+            if delta:
+                changes[1 if delta > 0 else -1].append(event)
+                self.applied[key] = wanted
+        for sign, events in changes.items():
+            if events:
+                await apply_events(target, events, sign)
+
+    async def clear(self) -> None:
+        await self.journal.delete_many({"rebuild": self.rebuild_id})
+
+
+async def rebuild(collection, events_collection, batch_size: int = 50000) -> Optional[int]:
+    """
+    Recompute all aggregates from the events collection. Used to backfill
+    when aggregates are first enabled or the configured cell sizes change,
+    and to reconcile them after failed live updates.
+
+    Only the holder of the rebuild lease runs; returns None when another
+    process holds it, else the number of events aggregated. Counts are
+    built in a staging collection renamed over ``collection`` at the end;
+    writes made meanwhile are journaled by apply_live and replayed on top
+    of the scan by event id, so each event counts exactly once.
+    """
+    meta = _meta(collection)
+    lease = _Lease(meta, AGGREGATES_LEASE_S)
+    if not await lease.acquire():
+        return None
+    staging = collection.database[f"{collection.name}_staging"]
+    try:
+        flagged = time.monotonic()
+        # From here on writers journal their changes instead of applying them
+        await meta.update_one(
+            {"_id": META_ID},
+            {"$set": {"ready": False, "rebuild": {"id": lease.owner, "expires_at": lease.expires_at}}},
+            upsert=True,
+        )
+        await staging.drop()
+        await create_aggregate_indexes(staging)
+        # Events written before the flag all have ids up to the newest one
+        # now; later ones are journaled, so the scan may stop there
+        newest = await events_collection.find_one({}, projection={"_id": 1}, sort=[("_id", -1)])
+        query: Dict[str, Any] = {"_id": {"$lte": newest["_id"]}} if newest else {"_id": {"$exists": False}}
+        cursor = events_collection.find(
+            query, projection={"_id": 1, "location.coordinates": 1, "timestamp": 1, "incident_type": 1},
+            batch_size=batch_size,
+        )
+        scanned: List[np.ndarray] = []
+        total = 0
+        while True:
+            docs = await cursor.to_list(length=batch_size)
+            if not docs:
+                break
+            await apply_events(staging, docs, 1)
+            scanned.append(_id_keys(d["_id"] for d in docs))
+            total += len(docs)
+            await lease.renew()
+        replay = _Replay(collection, lease.owner,
+                         np.sort(np.concatenate(scanned)) if scanned else np.empty(0, dtype="S24"))
+        await replay.apply(staging)
+        # Writers that read the meta just before it was flagged still apply
+        # to the old collection; let their updates land before replacing it
+        await asyncio.sleep(max(0.0, AGGREGATES_WRITE_GRACE_S - (time.monotonic() - flagged)))
+        await lease.renew()
+        await staging.rename(collection.name, dropTarget=True)
+        await replay.apply(collection)
+        await meta.update_one({"_id": META_ID}, {"$unset": {"rebuild": ""}})
+        # ... and writers that read it just before the flag was cleared still journal
+        await asyncio.sleep(AGGREGATES_WRITE_GRACE_S)
+        await replay.apply(collection)
+        await meta.update_one(
+            {"_id": META_ID},
+            {"$set": {"ready": True, "cell_sizes": AGGREGATE_CELL_SIZES, "built_at": datetime.utcnow()}},
+            upsert=True,
+        )
+        await replay.clear()
+        return total
+    except BaseException:
+        # Stay not ready; the next rebuild starts over
+        await meta.update_one({"_id": META_ID, "rebuild.id": lease.owner}, {"$unset": {"rebuild": ""}})
+        await _journal(collection).delete_many({"rebuild": lease.owner})
+        raise
+    finally:
+        await lease.release()
+
+
+def supports(cell_size_m: float, filters: Dict[str, Any]) -> bool:
+    """Whether a request can be answered from aggregates instead of raw events."""
+    if float(cell_size_m) not in AGGREGATE_CELL_SIZES:
+        return False
+    # Aggregates count every report, linked duplicates included
+    if filters.get("severity") or filters.get("status") or filters.get("bbox") or filters.get("deduplicated"):
+        return False
+    for field in ("start_date", "end_date"):
+        value = filters.get(field)
+        # Aggregates are per day: only whole-day ranges can be answered exactly
+        if value is not None and (value.hour or value.minute or value.second or value.microsecond):
+            return False
+    return True
+
+
+async def load_cell_counts(collection, cell_size_m: float, filters: Dict[str, Any],
+                           cell_range: Optional[Tuple[int, int, int, int]] = None,
+                           events_collection=None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Return (ix, iy, count) arrays of non-empty cells for the given filters,
+    restricted to ``cell_range`` (ix0, iy0, ix1, iy1, inclusive) when given.
+    Counts match build_event_query on the events, which ``events_collection``
+    (default: the ``events`` collection of the same database) is read for
+    when an end_date is set.
+    """
+    match: Dict[str, Any] = {"cell_size": float(cell_size_m)}
+    if cell_range is not None:
+        match["ix"] = {"$gte": int(cell_range[0]), "$lte": int(cell_range[2])}
+        match["iy"] = {"$gte": int(cell_range[1]), "$lte": int(cell_range[3])}
+    detailed = any(filters.get(f) for f in ("incident_type", "start_date", "end_date"))
+    if not detailed:
+        match["level"] = "total"
+        match["count"] = {"$gt": 0}
+        docs = await collection.find(match, projection={"_id": 0, "ix": 1, "iy": 1, "count": 1}).to_list(length=None)
+    else:
+        match["level"] = "detail"
+        if filters.get("incident_type"):
+            match["incident_type"] = filters["incident_type"]
+        day_range: Dict[str, Any] = {}
+        if filters.get("start_date"):
+            day_range["$gte"] = _event_day(filters["start_date"])
+        if filters.get("end_date"):
+            # Raw queries include timestamp == end_date (midnight, see supports):
+            # whole days before it come from here, that instant from the events
+            day_range["$lt"] = _event_day(filters["end_date"])
+        if day_range:
+            match["day"] = day_range
+        docs = await collection.aggregate([
+            {"$match": match},
+            {"$group": {"_id": {"ix": "$ix", "iy": "$iy"}, "count": {"$sum": "$count"}}},
+            {"$match": {"count": {"$gt": 0}}},
+            {"$project": {"_id": 0, "ix": "$_id.ix", "iy": "$_id.iy", "count": 1}},
+        ]).to_list(length=None)
+    ix = np.fromiter((d["ix"] for d in docs), dtype=np.int64, count=len(docs))
+    iy = np.fromiter((d["iy"] for d in docs), dtype=np.int64, count=len(docs))
+    counts = np.fromiter((d["count"] for d in docs), dtype=np.int64, count=len(docs))
+    if filters.get("end_date"):
+        if events_collection is None:
+            events_collection = collection.database.events
+        ix, iy, counts = await _add_events_at(events_collection, filters, cell_size_m, cell_range, ix, iy, counts)
+    return ix, iy, counts
+
+
+async def _add_events_at(events_collection, filters: Dict[str, Any], cell_size_m: float,
+                         cell_range: Optional[Tuple[int, int, int, int]],
+                         ix: np.ndarray, iy: np.ndarray, counts: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Add the events stamped exactly at end_date to (ix, iy, counts)."""
+    if filters.get("start_date") and filters["start_date"] > filters["end_date"]:
+        return ix, iy, counts
+    query: Dict[str, Any] = {"timestamp": filters["end_date"]}
+    if filters.get("incident_type"):
+        query["incident_type"] = filters["incident_type"]
+    docs = await events_collection.find(query, projection={"_id": 0, "location.coordinates": 1}).to_list(length=None)
+    coords = [c for c in map(_event_coords, docs) if c is not None]
+    if not coords:
+        return ix, iy, counts
+    ex, ey = cell_indices([c[0] for c in coords], [c[1] for c in coords], cell_size_m)
+    if cell_range is not None:
+        keep = (ex >= cell_range[0]) & (ex <= cell_range[2]) & (ey >= cell_range[1]) & (ey <= cell_range[3])
+        ex, ey = ex[keep], ey[keep]
+    cells, summed = np.unique(np.column_stack([np.concatenate([ix, ex]), np.concatenate([iy, ey])]),
+                              axis=0, return_inverse=True)
+    total = np.bincount(summed.ravel(), weights=np.concatenate([counts, np.ones(len(ex), dtype=np.int64)]),
+                        minlength=len(cells))
+    return cells[:, 0], cells[:, 1], np.rint(total).astype(np.int64)
@@ -0,0 +1,136 @@
+# Password hashing and access tokens. Hashing runs in a small thread pool
+# (PBKDF2 releases the GIL) so logins never stall the event loop, and
+# verified tokens are cached until they expire.
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import jwt
+from passlib.context import CryptContext
+
+JWT_SECRET = os.getenv("JWT_SECRET", "dev_secret_change_me")
+JWT_ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "60"))
+# PBKDF2 iterations for new hashes; stored hashes with other counts are
+# rehashed on the next successful login
+PASSWORD_HASH_ROUNDS = int(os.getenv("PASSWORD_HASH_ROUNDS", "29000"))
+# Threads hashing at once, and how many hashes may wait before new logins get 503
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64"))
+TOKEN_CACHE_MAX_ENTRIES = int(os.getenv("TOKEN_CACHE_MAX_ENTRIES", "10000"))
+
+# Use pbkdf2_sha256 to avoid external bcrypt backend issues on Windows
+pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto",
+                           pbkdf2_sha256__rounds=PASSWORD_HASH_ROUNDS)
+
+
+class HasherBusy(Exception):
+    """Raised when the maximum number of password hashes are already queued or running."""
+
+
+class PasswordHasher:
+    """
+    Hashes and verifies passwords in a thread pool of ``max_workers``; at
+    most ``max_pending`` operations may be queued or running, so a login
+    storm is shed instead of piling up behind the pool.
+    """
+
+    def __init__(self, context: CryptContext = pwd_context, max_workers: int = PASSWORD_HASH_WORKERS,
+                 max_pending: int = PASSWORD_HASH_MAX_PENDING):
+        self.context = context
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._pending = 0
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="password-hash")
+        return self._executor
+
+    def pending(self) -> int:
+        return self._pending
+
+    async def _run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        if self._pending >= self.max_pending:
+            raise HasherBusy(f"Too many logins in progress ({self.max_pending} pending)")
+        self._pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        finally:
+            self._pending -= 1
+
+    async def hash(self, password: str) -> str:
+        return await self._run(self.context.hash, password)
+
+    async def verify_and_update(self, password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+        """(valid, new hash) where the new hash is set when the stored one uses other rounds."""
+        if not hashed:
+            return False, None
+        try:
+            return await self._run(self.context.verify_and_update, password, hashed)
+        except ValueError:
+            # Unrecognised or malformed stored hash
+            return False, None
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+def create_access_token(subject: str, role: str) -> str:
+    to_encode = {
+        "sub": subject,
+        "role": role,
+        "iat": datetime.utcnow(),
+        "exp": datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES),
+    }
+    return jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGORITHM)
+
+
+class TokenCache:
+    """
+    LRU of verified token claims, keyed by the token itself. An entry is
+    only served until the token's ``exp``, so a cached token expires exactly
+    as a freshly decoded one would.
+    """
+
+    def __init__(self, max_entries: int = TOKEN_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+    def get(self, token: str) -> Optional[Dict[str, Any]]:
+        claims = self._entries.get(token)
+        if claims is None:
+            return None
+        if claims["exp"] <= time.time():
+            del self._entries[token]
+            return None
+        self._entries.move_to_end(token)
+        return claims
+
+    def put(self, token: str, claims: Dict[str, Any]) -> None:
+        if self.max_entries <= 0 or "exp" not in claims:
+            return
+        self._entries[token] = claims
+        self._entries.move_to_end(token)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+def decode_access_token(token: str, cache: Optional[TokenCache] = None) -> Dict[str, Any]:
+    """Verified claims of an access token; raises jwt.InvalidTokenError."""
+    if cache is not None:
+        claims = cache.get(token)
+        if claims is not None:
+            return claims
+    claims = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM], options={"require": ["exp", "sub"]})
+    if cache is not None:
+        cache.put(token, claims)
+    return claims
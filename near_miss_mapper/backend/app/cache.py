@@ -0,0 +1,132 @@
+# Content-addressed cache for analysis results
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+
+def cache_key(kind: str, params: Dict[str, Any], fingerprint: Dict[str, Any]) -> str:
+    """Stable hash of the analysis kind, its parameters and the data version."""
+    payload = json.dumps({'kind': kind, 'params': params, 'data': fingerprint},
+                         sort_keys=True, default=str, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """
+    LRU cache of JSON-serializable results bounded by entry count and total
+    serialized size, backed by ``<cache_dir>/<key>.json`` so results (and the
+    output files they point to) are reused across restarts.
+    """
+
+    def __init__(self, cache_dir: str, max_entries: int = 128, max_bytes: int = 64 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, Tuple[Dict[str, Any], int]]" = OrderedDict()
+        self._bytes = 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            if not all(os.path.exists(p) for p in _output_paths(entry[0])):
+                self._bytes -= self._entries.pop(key)[1]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                raw = f.read()
+            result = json.loads(raw)
+        except (OSError, ValueError):
+            return None
+        # Outputs may have been cleaned up independently of the cache entry
+        if not all(os.path.exists(p) for p in _output_paths(result)):
+            return None
+        self._remember(key, result, len(raw))
+        return result
+
+    def put(self, key: str, result: Dict[str, Any]) -> None:
+        raw = json.dumps(result, default=str)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = self._path(key) + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(raw)
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            print(f"Result cache write warning: {e}")
+        self._remember(key, json.loads(raw), len(raw))
+
+    def _remember(self, key: str, result: Dict[str, Any], size: int) -> None:
+        if size > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= old[1]
+        self._entries[key] = (result, size)
+        self._bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._bytes -= evicted
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._bytes = 0
+
+
+def _output_paths(result: Dict[str, Any]) -> List[str]:
+    """Files on disk that a cached result refers to."""
+    paths = list((result.get('outputs') or {}).values()) + [result.get('shapefile_path')]
+    return list(dict.fromkeys(path for path in paths if path))
+
+
+def cleanup_outputs(out_dir: str, max_age_s: Optional[float] = None, max_bytes: Optional[int] = None,
+                    now: Optional[float] = None) -> int:
+    """
+    Retention for the analysis outputs directory (and its cache/weights
+    subdirectories): delete outputs older than ``max_age_s``, then the
+    oldest ones until the total size fits ``max_bytes``. Files sharing a
+    stem (shapefile sidecars) are kept or removed together. Returns the
+    number of files deleted.
+    """
+    if not os.path.isdir(out_dir):
+        return 0
+    now = time.time() if now is None else now
+    groups: Dict[str, List[Tuple[str, os.stat_result]]] = {}
+    for root, _, files in os.walk(out_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            groups.setdefault(os.path.splitext(path)[0], []).append((path, st))
+    # (newest mtime, size, paths) per output, oldest first
+    outputs = sorted(
+        (max(st.st_mtime for _, st in files), sum(st.st_size for _, st in files), [p for p, _ in files])
+        for files in groups.values()
+    )
+    total = sum(size for _, size, _ in outputs)
+    deleted = 0
+    for mtime, size, paths in outputs:
+        expired = max_age_s is not None and now - mtime > max_age_s
+        over_budget = max_bytes is not None and total > max_bytes
+        if not (expired or over_budget):
+            continue
+        for path in paths:
+            try:
+                os.remove(path)
+                deleted += 1
+            except OSError:
+                pass
+        total -= size
+    return deleted
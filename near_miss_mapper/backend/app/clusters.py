@@ -0,0 +1,93 @@
+# Server-side clustering of events for map viewports
+import math
+import os
+from typing import Any, Dict, List
+
+from app.geo import EARTH_RADIUS_M, MAX_MERCATOR_LAT
+
+SEVERITY_RANKS = {"low": 1, "medium": 2, "high": 3, "critical": 4}
+SEVERITY_NAMES = {rank: name for name, rank in SEVERITY_RANKS.items()}
+
+TILE_SIZE_PX = 256
+# Defaults match the map's client-side clustering (maxClusterRadius,
+# disableClusteringAtZoom)
+CLUSTER_RADIUS_PX = int(os.getenv("CLUSTER_RADIUS_PX", "60"))
+CLUSTER_MAX_ZOOM = int(os.getenv("CLUSTER_MAX_ZOOM", "16"))
+# Upper bound on individual events returned once clustering stops
+CLUSTER_MAX_EVENTS = int(os.getenv("CLUSTER_MAX_EVENTS", "2000"))
+
+
+def cluster_cell_size(zoom: int, radius_px: int = CLUSTER_RADIUS_PX) -> float:
+    """Side in Web Mercator metres of a ``radius_px`` screen cell at ``zoom``."""
+    return 2 * math.pi * EARTH_RADIUS_M / (TILE_SIZE_PX * 2 ** zoom) * radius_px
+
+
+def cluster_pipeline(query: Dict[str, Any], cell_size_m: float) -> List[Dict[str, Any]]:
+    """
+    Aggregation pipeline grouping matching events into square Web Mercator
+    cells of ``cell_size_m``: count, max severity rank, mean position and
+    the id of the first event (the event itself for singletons).
+    """
+    lon = {"$arrayElemAt": ["$location.coordinates", 0]}
+    lat = {"$arrayElemAt": ["$location.coordinates", 1]}
+    rank = {"$switch": {
+        "branches": [{"case": {"$eq": ["$severity", name]}, "then": r} for name, r in SEVERITY_RANKS.items()],
+        "default": 0,
+    }}
+    # Same projection as geo.mercator_xy: y = R * atanh(sin(lat))
+    sin_lat = {"$sin": {"$multiply": [
+        {"$min": [{"$max": ["$lat", -MAX_MERCATOR_LAT]}, MAX_MERCATOR_LAT]}, math.pi / 180,
+    ]}}
+    x = {"$multiply": ["$lon", EARTH_RADIUS_M * math.pi / 180]}
+    y = {"$multiply": [0.5 * EARTH_RADIUS_M, {"$ln": {"$divide": [
+        {"$add": [1, "$sin_lat"]}, {"$subtract": [1, "$sin_lat"]},
+    ]}}]}
+    return [
+        {"$match": query},
+        {"$project": {"lon": lon, "lat": lat, "rank": rank}},
+        {"$project": {"lon": 1, "lat": 1, "rank": 1, "sin_lat": sin_lat}},
+        {"$group": {
+            "_id": {
+                "ix": {"$floor": {"$divide": [x, cell_size_m]}},
+                "iy": {"$floor": {"$divide": [y, cell_size_m]}},
+            },
+            "count": {"$sum": 1},
+            "max_rank": {"$max": "$rank"},
+            "lon": {"$avg": "$lon"},
+            "lat": {"$avg": "$lat"},
+            "event_id": {"$first": "$_id"},
+        }},
+    ]
+
+
+async def load_clusters(collection, query: Dict[str, Any], zoom: int,
+                        radius_px: int = CLUSTER_RADIUS_PX) -> Dict[str, Any]:
+    """Clustered counts for the viewport query at ``zoom``."""
+    cell_size = cluster_cell_size(zoom, radius_px)
+    docs = await collection.aggregate(cluster_pipeline(query, cell_size)).to_list(length=None)
+    clusters = []
+    for doc in docs:
+        cluster: Dict[str, Any] = {
+            "lon": doc["lon"],
+            "lat": doc["lat"],
+            "count": doc["count"],
+            "max_severity": SEVERITY_NAMES.get(doc["max_rank"]),
+        }
+        if doc["count"] == 1:
+            cluster["id"] = str(doc["event_id"])
+        clusters.append(cluster)
+    return {"zoom": zoom, "clustered": True, "cell_size_m": cell_size, "clusters": clusters}
+
+
+async def load_viewport_events(collection, query: Dict[str, Any], zoom: int,
+                               limit: int = CLUSTER_MAX_EVENTS) -> Dict[str, Any]:
+    """Raw event documents for the viewport once zoomed in past CLUSTER_MAX_ZOOM."""
+    docs = await collection.find(query, sort=[("_id", 1)], limit=limit + 1).to_list(length=limit + 1)
+    truncated = len(docs) > limit
+    docs = docs[:limit]
+    return {
+        "zoom": zoom,
+        "clustered": False,
+        "events": docs,
+        "truncated": truncated,
+    }
@@ -1,8 +1,13 @@
+import math
 import motor.motor_asyncio
 import os
+from datetime import datetime, timezone
+import numpy as np
 from dotenv import load_dotenv
 from bson import ObjectId
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple
+
+from app.geo import MAX_MERCATOR_LAT, box_polygons
 
 # Load environment variables
 load_dotenv()
@@ -19,14 +24,186 @@ db = client[DB_NAME]
 events_collection = db.events
 
 # Indexes
-async def create_indexes():
+async def create_indexes(collection=events_collection):
     # Create 2dsphere index for geospatial queries
-    await events_collection.create_index([("location", "2dsphere")])
+    await collection.create_index([("location", "2dsphere")])
     # Create indexes for common query fields
-    await events_collection.create_index([("incident_type", 1)])
-    await events_collection.create_index([("severity", 1)])
-    await events_collection.create_index([("status", 1)])
-    await events_collection.create_index([("timestamp", -1)])
+    await collection.create_index([("incident_type", 1)])
+    await collection.create_index([("severity", 1)])
+    await collection.create_index([("status", 1)])
+    await collection.create_index([("timestamp", -1)])
+    # Compound indexes for filtered analyses: equality fields first, then the
+    # time range, then the bbox (see build_event_query)
+    await collection.create_index([("severity", 1), ("timestamp", -1), ("location", "2dsphere")])
+    await collection.create_index([("incident_type", 1), ("timestamp", -1), ("location", "2dsphere")])
+    await collection.create_index([("status", 1), ("timestamp", -1), ("location", "2dsphere")])
+    await collection.create_index([("timestamp", -1), ("location", "2dsphere")])
+    # Linked duplicate reports (see app.dedup), looked up when their primary is deleted
+    await collection.create_index([("duplicate_of", 1)], sparse=True)
+
+# Split a viewport bbox into the planar lon/lat boxes it covers
+def bbox_boxes(bbox) -> List[Tuple[float, float, float, float]]:
+    """
+    Normalise ``bbox`` ([min_lon, min_lat, max_lon, max_lat], as a map
+    viewport reports it) into one or two boxes within [-180, 180]. Longitudes
+    may run past the antimeridian (max_lon > 180 or min_lon < -180, or
+    max_lon < min_lon as in GeoJSON) and are split there; latitudes are
+    clamped and an edge at the Web Mercator limit extends to the pole, since
+    the map and the aggregates draw polar events on that edge.
+    """
+    if len(bbox) != 4:
+        raise ValueError("bbox must be [min_lon, min_lat, max_lon, max_lat]")
+    min_lon, min_lat, max_lon, max_lat = (float(v) for v in bbox)
+    if not all(math.isfinite(v) for v in (min_lon, min_lat, max_lon, max_lat)):
+        raise ValueError("bbox values must be finite")
+    min_lat = -90.0 if min_lat <= -MAX_MERCATOR_LAT else min(min_lat, 90.0)
+    max_lat = 90.0 if max_lat >= MAX_MERCATOR_LAT else max(max_lat, -90.0)
+    if min_lon == max_lon or min_lat >= max_lat:
+        raise ValueError("bbox min values must be smaller than max values")
+    if max_lon < min_lon:
+        max_lon += 360
+    if max_lon - min_lon >= 360:
+        return [(-180.0, min_lat, 180.0, max_lat)]
+    shift = math.floor((min_lon + 180) / 360) * 360
+    min_lon, max_lon = min_lon - shift, max_lon - shift
+    if max_lon <= 180:
+        return [(min_lon, min_lat, max_lon, max_lat)]
+    return [(min_lon, min_lat, 180.0, max_lat), (-180.0, min_lat, max_lon - 360, max_lat)]
+
+# Translate event filters (EventQueryParams fields) into a Mongo query
+def build_event_query(filters: Dict[str, Any]) -> dict:
+    query: Dict[str, Any] = {}
+    for field in ("incident_type", "severity", "status"):
+        if filters.get(field):
+            query[field] = filters[field]
+    time_range = {}
+    if filters.get("start_date"):
+        time_range["$gte"] = filters["start_date"]
+    if filters.get("end_date"):
+        time_range["$lte"] = filters["end_date"]
+    if time_range:
+        query["timestamp"] = time_range
+    if filters.get("deduplicated"):
+        query["duplicate_of"] = {"$exists": False}
+    bbox = filters.get("bbox")
+    if bbox:
+        # Served by the 2dsphere indexes (location alone, or after the
+        # equality and time prefix of the compound ones, see create_indexes);
+        # legacy $box would need a 2d index. Densified edges keep the
+        # geodesic polygon on the planar viewport edges
+        polygons = [p for box in bbox_boxes(bbox) for p in box_polygons(*box)]
+        geometry = ({"type": "Polygon", "coordinates": polygons[0]} if len(polygons) == 1
+                    else {"type": "MultiPolygon", "coordinates": polygons})
+        query["location"] = {"$geoWithin": {"$geometry": geometry}}
+    return query
+
+# Cheap data-version fingerprint of a collection for result caching:
+# any insert changes the newest _id, any delete changes the count
+async def collection_fingerprint(collection) -> Dict[str, Any]:
+    count = await collection.estimated_document_count()
+    newest = await collection.find_one({}, projection={"_id": 1}, sort=[("_id", -1)])
+    return {
+        "count": int(count),
+        "max_id": str(newest["_id"]) if newest else None,
+    }
+
+# Bulk loader for analyses: only the coordinates are projected and fetched
+# in large batches, then decoded straight into float64 arrays
+EVENT_LOAD_BATCH_SIZE = int(os.getenv("EVENT_LOAD_BATCH_SIZE", "50000"))
+
+def _coordinate_pairs(docs: List[dict]) -> np.ndarray:
+    pairs = []
+    for doc in docs:
+        coords = (doc.get("location") or {}).get("coordinates")
+        if isinstance(coords, (list, tuple)) and len(coords) == 2:
+            pairs.append(coords)
+    try:
+        arr = np.asarray(pairs, dtype=np.float64).reshape(-1, 2)
+    except (TypeError, ValueError):
+        # Slow path: drop individual malformed coordinates
+        good = []
+        for c in pairs:
+            try:
+                good.append((float(c[0]), float(c[1])))
+            except (TypeError, ValueError):
+                continue
+        arr = np.asarray(good, dtype=np.float64).reshape(-1, 2)
+    return arr[np.isfinite(arr).all(axis=1)]
+
+async def load_event_coordinates(collection, query: Optional[dict] = None,
+                                 batch_size: int = EVENT_LOAD_BATCH_SIZE) -> Tuple[np.ndarray, np.ndarray]:
+    """Return (lon, lat) float64 arrays for all events matching query."""
+    cursor = collection.find(query or {}, projection={"_id": 0, "location.coordinates": 1}, batch_size=batch_size)
+    chunks = []
+    while True:
+        docs = await cursor.to_list(length=batch_size)
+        if not docs:
+            break
+        chunks.append(_coordinate_pairs(docs))
+    coords = np.concatenate(chunks) if chunks else np.empty((0, 2), dtype=np.float64)
+    return np.ascontiguousarray(coords[:, 0]), np.ascontiguousarray(coords[:, 1])
+
+# Space-time variant for emerging hot spot analyses: coordinates plus the
+# event time as UTC epoch seconds (naive timestamps are taken as UTC)
+def _coordinate_time_rows(docs: List[dict]) -> np.ndarray:
+    rows = []
+    for doc in docs:
+        coords = (doc.get("location") or {}).get("coordinates")
+        ts = doc.get("timestamp")
+        if not isinstance(ts, datetime) or not isinstance(coords, (list, tuple)) or len(coords) != 2:
+            continue
+        if ts.tzinfo is None:
+            ts = ts.replace(tzinfo=timezone.utc)
+        try:
+            rows.append((float(coords[0]), float(coords[1]), ts.timestamp()))
+        except (TypeError, ValueError):
+            continue
+    arr = np.asarray(rows, dtype=np.float64).reshape(-1, 3)
+    return arr[np.isfinite(arr).all(axis=1)]
+
+async def load_event_points(collection, query: Optional[dict] = None,
+                            batch_size: int = EVENT_LOAD_BATCH_SIZE) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Return (lon, lat, epoch seconds) float64 arrays for all events matching query."""
+    cursor = collection.find(query or {}, projection={"_id": 0, "location.coordinates": 1, "timestamp": 1},
+                             batch_size=batch_size)
+    chunks = []
+    while True:
+        docs = await cursor.to_list(length=batch_size)
+        if not docs:
+            break
+        chunks.append(_coordinate_time_rows(docs))
+    rows = np.concatenate(chunks) if chunks else np.empty((0, 3), dtype=np.float64)
+    return tuple(np.ascontiguousarray(rows[:, i]) for i in range(3))
+
+# Weighted variant for density surfaces: each event weighs weights[field]
+# (e.g. per severity), unlisted or missing values weigh `default`
+def _coordinate_weight_rows(docs: List[dict], field: str, weights: Dict[str, float], default: float) -> np.ndarray:
+    rows = []
+    for doc in docs:
+        coords = (doc.get("location") or {}).get("coordinates")
+        if not isinstance(coords, (list, tuple)) or len(coords) != 2:
+            continue
+        try:
+            rows.append((float(coords[0]), float(coords[1]), float(weights.get(doc.get(field), default))))
+        except (TypeError, ValueError):
+            continue
+    arr = np.asarray(rows, dtype=np.float64).reshape(-1, 3)
+    return arr[np.isfinite(arr).all(axis=1)]
+
+async def load_event_weights(collection, query: Optional[dict], field: str, weights: Dict[str, float],
+                             default: float = 1.0,
+                             batch_size: int = EVENT_LOAD_BATCH_SIZE) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Return (lon, lat, weight) float64 arrays for all events matching query."""
+    cursor = collection.find(query or {}, projection={"_id": 0, "location.coordinates": 1, field: 1},
+                             batch_size=batch_size)
+    chunks = []
+    while True:
+        docs = await cursor.to_list(length=batch_size)
+        if not docs:
+            break
+        chunks.append(_coordinate_weight_rows(docs, field, weights, default))
+    rows = np.concatenate(chunks) if chunks else np.empty((0, 3), dtype=np.float64)
+    return tuple(np.ascontiguousarray(rows[:, i]) for i in range(3))
 
 # Helper function to convert MongoDB document to dict
 def event_helper(event) -> dict:
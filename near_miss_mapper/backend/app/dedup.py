@@ -0,0 +1,270 @@
+# Ingest-time duplicate detection: reports of the same incident (close in
+# space and time) are linked to, or merged into, the first report instead
+# of counting as separate events
+import math
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from app.geo import EARTH_RADIUS_M, MAX_MERCATOR_LAT
+
+# off: insert every report; link: insert duplicates with duplicate_of set;
+# merge: do not insert duplicates, record them on the first report
+DEDUP_MODES = ("off", "link", "merge")
+DEDUP_MODE = os.getenv("DEDUP_MODE", "link")
+DEDUP_DISTANCE_M = float(os.getenv("DEDUP_DISTANCE_M", "30"))
+DEDUP_WINDOW_MINUTES = float(os.getenv("DEDUP_WINDOW_MINUTES", "15"))
+# Only reports of the same incident_type are duplicates of each other
+DEDUP_SAME_TYPE = os.getenv("DEDUP_SAME_TYPE", "true").lower() in ("1", "true", "yes")
+# Primaries kept in memory, by event time behind the newest event seen;
+# older reports are not deduplicated
+DEDUP_RETENTION_HOURS = float(os.getenv("DEDUP_RETENTION_HOURS", "168"))
+
+
+def _epoch(value: Any) -> Optional[float]:
+    if not isinstance(value, datetime):
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def _mercator(lon: float, lat: float) -> Tuple[float, float]:
+    # Scalar form of geo.mercator_xy: numpy is slower for one point
+    lat = max(-MAX_MERCATOR_LAT, min(MAX_MERCATOR_LAT, lat))
+    return (EARTH_RADIUS_M * math.radians(lon),
+            EARTH_RADIUS_M * math.log(math.tan(math.pi / 4 + math.radians(lat) / 2)))
+
+
+def _haversine_m(lon1: float, lat1: float, lon2: float, lat2: float) -> float:
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((p2 - p1) / 2) ** 2
+         + math.cos(p1) * math.cos(p2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(min(1.0, a)))
+
+
+def _point(doc: dict) -> Optional[Tuple[float, float, float]]:
+    coords = (doc.get("location") or {}).get("coordinates")
+    t = _epoch(doc.get("timestamp"))
+    try:
+        lon, lat = float(coords[0]), float(coords[1])
+    except (TypeError, ValueError, IndexError, KeyError):
+        return None
+    if t is None or not (math.isfinite(lon) and math.isfinite(lat)):
+        return None
+    return lon, lat, t
+
+
+class DuplicateIndex:
+    """
+    Spatio-temporal hash of primary (first) reports: buckets are cells of
+    the Web Mercator lattice ``distance_m`` wide times time slots of
+    ``window_s``, so a lookup only reads the few buckets around a report.
+    Buckets older than ``retention_s`` behind the newest report are dropped.
+    """
+
+    def __init__(self, distance_m: float = DEDUP_DISTANCE_M, window_s: float = DEDUP_WINDOW_MINUTES * 60,
+                 same_type: bool = DEDUP_SAME_TYPE, retention_s: float = DEDUP_RETENTION_HOURS * 3600):
+        self.distance_m = distance_m
+        self.window_s = window_s
+        self.same_type = same_type
+        self.retention_slots = max(1, math.ceil(retention_s / window_s))
+        self.ready = False
+        self._journal: Optional[List[Tuple[int, Any]]] = None
+        self._clear()
+
+    def _clear(self) -> None:
+        # (ix, iy, slot) -> [(id, lon, lat, t, incident_type)]
+        self._buckets: Dict[Tuple[int, int, int], List[tuple]] = defaultdict(list)
+        self._slots: Dict[int, Set[Tuple[int, int, int]]] = defaultdict(set)
+        self._where: Dict[str, Tuple[int, int, int]] = {}
+        self._newest_slot: Optional[int] = None
+
+    def __len__(self) -> int:
+        return len(self._where)
+
+    def _key(self, lon: float, lat: float, t: float) -> Tuple[int, int, int]:
+        x, y = _mercator(lon, lat)
+        return math.floor(x / self.distance_m), math.floor(y / self.distance_m), math.floor(t / self.window_s)
+
+    def _expired(self, slot: int) -> bool:
+        return self._newest_slot is not None and slot < self._newest_slot - self.retention_slots
+
+    async def build(self, collection) -> int:
+        """Load primaries within the retention window of the newest event."""
+        self.ready = False
+        self._journal = []
+        try:
+            self._clear()
+            newest = await collection.find_one({"timestamp": {"$type": "date"}}, projection={"timestamp": 1},
+                                               sort=[("timestamp", -1)])
+            if newest is not None:
+                since = newest["timestamp"] - timedelta(seconds=self.retention_slots * self.window_s)
+                cursor = collection.find(
+                    {"timestamp": {"$gte": since}, "duplicate_of": {"$exists": False}},
+                    projection={"location.coordinates": 1, "timestamp": 1, "incident_type": 1},
+                )
+                async for doc in cursor:
+                    self._insert(doc)
+            journal, self._journal = self._journal, None
+            for op, value in journal:
+                if op > 0:
+                    self.add(value)
+                else:
+                    self.remove(value)
+        finally:
+            self._journal = None
+        self.ready = True
+        return len(self)
+
+    def match(self, doc: dict) -> Optional[Any]:
+        """Id of the primary report ``doc`` duplicates (nearest in space, then time), if any."""
+        point = _point(doc)
+        if point is None:
+            return None
+        lon, lat, t = point
+        ix, iy, slot = self._key(lon, lat, t)
+        # Mercator stretches ground distances by sec(lat): widen the cell reach accordingly
+        lat_edge = min(abs(lat) + math.degrees(self.distance_m / EARTH_RADIUS_M), MAX_MERCATOR_LAT)
+        reach = math.ceil(1 / math.cos(math.radians(lat_edge)))
+        best, best_rank = None, None
+        for dt in (-1, 0, 1):
+            if self._expired(slot + dt):
+                continue
+            for dx in range(-reach, reach + 1):
+                for dy in range(-reach, reach + 1):
+                    for event_id, lon2, lat2, t2, incident_type in self._buckets.get((ix + dx, iy + dy, slot + dt), ()):
+                        if abs(t2 - t) > self.window_s:
+                            continue
+                        if self.same_type and incident_type != doc.get("incident_type"):
+                            continue
+                        d = _haversine_m(lon, lat, lon2, lat2)
+                        if d <= self.distance_m and (best_rank is None or (d, abs(t2 - t)) < best_rank):
+                            best, best_rank = event_id, (d, abs(t2 - t))
+        return best
+
+    def _insert(self, doc: dict) -> None:
+        point = _point(doc)
+        if point is None or str(doc["_id"]) in self._where:
+            return
+        key = self._key(*point)
+        if self._expired(key[2]):
+            return
+        self._buckets[key].append((doc["_id"], point[0], point[1], point[2], doc.get("incident_type")))
+        self._slots[key[2]].add(key)
+        self._where[str(doc["_id"])] = key
+        if self._newest_slot is None or key[2] > self._newest_slot:
+            self._newest_slot = key[2]
+            self._evict()
+
+    def _evict(self) -> None:
+        for slot in [s for s in self._slots if self._expired(s)]:
+            for key in self._slots.pop(slot):
+                for entry in self._buckets.pop(key, ()):
+                    self._where.pop(str(entry[0]), None)
+
+    def add(self, docs: Iterable[dict]) -> None:
+        """Index reports as primaries."""
+        docs = list(docs)
+        if self._journal is not None:
+            self._journal.append((1, docs))
+            return
+        for doc in docs:
+            self._insert(doc)
+
+    def remove(self, ids: Iterable[Any]) -> None:
+        ids = [str(i) for i in ids]
+        if self._journal is not None:
+            self._journal.append((-1, ids))
+            return
+        for event_id in ids:
+            key = self._where.pop(event_id, None)
+            if key is None:
+                continue
+            bucket = self._buckets[key]
+            bucket[:] = [entry for entry in bucket if str(entry[0]) != event_id]
+            if not bucket:
+                del self._buckets[key]
+                self._slots[key[2]].discard(key)
+
+
+class Deduplicator:
+    """
+    One ingestion's duplicate handling: ``resolve`` assigns ids and finds
+    duplicates before the insert, ``commit`` records them on their
+    primaries after it. Reports without a match become primaries at once,
+    so duplicates within the same request are caught too.
+    """
+
+    def __init__(self, index: DuplicateIndex, collection, mode: str = DEDUP_MODE):
+        self.index = index
+        self.collection = collection
+        self.mode = mode
+        self.linked = 0
+        self.merged = 0
+
+    def resolve(self, docs: List[dict]) -> Tuple[List[int], Dict[Any, List[dict]]]:
+        """Positions of ``docs`` to insert, and the duplicates found per primary id."""
+        duplicates: Dict[Any, List[dict]] = defaultdict(list)
+        keep = []
+        for i, doc in enumerate(docs):
+            doc.setdefault("_id", ObjectId())
+            primary = self.index.match(doc) if self.mode != "off" and self.index.ready else None
+            if primary is None:
+                self.index.add([doc])
+                keep.append(i)
+                continue
+            duplicates[primary].append(doc)
+            if self.mode == "link":
+                doc["duplicate_of"] = primary
+                keep.append(i)
+                self.linked += 1
+            else:
+                self.merged += 1
+        return keep, duplicates
+
+    async def commit(self, duplicates: Dict[Any, List[dict]], failed: Iterable[dict] = ()) -> None:
+        """Count duplicates on their primaries; ``failed`` are resolved docs that were not inserted."""
+        failed_ids = {doc["_id"] for doc in failed}
+        self.index.remove(failed_ids)
+        updates = []
+        for primary, docs in duplicates.items():
+            docs = [doc for doc in docs if doc["_id"] not in failed_ids]
+            if not docs:
+                continue
+            update: Dict[str, Any] = {"$inc": {"duplicates": len(docs)}}
+            if self.mode == "merge":
+                update["$push"] = {"merged_reports": {"$each": [
+                    {k: doc.get(k) for k in ("reported_by", "timestamp", "severity", "description")} for doc in docs
+                ]}}
+            updates.append(UpdateOne({"_id": primary}, update))
+        if updates:
+            await self.collection.bulk_write(updates, ordered=False)
+
+
+async def promote(collection, deleted: dict) -> Optional[dict]:
+    """
+    Keep incident counts right after a delete: a deleted duplicate is
+    uncounted from its primary; a deleted primary hands over to its earliest
+    linked duplicate, which is returned.
+    """
+    if deleted.get("duplicate_of") is not None:
+        await collection.update_one({"_id": deleted["duplicate_of"]}, {"$inc": {"duplicates": -1}})
+        return None
+    if not deleted.get("duplicates"):
+        return None
+    successor = await collection.find_one({"duplicate_of": deleted["_id"]}, sort=[("timestamp", 1), ("_id", 1)])
+    if successor is None:
+        return None
+    remaining = await collection.count_documents({"duplicate_of": deleted["_id"]}) - 1
+    await collection.update_many({"duplicate_of": deleted["_id"], "_id": {"$ne": successor["_id"]}},
+                                 {"$set": {"duplicate_of": successor["_id"]}})
+    await collection.update_one({"_id": successor["_id"]},
+                                {"$unset": {"duplicate_of": ""}, "$set": {"duplicates": remaining}})
+    successor.pop("duplicate_of", None)
+    successor["duplicates"] = remaining
+    return successor
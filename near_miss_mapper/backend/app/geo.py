@@ -0,0 +1,77 @@
+# Web Mercator (EPSG:3857) constants and projection shared by the web
+# process and the analysis workers; numpy only
+import math
+from typing import List, Tuple
+
+import numpy as np
+
+EARTH_RADIUS_M = 6378137.0
+MAX_MERCATOR_LAT = 85.05112878
+WORLD_SIZE_M = 2 * math.pi * EARTH_RADIUS_M
+
+
+def mercator_xy(lon: np.ndarray, lat: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Closed-form EPSG:3857 projection, so inserts need no pyproj."""
+    lon = np.asarray(lon, dtype=float)
+    lat = np.clip(np.asarray(lat, dtype=float), -MAX_MERCATOR_LAT, MAX_MERCATOR_LAT)
+    x = EARTH_RADIUS_M * np.radians(lon)
+    y = EARTH_RADIUS_M * np.log(np.tan(np.pi / 4 + np.radians(lat) / 2))
+    return x, y
+
+
+def mercator_lonlat(mx: float, my: float) -> Tuple[float, float]:
+    """Inverse of mercator_xy for one point."""
+    lon = math.degrees(mx / EARTH_RADIUS_M)
+    lat = math.degrees(2 * math.atan(math.exp(my / EARTH_RADIUS_M)) - math.pi / 2)
+    return lon, lat
+
+
+def tile_bounds(z: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    """(minx, miny, maxx, maxy) of an XYZ tile in Web Mercator metres."""
+    span = WORLD_SIZE_M / 2 ** z
+    minx = -WORLD_SIZE_M / 2 + x * span
+    maxy = WORLD_SIZE_M / 2 - y * span
+    return minx, maxy - span, minx + span, maxy
+
+
+def _parallel_segments(lat: float, width: float, tolerance_m: float, max_segments: int) -> int:
+    """
+    Segments along a parallel of ``width`` degrees so that the geodesic
+    between neighbouring vertices, which bulges poleward, strays at most
+    ``tolerance_m`` from it: tan(lat_mid) = tan(lat) / cos(step / 2).
+    """
+    phi = math.radians(abs(lat))
+    reach = phi + tolerance_m / EARTH_RADIUS_M
+    if phi == 0 or reach >= math.pi / 2:
+        return 1
+    step = 2 * math.acos(math.tan(phi) / math.tan(reach))
+    return max(1, min(max_segments, math.ceil(math.radians(width) / step)))
+
+
+def box_polygons(min_lon: float, min_lat: float, max_lon: float, max_lat: float,
+                 tolerance_m: float = 1.0, max_segments: int = 1024,
+                 max_width: float = 90.0) -> List[List[List[float]]]:
+    """
+    GeoJSON polygon rings whose geodesic edges follow the planar lon/lat box
+    within ``tolerance_m`` (``max_segments`` per parallel allowing): pieces
+    at most ``max_width`` degrees wide, well under a hemisphere, with their
+    parallels densified. Meridians are geodesics already; a side at a pole
+    becomes a single pole vertex.
+    """
+    pieces = max(1, math.ceil((max_lon - min_lon) / max_width))
+    edges = np.linspace(min_lon, max_lon, pieces + 1)
+    mid_lat = (min_lat + max_lat) / 2
+    rings = []
+    for a, b in zip(edges[:-1].tolist(), edges[1:].tolist()):
+        if min_lat <= -90:
+            south = [[(a + b) / 2, -90.0]]
+        else:
+            n = _parallel_segments(min_lat, b - a, tolerance_m, max_segments)
+            south = [[lon, min_lat] for lon in np.linspace(a, b, n + 1).tolist()]
+        if max_lat >= 90:
+            north = [[(a + b) / 2, 90.0]]
+        else:
+            n = _parallel_segments(max_lat, b - a, tolerance_m, max_segments)
+            north = [[lon, max_lat] for lon in np.linspace(b, a, n + 1).tolist()]
+        rings.append(south + [[b, mid_lat]] + north + [[a, mid_lat], south[0]])
+    return [[ring] for ring in rings]
@@ -0,0 +1,138 @@
+# Kernel density heatmap rasters: window layout on the global Web Mercator
+# lattice, uint16 quantisation and PNG encoding (numpy + stdlib only, so the
+# web process can plan queries without the spatial stack)
+import base64
+import math
+import os
+import struct
+import zlib
+from typing import Any, Dict, Tuple
+
+import numpy as np
+
+from app.geo import MAX_MERCATOR_LAT, mercator_lonlat, mercator_xy
+
+KERNELS = ("gaussian", "quartic")
+# Upper bound on raster cells (including the kernel margin) in one heatmap
+KDE_MAX_CELLS = int(os.getenv("KDE_MAX_CELLS", "4000000"))
+# Gaussian kernels are truncated at this many bandwidths (sigma)
+GAUSSIAN_TRUNCATE = 3.0
+
+# Colour ramp stops (position, RGBA) for PNG output, transparent at zero density
+RAMP = (
+    (0.0, (0, 0, 255, 0)),
+    (0.25, (0, 0, 255, 96)),
+    (0.5, (0, 255, 255, 144)),
+    (0.7, (0, 255, 0, 176)),
+    (0.85, (255, 255, 0, 208)),
+    (1.0, (255, 0, 0, 232)),
+)
+
+
+def kernel_radius_m(kernel: str, bandwidth_m: float) -> float:
+    """Distance beyond which the kernel is zero (truncated for the Gaussian)."""
+    if kernel == "gaussian":
+        return GAUSSIAN_TRUNCATE * bandwidth_m
+    return bandwidth_m
+
+
+def raster_window(bbox, cell_size_m: float, radius_m: float) -> Dict[str, int]:
+    """
+    Cells of the global lattice covering ``bbox`` ([min_lon, min_lat,
+    max_lon, max_lat]): cell (col0 + i, row0 + j) for i < n_cols, j < n_rows,
+    plus ``pad`` cells on every side so events within the kernel radius of
+    the bbox contribute.
+    """
+    (minx, maxx), (miny, maxy) = mercator_xy([bbox[0], bbox[2]], [bbox[1], bbox[3]])
+    col0, row0 = math.floor(minx / cell_size_m), math.floor(miny / cell_size_m)
+    col1, row1 = math.floor(maxx / cell_size_m), math.floor(maxy / cell_size_m)
+    return {
+        "col0": col0,
+        "row0": row0,
+        "n_cols": col1 - col0 + 1,
+        "n_rows": row1 - row0 + 1,
+        "pad": math.ceil(radius_m / cell_size_m),
+    }
+
+
+def padded_size(window: Dict[str, int]) -> int:
+    return (window["n_cols"] + 2 * window["pad"]) * (window["n_rows"] + 2 * window["pad"])
+
+
+def cell_range(window: Dict[str, int]) -> Tuple[int, int, int, int]:
+    """Inclusive (ix0, iy0, ix1, iy1) of the padded window."""
+    pad = window["pad"]
+    return (window["col0"] - pad, window["row0"] - pad,
+            window["col0"] + window["n_cols"] - 1 + pad, window["row0"] + window["n_rows"] - 1 + pad)
+
+
+def query_bbox(window: Dict[str, int], cell_size_m: float) -> list:
+    """Lon/lat bbox of the padded window, clamped to the world."""
+    ix0, iy0, ix1, iy1 = cell_range(window)
+    min_lon, min_lat = mercator_lonlat(ix0 * cell_size_m, iy0 * cell_size_m)
+    max_lon, max_lat = mercator_lonlat((ix1 + 1) * cell_size_m, (iy1 + 1) * cell_size_m)
+    return [max(min_lon, -180.0), max(min_lat, -MAX_MERCATOR_LAT),
+            min(max_lon, 180.0), min(max_lat, MAX_MERCATOR_LAT)]
+
+
+def window_bounds(window: Dict[str, int], cell_size_m: float) -> Dict[str, list]:
+    """Outer edges of the (unpadded) window in EPSG:3857 and lon/lat."""
+    minx, miny = window["col0"] * cell_size_m, window["row0"] * cell_size_m
+    maxx, maxy = minx + window["n_cols"] * cell_size_m, miny + window["n_rows"] * cell_size_m
+    return {
+        "bounds_3857": [minx, miny, maxx, maxy],
+        "bounds": list(mercator_lonlat(minx, miny)) + list(mercator_lonlat(maxx, maxy)),
+    }
+
+
+def quantize(density: np.ndarray) -> Tuple[np.ndarray, float]:
+    """uint16 codes and the scale with ``density ~= code * scale``."""
+    peak = float(density.max()) if density.size else 0.0
+    if peak <= 0:
+        return np.zeros(density.shape, dtype="<u2"), 0.0
+    scale = peak / 65535
+    return np.rint(density / scale).astype("<u2"), scale
+
+
+def colourize(codes: np.ndarray) -> np.ndarray:
+    """(rows, cols, 4) uint8 RGBA of uint16 codes through RAMP."""
+    positions = [p for p, _ in RAMP]
+    lut = np.stack([
+        np.interp(np.linspace(0, 1, 256), positions, [c[channel] for _, c in RAMP])
+        for channel in range(4)
+    ], axis=1).round().astype(np.uint8)
+    rgba = lut[(codes.astype(np.uint32) * 255 + 65534) // 65535]
+    rgba[codes == 0, 3] = 0
+    return rgba
+
+
+def _chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+
+def encode_png(rgba: np.ndarray) -> bytes:
+    """8-bit RGBA PNG of a (rows, cols, 4) uint8 array, rows top to bottom."""
+    height, width = rgba.shape[:2]
+    # Filter type 0 (none) per scanline; zlib does well on mostly empty rasters
+    scanlines = np.concatenate([np.zeros((height, 1), dtype=np.uint8), rgba.reshape(height, width * 4)], axis=1)
+    return (b"\x89PNG\r\n\x1a\n"
+            + _chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+            + _chunk(b"IDAT", zlib.compress(scanlines.tobytes(), 6))
+            + _chunk(b"IEND", b""))
+
+
+def encode_raster(density: np.ndarray, fmt: str) -> Dict[str, Any]:
+    """
+    Payload fields for a north-up density raster: ``data`` is the base64 of
+    a PNG (``fmt='png'``) or of the row-major little-endian uint16 codes
+    (``fmt='uint16'``); density ~= code * ``scale``.
+    """
+    codes, scale = quantize(density)
+    raw = encode_png(colourize(codes)) if fmt == "png" else codes.tobytes()
+    return {
+        "format": fmt,
+        "dtype": "<u2",
+        "scale": scale,
+        "max_value": float(density.max()) if density.size else 0.0,
+        "data": base64.b64encode(raw).decode("ascii"),
+    }
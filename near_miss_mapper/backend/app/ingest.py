@@ -0,0 +1,339 @@
+# Bulk event ingestion from NDJSON, CSV or GeoJSON FeatureCollections
+import asyncio
+import csv
+import io
+import json
+import math
+import os
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from pydantic import ValidationError
+from pymongo.errors import BulkWriteError
+
+from app.dedup import Deduplicator
+from app.models import NearMissEventCreate
+
+# Documents per insert_many call; the next chunk is validated while one is being written
+INGEST_CHUNK_SIZE = int(os.getenv("INGEST_CHUNK_SIZE", "5000"))
+# Per-row errors listed in the response (the failed count is always complete)
+INGEST_MAX_ERRORS = int(os.getenv("INGEST_MAX_ERRORS", "1000"))
+# CSV and GeoJSON bodies are read whole; NDJSON is parsed as it streams in
+INGEST_MAX_BYTES = int(os.getenv("INGEST_MAX_BYTES", str(512 * 1024 * 1024)))
+
+EVENT_FIELDS = ("description", "incident_type", "severity", "timestamp", "reported_by", "status")
+LON_COLUMNS = ("lon", "lng", "longitude", "x")
+LAT_COLUMNS = ("lat", "latitude", "y")
+
+# (input row index, raw event dict) or (input row index, parse error)
+Record = Tuple[int, Union[Dict[str, Any], Exception]]
+
+
+class IngestError(Exception):
+    """The request body as a whole cannot be ingested (unknown format, not a FeatureCollection, too large)."""
+
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def detect_format(content_type: Optional[str], explicit: Optional[str] = None) -> str:
+    if explicit:
+        return explicit
+    media = (content_type or "").split(";")[0].strip().lower()
+    if media in ("application/x-ndjson", "application/ndjson", "application/jsonl", "application/geo+json-seq"):
+        return "ndjson"
+    if media in ("text/csv", "application/csv"):
+        return "csv"
+    if media in ("application/geo+json", "application/json"):
+        return "geojson"
+    raise IngestError("Unknown body format; pass format=ndjson|csv|geojson or a matching Content-Type")
+
+
+def _with_additional_info(event: Dict[str, Any], extra: Dict[str, Any]) -> Dict[str, Any]:
+    info = event.get("additional_info")
+    if isinstance(info, str):
+        try:
+            info = json.loads(info)
+        except ValueError:
+            info = {"additional_info": info}
+    extra = dict(extra)
+    if isinstance(info, dict):
+        extra.update(info)
+    if extra:
+        event["additional_info"] = extra
+    return event
+
+
+def feature_to_event(feature: Dict[str, Any]) -> Dict[str, Any]:
+    """GeoJSON Point Feature -> event dict; unknown properties go to additional_info."""
+    geometry = feature.get("geometry") or {}
+    if geometry.get("type") != "Point":
+        raise ValueError("Feature geometry must be a Point")
+    properties = dict(feature.get("properties") or {})
+    event = {field: properties.pop(field) for field in EVENT_FIELDS if field in properties}
+    event["location"] = {"type": "Point", "coordinates": geometry.get("coordinates")}
+    if "additional_info" in properties:
+        event["additional_info"] = properties.pop("additional_info")
+    return _with_additional_info(event, properties)
+
+
+def csv_row_to_event(row: Dict[str, str]) -> Dict[str, Any]:
+    """CSV row with lon/lat columns -> event dict; empty cells are omitted, other columns go to additional_info."""
+    values = {k.strip(): v for k, v in row.items() if k is not None and v not in (None, "")}
+    # Known columns match case-insensitively; other columns keep their names
+    columns = {k.lower(): k for k in values}
+
+    def take(*names: str) -> Optional[str]:
+        found = [values.pop(columns[n]) for n in names if n in columns]
+        return found[0] if found else None
+
+    lon, lat = take(*LON_COLUMNS), take(*LAT_COLUMNS)
+    if lon is None or lat is None:
+        raise ValueError("Row needs lon and lat columns")
+    event = {field: take(field) for field in EVENT_FIELDS if field in columns}
+    event["location"] = {"type": "Point", "coordinates": [lon, lat]}
+    if "additional_info" in columns:
+        event["additional_info"] = take("additional_info")
+    return _with_additional_info(event, values)
+
+
+def _json_record(line: bytes) -> Dict[str, Any]:
+    obj = json.loads(line)
+    if not isinstance(obj, dict):
+        raise ValueError("Each line must be a JSON object")
+    # GeoJSON text sequences (one Feature per line) are accepted too
+    return feature_to_event(obj) if obj.get("type") == "Feature" else obj
+
+
+async def _ndjson_records(stream: AsyncIterator[bytes]) -> AsyncIterator[Record]:
+    row = 0
+    buffer = b""
+
+    def parse(line: bytes) -> Optional[Record]:
+        nonlocal row
+        if not line.strip():
+            return None
+        record: Record
+        try:
+            record = (row, _json_record(line))
+        except ValueError as e:
+            record = (row, e)
+        row += 1
+        return record
+
+    async for chunk in stream:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            record = parse(line)
+            if record is not None:
+                yield record
+    record = parse(buffer)
+    if record is not None:
+        yield record
+
+
+def _csv_records(body: bytes) -> Iterable[Record]:
+    try:
+        text = body.decode("utf-8-sig")
+    except UnicodeDecodeError as e:
+        raise IngestError(f"CSV body must be UTF-8: {e}")
+    for row, values in enumerate(csv.DictReader(io.StringIO(text, newline=""))):
+        try:
+            yield row, csv_row_to_event(values)
+        except ValueError as e:
+            yield row, e
+
+
+def _geojson_records(body: bytes) -> Iterable[Record]:
+    try:
+        collection = json.loads(body)
+    except ValueError as e:
+        raise IngestError(f"Invalid GeoJSON: {e}")
+    if not isinstance(collection, dict) or collection.get("type") != "FeatureCollection":
+        raise IngestError("GeoJSON body must be a FeatureCollection")
+    for row, feature in enumerate(collection.get("features") or []):
+        try:
+            if not isinstance(feature, dict):
+                raise ValueError("Feature must be an object")
+            yield row, feature_to_event(feature)
+        except ValueError as e:
+            yield row, e
+
+
+async def _read_all(stream: AsyncIterator[bytes]) -> bytes:
+    parts, size = [], 0
+    async for chunk in stream:
+        size += len(chunk)
+        if size > INGEST_MAX_BYTES:
+            raise IngestError(f"Body exceeds {INGEST_MAX_BYTES} bytes; send NDJSON to stream larger imports", 413)
+        parts.append(chunk)
+    return b"".join(parts)
+
+
+async def iter_records(fmt: str, stream: AsyncIterator[bytes]) -> AsyncIterator[Record]:
+    if fmt == "ndjson":
+        async for record in _ndjson_records(stream):
+            yield record
+        return
+    body = await _read_all(stream)
+    for record in (_csv_records(body) if fmt == "csv" else _geojson_records(body)):
+        yield record
+
+
+def _error_message(error: Exception) -> str:
+    if isinstance(error, ValidationError):
+        return "; ".join(
+            f"{'.'.join(str(p) for p in e['loc'])}: {e['msg']}" for e in error.errors()
+        )
+    return str(error) or error.__class__.__name__
+
+
+def validate_event(raw: Dict[str, Any]) -> Dict[str, Any]:
+    """Validated Mongo document for one raw event (any client id is dropped)."""
+    doc = NearMissEventCreate(**raw).dict()
+    if doc["location"]["type"] != "Point":
+        raise ValueError("location.type must be 'Point'")
+    # Checked here rather than left to the 2dsphere index, which rejects them per row anyway
+    coords = doc["location"]["coordinates"]
+    if (len(coords) != 2 or not all(math.isfinite(c) for c in coords)
+            or not (-180 <= coords[0] <= 180 and -90 <= coords[1] <= 90)):
+        raise ValueError("location.coordinates must be [lon, lat] within [-180, 180] x [-90, 90]")
+    return doc
+
+
+class IngestReport:
+    """Counts, created ids and (capped) per-row errors of one bulk ingestion."""
+
+    def __init__(self, return_ids: bool = True, max_errors: int = INGEST_MAX_ERRORS):
+        self.return_ids = return_ids
+        self.max_errors = max_errors
+        self.received = 0
+        self.inserted = 0
+        self.failed = 0
+        # Duplicates of earlier reports: inserted with duplicate_of, or merged and not inserted
+        self.linked = 0
+        self.merged = 0
+        self.ids: List[str] = []
+        self.errors: List[Dict[str, Any]] = []
+
+    def error(self, row: int, message: str) -> None:
+        self.failed += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({"row": row, "error": message})
+
+    def view(self) -> Dict[str, Any]:
+        out = {
+            "received": self.received,
+            "inserted": self.inserted,
+            "failed": self.failed,
+            "duplicates_linked": self.linked,
+            "duplicates_merged": self.merged,
+            "errors": sorted(self.errors, key=lambda e: e["row"]),
+            "errors_truncated": self.failed > len(self.errors),
+        }
+        if self.return_ids:
+            out["ids"] = self.ids
+        return out
+
+
+async def _insert_chunk(collection, rows: List[int], docs: List[Dict[str, Any]], report: IngestReport,
+                        on_inserted: Optional[Callable[[List[dict]], Awaitable[None]]],
+                        deduplicator: Optional[Deduplicator] = None,
+                        duplicates: Optional[Dict[Any, List[dict]]] = None) -> None:
+    failed: Dict[int, str] = {}
+    try:
+        # pymongo assigns each _id client-side, so created ids need no read-back
+        await collection.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        for write_error in e.details.get("writeErrors", []):
+            failed[write_error["index"]] = write_error.get("errmsg", "write error")
+    except Exception:
+        # Outcome unknown: none of the chunk may stay a duplicate primary.
+        # On cancellation the chunk may well be stored: keep it indexed
+        if deduplicator is not None:
+            await deduplicator.commit({}, docs)
+        raise
+    inserted = []
+    for i, (row, doc) in enumerate(zip(rows, docs)):
+        if i in failed:
+            report.error(row, failed[i])
+            continue
+        inserted.append(doc)
+        if report.return_ids:
+            report.ids.append(str(doc["_id"]))
+    report.inserted += len(inserted)
+    if deduplicator is not None:
+        await deduplicator.commit(duplicates or {}, [docs[i] for i in failed])
+    if inserted and on_inserted is not None:
+        await on_inserted(inserted)
+
+
+def validate_chunk(chunk: List[Record]) -> Tuple[List[int], List[Dict[str, Any]], List[Tuple[int, str]]]:
+    """(rows, documents) of the valid records plus (row, message) of the rest."""
+    rows, docs, errors = [], [], []
+    for row, raw in chunk:
+        if isinstance(raw, Exception):
+            errors.append((row, _error_message(raw)))
+            continue
+        try:
+            docs.append(validate_event(raw))
+            rows.append(row)
+        except (ValidationError, ValueError, TypeError) as e:
+            errors.append((row, _error_message(e)))
+    return rows, docs, errors
+
+
+async def ingest(collection, records: AsyncIterator[Record], return_ids: bool = True,
+                 chunk_size: int = INGEST_CHUNK_SIZE,
+                 on_inserted: Optional[Callable[[List[dict]], Awaitable[None]]] = None,
+                 deduplicator: Optional[Deduplicator] = None) -> Dict[str, Any]:
+    """
+    Validate records and write them with unordered insert_many in chunks of
+    ``chunk_size``; rows that fail to parse, validate or insert are reported
+    individually without stopping the import. Each chunk is validated in a
+    thread (keeping the event loop responsive) while the previous one is
+    written. ``on_inserted`` receives each chunk's inserted documents (e.g.
+    to update aggregates). With a ``deduplicator``, duplicates of earlier
+    reports (including earlier rows) are linked or merged.
+    """
+    report = IngestReport(return_ids=return_ids)
+    chunk: List[Record] = []
+    pending: Optional[asyncio.Task] = None
+
+    async def flush() -> None:
+        nonlocal pending, chunk
+        if not chunk:
+            return
+        rows, docs, errors = await asyncio.to_thread(validate_chunk, chunk)
+        chunk = []
+        for row, message in errors:
+            report.error(row, message)
+        if pending is not None:
+            await pending
+            pending = None
+        duplicates = None
+        if deduplicator is not None and docs:
+            keep, duplicates = deduplicator.resolve(docs)
+            rows, docs = [rows[i] for i in keep], [docs[i] for i in keep]
+            report.linked, report.merged = deduplicator.linked, deduplicator.merged
+        if docs:
+            pending = asyncio.create_task(
+                _insert_chunk(collection, rows, docs, report, on_inserted, deduplicator, duplicates))
+        elif duplicates:
+            # Every row merged: only the primaries change
+            pending = asyncio.create_task(deduplicator.commit(duplicates))
+
+    try:
+        async for record in records:
+            report.received += 1
+            chunk.append(record)
+            if len(chunk) >= chunk_size:
+                await flush()
+        await flush()
+        if pending is not None:
+            await pending
+    finally:
+        if pending is not None and not pending.done():
+            pending.cancel()
+    return report.view()
@@ -0,0 +1,201 @@
+# Background job queue for CPU-heavy analyses
+import asyncio
+import importlib
+import multiprocessing
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, Optional, Union
+
+from fastapi import HTTPException
+
+
+def call_target(target: str, *args: Any) -> Any:
+    """Import ``module:function`` and call it; runs inside pool workers."""
+    module, name = target.split(':')
+    return getattr(importlib.import_module(module), name)(*args)
+
+
+def warm_up(*modules: str) -> None:
+    """Import modules in a pool worker ahead of its first real task."""
+    for module in modules:
+        importlib.import_module(module)
+
+
+class JobQueueFull(Exception):
+    """Raised when the queue already holds the maximum number of unfinished jobs."""
+
+
+class JobManager:
+    """
+    Runs analysis jobs without blocking the event loop.
+
+    At most ``max_workers`` jobs run at once, each offloading its heavy part
+    to a process pool via ``run_in_pool``; at most ``max_pending`` jobs may be
+    queued or running before new submissions are rejected. The last
+    ``history`` finished jobs are kept for status/result lookups.
+    """
+
+    def __init__(self, max_workers: int = 1, max_pending: int = 8, history: int = 100):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.history = history
+        self._jobs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._inflight: Dict[str, Dict[str, Any]] = {}
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn: never fork the web worker with its Mongo client and event loop
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+        return self._executor
+
+    def pending(self) -> int:
+        return sum(1 for job in self._jobs.values() if job['status'] in ('queued', 'running'))
+
+    def submit(self, kind: str, work: Callable[[Dict[str, Any]], Awaitable[Any]],
+               key: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Queue ``work(job)`` and return the job record immediately. Jobs with
+        the same ``key`` share one unfinished run instead of queueing twice.
+        """
+        if key is not None and key in self._inflight:
+            return self._inflight[key]
+        if self.pending() >= self.max_pending:
+            raise JobQueueFull(f"Analysis queue is full ({self.max_pending} jobs pending)")
+        job = self._new_job(kind, key)
+        if key is not None:
+            self._inflight[key] = job
+        job['task'] = asyncio.create_task(self._execute(job, work))
+        return job
+
+    def completed(self, kind: str, result: Any, key: Optional[str] = None) -> Dict[str, Any]:
+        """Record a job whose result is already known (e.g. a cache hit)."""
+        job = self._new_job(kind, key)
+        job.update(status='done', stage='done', progress=1.0,
+                   started_at=job['created_at'], finished_at=job['created_at'], result=result)
+        job['task'] = asyncio.get_running_loop().create_future()
+        job['task'].set_result(None)
+        return job
+
+    def _new_job(self, kind: str, key: Optional[str]) -> Dict[str, Any]:
+        job = {
+            'id': uuid.uuid4().hex,
+            'kind': kind,
+            'key': key,
+            'status': 'queued',
+            'stage': 'queued',
+            'progress': 0.0,
+            'created_at': datetime.utcnow(),
+            'started_at': None,
+            'finished_at': None,
+            'error': None,
+            'error_status': None,
+            'result': None,
+        }
+        self._jobs[job['id']] = job
+        self._trim()
+        return job
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return self._jobs.get(job_id)
+
+    async def wait(self, job: Dict[str, Any]) -> Any:
+        """Wait for a job and return its result, re-raising failures as HTTP errors."""
+        await asyncio.shield(job['task'])
+        if job['status'] == 'failed':
+            raise HTTPException(status_code=job['error_status'] or 500, detail=job['error'])
+        return job['result']
+
+    async def run_in_pool(self, fn: Union[str, Callable[..., Any]], *args: Any) -> Any:
+        """
+        Run ``fn(*args)`` in the process pool. ``fn`` may be a
+        ``'module:function'`` string, imported only in the worker, so the
+        web process never loads heavy analysis modules.
+
+        A worker dying (e.g. killed for memory) breaks the whole pool: the
+        call fails and the pool is replaced so later jobs run normally.
+        """
+        loop = asyncio.get_running_loop()
+        executor = self.executor
+        try:
+            if isinstance(fn, str):
+                return await loop.run_in_executor(executor, call_target, fn, *args)
+            return await loop.run_in_executor(executor, fn, *args)
+        except BrokenProcessPool:
+            self._discard(executor)
+            raise
+
+    def _discard(self, executor: ProcessPoolExecutor) -> None:
+        # Calls that shared the broken pool fail too; only the first replaces it
+        if self._executor is executor:
+            self._executor = None
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    async def warm_up(self, *modules: str) -> None:
+        """Start every pool worker and import ``modules`` in it."""
+        loop = asyncio.get_running_loop()
+        executor = self.executor
+        try:
+            await asyncio.gather(*(
+                loop.run_in_executor(executor, warm_up, *modules) for _ in range(self.max_workers)
+            ))
+        except BrokenProcessPool:
+            self._discard(executor)
+            raise
+
+    async def _execute(self, job: Dict[str, Any], work: Callable[[Dict[str, Any]], Awaitable[Any]]) -> None:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_workers)
+        async with self._slots:
+            job['status'] = 'running'
+            job['stage'] = 'running'
+            job['started_at'] = datetime.utcnow()
+            try:
+                job['result'] = await work(job)
+                job['status'] = 'done'
+                job['stage'] = 'done'
+                job['progress'] = 1.0
+            except HTTPException as e:
+                job['status'] = 'failed'
+                job['error'] = e.detail
+                job['error_status'] = e.status_code
+            except Exception as e:
+                job['status'] = 'failed'
+                job['error'] = str(e) or e.__class__.__name__
+            finally:
+                job['finished_at'] = datetime.utcnow()
+                if job['key'] is not None:
+                    self._inflight.pop(job['key'], None)
+
+    def _trim(self) -> None:
+        finished = [job_id for job_id, job in self._jobs.items() if job['status'] in ('done', 'failed')]
+        for job_id in finished[:max(0, len(finished) - self.history)]:
+            del self._jobs[job_id]
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+def job_view(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Public status fields of a job (no task handle or result payload)."""
+    return {
+        'job_id': job['id'],
+        'kind': job['kind'],
+        'status': job['status'],
+        'stage': job['stage'],
+        'progress': job['progress'],
+        'created_at': job['created_at'],
+        'started_at': job['started_at'],
+        'finished_at': job['finished_at'],
+        'error': job['error'],
+    }
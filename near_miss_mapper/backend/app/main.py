@@ -1,22 +1,31 @@
-from fastapi import FastAPI, HTTPException, Depends
+import time
+_IMPORT_STARTED = time.perf_counter()
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, EmailStr
-from typing import List, Optional, Literal
-from datetime import datetime, timedelta
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import StreamingResponse
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from pydantic import BaseModel, EmailStr, Field
+from typing import Dict, List, Optional, Literal
+from datetime import datetime
+import asyncio
+import base64
+import json
 import motor.motor_asyncio
 from bson import ObjectId
 import os
 from dotenv import load_dotenv
-from passlib.context import CryptContext
 import jwt
-import pandas as pd
-import numpy as np
-from esda.moran import Moran
-from app.spatial.gi_star import (
-    events_to_grid,
-    gi_star as gi_star_compute,
-    save_as_shapefile,
-)
+from pymongo.errors import DuplicateKeyError, WriteError
+from app import aggregates, auth, clusters, dedup, heatmap, ingest, metrics, nearby, tiles
+from app.cache import ResultCache, cache_key, cleanup_outputs
+from app.db import (bbox_boxes, build_event_query, collection_fingerprint, create_indexes, load_event_coordinates,
+                    load_event_points, load_event_weights)
+from app.models import EventQueryParams
+from app.jobs import JobManager, JobQueueFull, job_view
+# The spatial stack (pandas, geopandas, esda, ...) is never imported here:
+# analyses run by name in pool workers, which import it on first use
+ANALYSIS_MODULE = "app.spatial.analysis"
 
 # Load environment variables
 load_dotenv()
@@ -36,7 +45,51 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Truncated", "ETag", "X-Raster-Bounds", "X-Raster-Scale", "X-Raster-Max"],
+)
+# Compress larger responses (inline Gi* cells, event pages) for clients sending Accept-Encoding: gzip
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+# Prometheus metrics for this process (scraped from /metrics)
+metrics_registry = metrics.Registry()
+http_request_seconds = metrics_registry.histogram(
+    "http_request_duration_seconds", "Latency of /api/events requests, including the streamed body",
+    ["method", "route", "status"],
+)
+analysis_stage_seconds = metrics_registry.histogram(
+    "analysis_stage_duration_seconds", "Time spent per analysis stage",
+    ["kind", "stage"], buckets=metrics.STAGE_BUCKETS,
+)
+analysis_stage_peak_bytes = metrics_registry.gauge(
+    "analysis_stage_peak_bytes", "tracemalloc peak of the last traced run of each analysis stage",
+    ["kind", "stage"],
 )
+analysis_results = metrics_registry.counter(
+    "analysis_results_total", "Analysis results served, computed or from the result cache",
+    ["kind", "source"],
+)
+
+@app.middleware("http")
+async def record_events_latency(request: Request, call_next):
+    if not request.url.path.startswith("/api/events"):
+        return await call_next(request)
+    start = time.perf_counter()
+    response = await call_next(request)
+    body = response.body_iterator
+
+    async def timed_body():
+        # Observe once the body is sent so NDJSON streams count in full
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            route = request.scope.get("route")
+            http_request_seconds.observe(
+                time.perf_counter() - start, method=request.method,
+                route=getattr(route, "path", "unmatched"), status=response.status_code,
+            )
+    response.body_iterator = timed_body()
+    return response
 
 # MongoDB setup
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
@@ -47,9 +100,9 @@ db = client[DB_NAME]
 # Ensure indexes on startup
 @app.on_event("startup")
 async def ensure_indexes():
-    # Create 2dsphere index for location-based queries
+    # 2dsphere index for location-based queries plus filter indexes
     try:
-        await db.events.create_index([("location", "2dsphere")])
+        await create_indexes(db.events)
     except Exception as e:
         # Log or ignore; app can still function for non-geo endpoints
         print(f"Index creation warning: {e}")
@@ -59,6 +112,121 @@ async def ensure_indexes():
         await db.credentials.create_index("role")
     except Exception as e:
         print(f"Credentials index warning: {e}")
+    # Per-cell aggregates; backfilled and reconciled in the background
+    if aggregates.AGGREGATES_ENABLED:
+        try:
+            await aggregates.create_aggregate_indexes(db.grid_aggregates)
+        except Exception as e:
+            print(f"Aggregates setup warning: {e}")
+        asyncio.create_task(_maintain_aggregates())
+
+# How often each worker checks whether the aggregates need a rebuild; the
+# rebuild lease makes sure only one process runs it
+AGGREGATES_CHECK_INTERVAL_S = float(os.getenv("AGGREGATES_CHECK_INTERVAL_S", "60"))
+
+async def _maintain_aggregates():
+    while True:
+        try:
+            if await aggregates.needs_rebuild(db.grid_aggregates):
+                n = await aggregates.rebuild(db.grid_aggregates, db.events)
+                if n is not None:
+                    print(f"Grid aggregates rebuilt from {n} events")
+        except Exception as e:
+            print(f"Aggregates rebuild warning: {e}")
+        await asyncio.sleep(AGGREGATES_CHECK_INTERVAL_S)
+
+# Nearby queries are served from an in-memory index of event locations,
+# built in the background at startup and updated with every write. Each
+# worker process holds its own copy, so writes made by other workers (or
+# straight to the database) are caught by a periodic fingerprint check
+# that rebuilds the index; queries fall back to $geoNear meanwhile
+NEARBY_INDEX_CHECK_INTERVAL_S = float(os.getenv("NEARBY_INDEX_CHECK_INTERVAL_S", "30"))
+# A fingerprint mismatch is confirmed after this long, so that this
+# worker's own writes in flight do not trigger a rebuild
+NEARBY_INDEX_CHECK_GRACE_S = 2.0
+event_index = nearby.EventIndex()
+metrics_registry.gauge("nearby_index_events", "Events in the in-memory nearby index",
+                       function=lambda: len(event_index))
+
+@app.on_event("startup")
+async def build_event_index():
+    if nearby.NEARBY_INDEX_ENABLED:
+        asyncio.create_task(_maintain_event_index())
+
+async def _build_event_index():
+    try:
+        start = time.perf_counter()
+        n = await event_index.build(db.events)
+        print(f"Nearby index built from {n} events in {time.perf_counter() - start:.2f}s")
+    except Exception as e:
+        # Nearby queries fall back to Mongo $geoNear
+        print(f"Nearby index build warning: {e}")
+
+async def _maintain_event_index():
+    await _build_event_index()
+    while True:
+        await asyncio.sleep(NEARBY_INDEX_CHECK_INTERVAL_S)
+        try:
+            if event_index.ready and await event_index.is_stale(db.events):
+                await asyncio.sleep(NEARBY_INDEX_CHECK_GRACE_S)
+                if not await event_index.is_stale(db.events):
+                    continue
+                print("Events were written outside this worker; rebuilding the in-memory indexes")
+                await _build_event_index()
+                if dedup.DEDUP_MODE != "off":
+                    await _build_duplicate_index()
+            elif not event_index.ready:
+                await _build_event_index()
+        except Exception as e:
+            print(f"Nearby index check warning: {e}")
+
+# Duplicate reports of one incident are detected on insert against an
+# in-memory spatio-temporal index of recent primary reports. It is per
+# process too and is rebuilt along with the nearby index when that finds
+# outside writes; with NEARBY_INDEX_ENABLED off nothing checks it, so run a
+# single worker or reports from other workers are not deduplicated
+duplicate_index = dedup.DuplicateIndex()
+metrics_registry.gauge("dedup_index_events", "Primary reports in the duplicate detection index",
+                       function=lambda: len(duplicate_index))
+
+@app.on_event("startup")
+async def build_duplicate_index():
+    if dedup.DEDUP_MODE != "off":
+        asyncio.create_task(_build_duplicate_index())
+
+async def _build_duplicate_index():
+    try:
+        n = await duplicate_index.build(db.events)
+        print(f"Duplicate index built from {n} recent reports")
+    except Exception as e:
+        # Reports are inserted without deduplication until it is built
+        print(f"Duplicate index build warning: {e}")
+
+def _deduplicator(mode: Optional[str]) -> dedup.Deduplicator:
+    return dedup.Deduplicator(duplicate_index, db.events, mode or dedup.DEDUP_MODE)
+
+def _index_events(added: Optional[List[dict]] = None, removed: Optional[List[str]] = None):
+    if nearby.NEARBY_INDEX_ENABLED:
+        event_index.remove(removed or [])
+        event_index.add(added or [])
+
+async def _on_events_inserted(events: List[dict]):
+    _index_events(added=events)
+    await _update_aggregates(events, 1)
+
+async def _update_aggregates(events: List[dict], sign: int):
+    # Aggregates are derived data: never fail the write path because of them
+    if not aggregates.AGGREGATES_ENABLED:
+        return
+    try:
+        await aggregates.apply_live(db.grid_aggregates, events, sign)
+    except Exception as e:
+        print(f"Aggregates update warning: {e}")
+        # Serve raw events until the maintenance rebuild has reconciled them
+        try:
+            await aggregates.mark_stale(db.grid_aggregates)
+        except Exception as e:
+            print(f"Aggregates stale marking warning: {e}")
 
 # Helper to serialize MongoDB document to API model-friendly dict
 def serialize_event(doc: dict) -> dict:
@@ -68,29 +236,29 @@ def serialize_event(doc: dict) -> dict:
     _id = out.pop("_id", None)
     if _id is not None:
         out["id"] = str(_id)
+    if out.get("duplicate_of") is not None:
+        out["duplicate_of"] = str(out["duplicate_of"])
     return out
 
-# Auth setup
-# Use pbkdf2_sha256 to avoid external bcrypt backend issues on Windows
-pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
-JWT_SECRET = os.getenv("JWT_SECRET", "dev_secret_change_me")
-JWT_ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
-ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "60"))
-
-def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
-
-def verify_password(password: str, hashed: str) -> bool:
-    return pwd_context.verify(password, hashed)
-
-def create_access_token(subject: str, role: str) -> str:
-    to_encode = {
-        "sub": subject,
-        "role": role,
-        "iat": datetime.utcnow(),
-        "exp": datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES),
-    }
-    return jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGORITHM)
+# Auth setup: password hashing off the event loop, verified tokens cached
+password_hasher = auth.PasswordHasher()
+token_cache = auth.TokenCache()
+bearer_scheme = HTTPBearer(auto_error=False)
+metrics_registry.gauge("password_hash_pending", "Password hashes queued or running",
+                       function=password_hasher.pending)
+
+@app.on_event("shutdown")
+async def shutdown_password_hasher():
+    password_hasher.shutdown()
+
+async def get_current_user(credentials: Optional[HTTPAuthorizationCredentials] = Depends(bearer_scheme)) -> dict:
+    # Dependency for protected endpoints: claims of a valid bearer token
+    if credentials is None:
+        raise HTTPException(status_code=401, detail="Not authenticated", headers={"WWW-Authenticate": "Bearer"})
+    try:
+        return auth.decode_access_token(credentials.credentials, token_cache)
+    except jwt.InvalidTokenError:
+        raise HTTPException(status_code=401, detail="Invalid or expired token", headers={"WWW-Authenticate": "Bearer"})
 
 # Auth models
 class UserCreate(BaseModel):
@@ -124,10 +292,13 @@ class NearMissEvent(BaseModel):
     description: str
     incident_type: str
     severity: str
-    timestamp: datetime = datetime.utcnow()
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
     reported_by: str
     status: str = "reported"
     additional_info: Optional[dict] = {}
+    # Set by ingest-time deduplication (see app.dedup), never by clients
+    duplicate_of: Optional[str] = None
+    duplicates: int = 0
 
 # API Endpoints
 @app.get("/")
@@ -135,7 +306,82 @@ async def root():
     return {"message": "Welcome to Urban Near Miss Mapper API"}
 
 # ----- Spatial Statistics: Getis-Ord Gi* -----
-class GiStarRequest(BaseModel):
+# Worker processes for Gi* permutation inference (-1 = all CPUs)
+GI_STAR_N_JOBS = int(os.getenv("GI_STAR_N_JOBS", "1"))
+# Concurrent analyses and how many may be queued before new ones get 429
+ANALYSIS_MAX_WORKERS = int(os.getenv("ANALYSIS_MAX_WORKERS", "1"))
+ANALYSIS_MAX_PENDING = int(os.getenv("ANALYSIS_MAX_PENDING", "8"))
+ANALYSIS_JOB_HISTORY = int(os.getenv("ANALYSIS_JOB_HISTORY", "100"))
+ANALYSIS_OUT_DIR = os.getenv(
+    "ANALYSIS_OUT_DIR",
+    os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data', 'outputs')),
+)
+# In-memory result cache bounds; entries are also kept on disk under ANALYSIS_OUT_DIR/cache
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "128"))
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Retention for ANALYSIS_OUT_DIR (outputs, cached results, weights), checked periodically
+OUTPUT_RETENTION_HOURS = float(os.getenv("OUTPUT_RETENTION_HOURS", "168"))
+OUTPUT_MAX_BYTES = int(os.getenv("OUTPUT_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+OUTPUT_CLEANUP_INTERVAL_S = float(os.getenv("OUTPUT_CLEANUP_INTERVAL_S", "3600"))
+# Start the analysis pool and import the spatial stack in it at startup, so
+# the first analysis does not pay for it (web-only workers leave this off)
+ANALYSIS_PREWARM = os.getenv("ANALYSIS_PREWARM", "false").lower() in ("1", "true", "yes")
+
+analysis_jobs = JobManager(
+    max_workers=ANALYSIS_MAX_WORKERS,
+    max_pending=ANALYSIS_MAX_PENDING,
+    history=ANALYSIS_JOB_HISTORY,
+)
+metrics_registry.gauge("analysis_jobs_pending", "Analysis jobs queued or running",
+                       function=analysis_jobs.pending)
+
+result_cache = ResultCache(
+    os.path.join(ANALYSIS_OUT_DIR, 'cache'),
+    max_entries=RESULT_CACHE_MAX_ENTRIES,
+    max_bytes=RESULT_CACHE_MAX_BYTES,
+)
+
+# Vector tiles: the latest Gi* grid plus an LRU of encoded tiles keyed by ETag
+gi_star_layer = tiles.GridLayer(ANALYSIS_OUT_DIR)
+tile_cache = tiles.TileCache()
+
+async def _cleanup_outputs_periodically():
+    while True:
+        try:
+            removed = await asyncio.to_thread(
+                cleanup_outputs, ANALYSIS_OUT_DIR, OUTPUT_RETENTION_HOURS * 3600, OUTPUT_MAX_BYTES,
+            )
+            if removed:
+                print(f"Output cleanup removed {removed} files")
+        except Exception as e:
+            print(f"Output cleanup warning: {e}")
+        await asyncio.sleep(OUTPUT_CLEANUP_INTERVAL_S)
+
+@app.on_event("startup")
+async def start_output_cleanup():
+    if OUTPUT_CLEANUP_INTERVAL_S > 0:
+        asyncio.create_task(_cleanup_outputs_periodically())
+
+async def _prewarm_analysis_pool():
+    try:
+        start = time.perf_counter()
+        await analysis_jobs.warm_up(ANALYSIS_MODULE)
+        print(f"Analysis pool warmed up in {time.perf_counter() - start:.2f}s")
+    except Exception as e:
+        print(f"Analysis pool warm-up warning: {e}")
+
+@app.on_event("startup")
+async def prewarm_analysis_pool():
+    if ANALYSIS_PREWARM:
+        asyncio.create_task(_prewarm_analysis_pool())
+
+@app.on_event("shutdown")
+async def shutdown_analysis_jobs():
+    analysis_jobs.shutdown()
+
+class GiStarRequest(EventQueryParams):
+    # Event filters (incident_type, severity, status, start_date, end_date, bbox)
+    # are inherited from EventQueryParams and pushed down into the Mongo query
     neighborhood_method: Literal['queen', 'rook', 'knn', 'distance_band'] = 'queen'
     k: int = 8
     distance_band_m: Optional[float] = None
@@ -144,102 +390,331 @@ class GiStarRequest(BaseModel):
     use_centroids: bool = False
     cell_size_m: float = 250.0
     buffer_m: float = 0.0
+    seed: Optional[int] = None  # fix for reproducible permutation p-values
+    # Files written per analysis: GeoParquet, Arrow IPC (memory-mappable) and/or shapefile
+    output_formats: List[Literal['parquet', 'arrow', 'shapefile']] = ['parquet']
+    # Return significant cells inline as grid (col, row) plus z/p arrays,
+    # base64 typed buffers or plain JSON lists (see compact_cells)
+    inline_cells: Optional[Literal['base64', 'json']] = None
+    # Read pre-aggregated cell counts when the cell size and filters allow it;
+    # both paths grid on the same global lattice, so results match
+    use_aggregates: bool = True
+    # Per-stage seconds (loading, gridding, weights, gi_star, fdr, moran, writers)
+    # in a `timings` block; trace_memory adds tracemalloc peaks but slows the run
+    timings: bool = False
+    trace_memory: bool = False
 
-@app.post("/api/spatial/gi_star")
-async def compute_gi_star(req: GiStarRequest):
-    # 1) Load events from Mongo
-    events = []
-    async for doc in db.events.find():
-        try:
-            coords = doc.get('location', {}).get('coordinates', None)
-            if coords and isinstance(coords, list) and len(coords) == 2:
-                events.append({
-                    'lon': float(coords[0]),
-                    'lat': float(coords[1])
-                })
-        except Exception:
-            continue
+class GiStarPyramidRequest(GiStarRequest):
+    # Levels computed in one job; every size must be a whole multiple of the
+    # smallest, which is binned once and summed into the others (cell_size_m is unused)
+    cell_sizes: List[float] = [50.0, 100.0, 250.0, 500.0, 1000.0]
+
+async def _load_analysis_data(job: dict, req: GiStarRequest, query: dict, cell_size_m: float):
+    """Return (data, from_cells): aggregated (ix, iy, counts) or event (lon, lat) arrays."""
+    params = req.dict()
+    if (req.use_aggregates and aggregates.AGGREGATES_ENABLED
+            and aggregates.supports(cell_size_m, params)
+            and await aggregates.is_ready(db.grid_aggregates)):
+        # 1a) Pre-aggregated per-cell counts: O(non-empty cells) instead of O(events)
+        job['stage'] = 'loading_aggregates'
+        job['progress'] = 0.1
+        return await aggregates.load_cell_counts(db.grid_aggregates, cell_size_m, params,
+                                                 events_collection=db.events), True
+    # 1b) Load event coordinates from Mongo
+    job['stage'] = 'loading_events'
+    job['progress'] = 0.1
+    return await load_event_coordinates(db.events, query), False
 
-    if not events:
+def _finish_timings(kind: str, req: EventQueryParams, result: dict, load_seconds: float, from_cells: bool) -> dict:
+    # Workers always time their stages; feed the metrics, then keep the
+    # `timings` blocks only when the request asked for them
+    parts = [result] + list((result.get('levels') or {}).values())
+    load_stage = 'load_aggregates' if from_cells else 'load_events'
+    timings = result.setdefault('timings', {'stages': {}, 'total_seconds': 0.0})
+    timings['stages'] = dict({load_stage: {'seconds': round(load_seconds, 6)}}, **timings['stages'])
+    timings['total_seconds'] = round(timings['total_seconds'] + load_seconds, 6)
+    for part in parts:
+        if part.get('timings'):
+            metrics.observe_timings(analysis_stage_seconds, analysis_stage_peak_bytes, kind, part['timings'])
+        if not getattr(req, 'timings', False):
+            part.pop('timings', None)
+    analysis_results.inc(kind=kind, source='computed')
+    return result
+
+async def _gi_star_work(job: dict, req: GiStarRequest, query: dict, key: str) -> dict:
+    start = time.perf_counter()
+    data, from_cells = await _load_analysis_data(job, req, query, req.cell_size_m)
+    load_seconds = time.perf_counter() - start
+    if len(data[0]) == 0:
         raise HTTPException(status_code=400, detail="No events found to compute Gi*.")
 
-    events_df = pd.DataFrame(events)
-
-    # 2) Aggregate events to a grid (counts per cell)
-    grid_gdf = events_to_grid(events_df, lon_field='lon', lat_field='lat', cell_size_m=req.cell_size_m, buffer_m=req.buffer_m)
-
-    # 3) Compute Gi* on counts
-    gi_gdf = gi_star_compute(
-        grid_gdf,
-        value_field='count',
-        neighborhood_method=req.neighborhood_method,
-        k=req.k,
-        distance_band_m=req.distance_band_m,
-        permutations=req.permutations,
-        fdr=req.fdr,
-        use_centroids=req.use_centroids,
-    )
+    # 2) Grid, Gi*, Moran's I and output files in an analysis worker process
+    job['stage'] = 'computing'
+    job['progress'] = 0.3
+    run = f"{ANALYSIS_MODULE}:{'run_gi_star_on_cells' if from_cells else 'run_gi_star_analysis'}"
+    result = await analysis_jobs.run_in_pool(run, *data, req.dict(), ANALYSIS_OUT_DIR, GI_STAR_N_JOBS,
+                                             f"gi_star_{key[:16]}")
+    result = _finish_timings('gi_star', req, result, load_seconds, from_cells)
+    result_cache.put(key, result)
+    gi_star_layer.set_latest(result.get('outputs') or {})
+    return dict(result, cached=False)
 
-    # 4) Global spatial autocorrelation (Moran's I) on counts for context
+async def _gi_star_pyramid_work(job: dict, req: GiStarPyramidRequest, query: dict, key: str) -> dict:
+    # One data pass at the finest level; coarser levels are summed in the worker
+    start = time.perf_counter()
+    data, from_cells = await _load_analysis_data(job, req, query, min(req.cell_sizes))
+    load_seconds = time.perf_counter() - start
+    if len(data[0]) == 0:
+        raise HTTPException(status_code=400, detail="No events found to compute Gi*.")
+
+    job['stage'] = 'computing'
+    job['progress'] = 0.3
+    run = f"{ANALYSIS_MODULE}:{'run_gi_star_pyramid_on_cells' if from_cells else 'run_gi_star_pyramid_analysis'}"
+    result = await analysis_jobs.run_in_pool(run, *data, req.dict(), ANALYSIS_OUT_DIR, GI_STAR_N_JOBS,
+                                             f"gi_star_pyramid_{key[:16]}")
+    result = _finish_timings('gi_star_pyramid', req, result, load_seconds, from_cells)
+    result_cache.put(key, result)
+    return dict(result, cached=False)
+
+async def _submit_analysis(kind: str, req: EventQueryParams, work) -> dict:
     try:
-        # Build weights consistent with chosen method for comparability
-        # For simplicity, use queen on the grid for Moran's I
-        w_gdf = gi_gdf.copy()
-        w_gdf = w_gdf.set_geometry('geometry')
-        # Use libpysal Queen via GeoDataFrame directly
-        from libpysal.weights import Queen
-        w = Queen.from_dataframe(w_gdf)
-        w.transform = 'R'
-        mi = Moran(gi_gdf['count'].to_numpy(dtype=float), w, two_tailed=True, permutations=req.permutations)
-        moran_i = float(mi.I)
-        moran_p = float(mi.p_sim)
-        moran_z = float(mi.z_sim)
-    except Exception as e:
-        moran_i = None
-        moran_p = None
-        moran_z = None
-
-    # 5) Save shapefile output
-    out_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data', 'outputs'))
-    timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
-    shp_path = save_as_shapefile(gi_gdf, out_dir, f"gi_star_{timestamp}")
-
-    # 6) Build summary
-    z = gi_gdf['z_score'].to_numpy()
-    p = gi_gdf['p_value'].to_numpy()
-    sig = gi_gdf['significance'].astype(str)
-
-    summary = {
-        'n_units': int(len(gi_gdf)),
-        'hot_counts': {
-            'hot_99': int((sig == 'hot_99').sum()),
-            'hot_95': int((sig == 'hot_95').sum()),
-            'hot_90': int((sig == 'hot_90').sum()),
-        },
-        'cold_counts': {
-            'cold_99': int((sig == 'cold_99').sum()),
-            'cold_95': int((sig == 'cold_95').sum()),
-            'cold_90': int((sig == 'cold_90').sum()),
-        },
-        'fdr_significant_total': int(gi_gdf['fdr_significant'].sum()),
-        'z_stats': {
-            'min': float(np.nanmin(z)),
-            'mean': float(np.nanmean(z)),
-            'max': float(np.nanmax(z)),
-            'std': float(np.nanstd(z)),
-        },
-        'moran': {
-            'I': moran_i,
-            'z': moran_z,
-            'p_value': moran_p,
-        }
-    }
+        query = build_event_query(req.dict())
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    # Same parameters on the same data version reuse the earlier result
+    key = cache_key(kind, req.dict(), await collection_fingerprint(db.events))
+    cached = result_cache.get(key)
+    if cached is not None:
+        gi_star_layer.set_latest(cached.get('outputs') or {})
+        analysis_results.inc(kind=kind, source='cache')
+        return analysis_jobs.completed(kind, dict(cached, cached=True), key=key)
+    try:
+        return analysis_jobs.submit(kind, lambda job: work(job, req, query, key), key=key)
+    except JobQueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e))
 
-    return {
-        'status': 'ok',
-        'shapefile_path': shp_path,
-        'summary': summary,
-    }
+async def _submit_gi_star(req: GiStarRequest) -> dict:
+    return await _submit_analysis('gi_star', req, _gi_star_work)
+
+async def _submit_gi_star_pyramid(req: GiStarPyramidRequest) -> dict:
+    sizes = req.cell_sizes
+    if not sizes or min(sizes) <= 0:
+        raise HTTPException(status_code=422, detail="cell_sizes must be positive")
+    base = min(sizes)
+    if any(abs(s / base - round(s / base)) > 1e-9 for s in sizes):
+        raise HTTPException(status_code=422, detail="cell_sizes must be whole multiples of the smallest size")
+    return await _submit_analysis('gi_star_pyramid', req, _gi_star_pyramid_work)
+
+class EmergingHotspotRequest(EventQueryParams):
+    # Space-time Gi* over (cell x time slice) with a Mann-Kendall trend per cell;
+    # slices end at end_date (or the latest event)
+    neighborhood_method: Literal['queen', 'rook'] = 'queen'
+    cell_size_m: float = 250.0
+    time_step_days: float = 7.0
+    time_window: int = 1  # previous slices in each unit's neighbourhood
+    fdr: bool = True
+    output_formats: List[Literal['parquet', 'arrow', 'shapefile']] = ['parquet']
+
+async def _emerging_work(job: dict, req: EmergingHotspotRequest, query: dict, key: str) -> dict:
+    job['stage'] = 'loading_events'
+    job['progress'] = 0.1
+    start = time.perf_counter()
+    data = await load_event_points(db.events, query)
+    load_seconds = time.perf_counter() - start
+    if len(data[0]) == 0:
+        raise HTTPException(status_code=400, detail="No events found to compute emerging hot spots.")
+
+    job['stage'] = 'computing'
+    job['progress'] = 0.3
+    try:
+        result = await analysis_jobs.run_in_pool(f"{ANALYSIS_MODULE}:run_emerging_hotspot_analysis", *data, req.dict(),
+                                                 ANALYSIS_OUT_DIR, GI_STAR_N_JOBS, f"emerging_{key[:16]}")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    result = _finish_timings('emerging_hotspots', req, result, load_seconds, False)
+    result_cache.put(key, result)
+    return dict(result, cached=False)
+
+async def _submit_emerging(req: EmergingHotspotRequest) -> dict:
+    if req.cell_size_m <= 0 or req.time_step_days <= 0 or req.time_window < 0:
+        raise HTTPException(status_code=422, detail="cell_size_m and time_step_days must be positive, time_window >= 0")
+    return await _submit_analysis('emerging_hotspots', req, _emerging_work)
+
+class KdeRequest(EventQueryParams):
+    # Kernel density raster over bbox (required) on the global lattice;
+    # sizes are Web Mercator metres as for Gi* grids
+    cell_size_m: float = 50.0
+    kernel: Literal['gaussian', 'quartic'] = 'gaussian'
+    bandwidth_m: float = 200.0  # Gaussian sigma (truncated at 3 sigma) or quartic radius
+    # Weight each event by its severity instead of counting it once;
+    # severities missing from severity_weights weigh 1
+    weight_by_severity: bool = False
+    severity_weights: Dict[str, float] = {k: float(v) for k, v in clusters.SEVERITY_RANKS.items()}
+    # png: colour-ramped RGBA overlay; uint16: base64 little-endian codes
+    # (value = code * scale), row-major from the north-west corner
+    format: Literal['png', 'uint16'] = 'png'
+    # Read pre-aggregated cell counts when the cell size and filters allow it
+    use_aggregates: bool = True
+    timings: bool = False
+
+async def _kde_work(job: dict, req: KdeRequest, query: dict, key: str) -> dict:
+    params = req.dict()
+    window = heatmap.raster_window(req.bbox, req.cell_size_m, heatmap.kernel_radius_m(req.kernel, req.bandwidth_m))
+    start = time.perf_counter()
+    from_cells = (req.use_aggregates and not req.weight_by_severity and aggregates.AGGREGATES_ENABLED
+                  and aggregates.supports(req.cell_size_m, dict(params, bbox=None))
+                  and await aggregates.is_ready(db.grid_aggregates))
+    job['progress'] = 0.1
+    if from_cells:
+        # Cell counts of the bbox plus the kernel margin: O(cells), not O(events)
+        job['stage'] = 'loading_aggregates'
+        data = await aggregates.load_cell_counts(db.grid_aggregates, req.cell_size_m, params,
+                                                 cell_range=heatmap.cell_range(window), events_collection=db.events)
+    else:
+        # Events within the kernel radius of the bbox contribute too
+        job['stage'] = 'loading_events'
+        query = build_event_query(dict(params, bbox=heatmap.query_bbox(window, req.cell_size_m)))
+        if req.weight_by_severity:
+            data = await load_event_weights(db.events, query, "severity", req.severity_weights)
+        else:
+            data = await load_event_coordinates(db.events, query) + (None,)
+    load_seconds = time.perf_counter() - start
+
+    job['stage'] = 'computing'
+    job['progress'] = 0.3
+    run = f"{ANALYSIS_MODULE}:{'run_kde_on_cells' if from_cells else 'run_kde_analysis'}"
+    result = await analysis_jobs.run_in_pool(run, *data, params)
+    result = _finish_timings('kde', req, result, load_seconds, from_cells)
+    result_cache.put(key, result)
+    return dict(result, cached=False)
+
+async def _submit_kde(req: KdeRequest) -> dict:
+    if not req.bbox:
+        raise HTTPException(status_code=422, detail="bbox is required")
+    if req.cell_size_m <= 0 or req.bandwidth_m <= 0:
+        raise HTTPException(status_code=422, detail="cell_size_m and bandwidth_m must be positive")
+    try:
+        build_event_query(req.dict())
+        boxes = bbox_boxes(req.bbox)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    # One raster window: normalise the bbox, which must not cross the antimeridian
+    if len(boxes) > 1:
+        raise HTTPException(status_code=422, detail="bbox must not cross the antimeridian")
+    req.bbox = list(boxes[0])
+    window = heatmap.raster_window(req.bbox, req.cell_size_m, heatmap.kernel_radius_m(req.kernel, req.bandwidth_m))
+    if heatmap.padded_size(window) > heatmap.KDE_MAX_CELLS:
+        raise HTTPException(status_code=400, detail=(
+            f"Raster of {heatmap.padded_size(window)} cells (with kernel margin) exceeds {heatmap.KDE_MAX_CELLS}; "
+            "use a larger cell_size_m, a smaller bandwidth_m or a smaller bbox"))
+    return await _submit_analysis('kde', req, _kde_work)
+
+@app.post("/api/spatial/gi_star")
+async def compute_gi_star(req: GiStarRequest):
+    # Synchronous variant: same queue and worker pool, waits for the result
+    job = await _submit_gi_star(req)
+    return await analysis_jobs.wait(job)
+
+@app.post("/api/spatial/gi_star/jobs", status_code=202)
+async def submit_gi_star_job(req: GiStarRequest):
+    return job_view(await _submit_gi_star(req))
+
+@app.post("/api/spatial/gi_star/pyramid")
+async def compute_gi_star_pyramid(req: GiStarPyramidRequest):
+    job = await _submit_gi_star_pyramid(req)
+    return await analysis_jobs.wait(job)
+
+@app.post("/api/spatial/gi_star/pyramid/jobs", status_code=202)
+async def submit_gi_star_pyramid_job(req: GiStarPyramidRequest):
+    return job_view(await _submit_gi_star_pyramid(req))
+
+@app.post("/api/spatial/emerging_hotspots")
+async def compute_emerging_hotspots(req: EmergingHotspotRequest):
+    job = await _submit_emerging(req)
+    return await analysis_jobs.wait(job)
+
+@app.post("/api/spatial/emerging_hotspots/jobs", status_code=202)
+async def submit_emerging_hotspots_job(req: EmergingHotspotRequest):
+    return job_view(await _submit_emerging(req))
+
+@app.post("/api/spatial/kde")
+async def compute_kde(req: KdeRequest):
+    # PNG rasters come back as the image itself, placed by the X-Raster-Bounds
+    # header ([min_lon, min_lat, max_lon, max_lat]); uint16 rasters as JSON
+    job = await _submit_kde(req)
+    result = await analysis_jobs.wait(job)
+    if req.format != 'png':
+        return result
+    return Response(content=base64.b64decode(result['data']), media_type="image/png", headers={
+        "X-Raster-Bounds": ",".join(f"{v:.8f}" for v in result['bounds']),
+        "X-Raster-Scale": repr(result['scale']),
+        "X-Raster-Max": repr(result['max_value']),
+    })
+
+@app.post("/api/spatial/kde/jobs", status_code=202)
+async def submit_kde_job(req: KdeRequest):
+    return job_view(await _submit_kde(req))
+
+@app.get("/api/spatial/jobs/{job_id}")
+async def get_analysis_job(job_id: str):
+    job = analysis_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_view(job)
+
+@app.get("/api/spatial/jobs/{job_id}/result")
+async def get_analysis_job_result(job_id: str, level: Optional[float] = None):
+    job = analysis_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job['status'] == 'failed':
+        raise HTTPException(status_code=job['error_status'] or 500, detail=job['error'])
+    if job['status'] != 'done':
+        raise HTTPException(status_code=409, detail=f"Job is {job['status']}")
+    if level is None:
+        return job['result']
+    # Single level of a pyramid result, by cell size in metres
+    levels = job['result'].get('levels') or {}
+    if f"{level:g}" not in levels:
+        raise HTTPException(status_code=404, detail=f"No level {level:g} in this result")
+    return levels[f"{level:g}"]
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    # Per-process: with several uvicorn/gunicorn workers each one is scraped separately
+    return Response(content=metrics_registry.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/tiles/{layer}/{z}/{x}/{y}.pbf")
+async def get_tile(layer: Literal['events', 'gi_star'], z: int, x: int, y: int, request: Request):
+    if not tiles.valid_tile(z, x, y):
+        raise HTTPException(status_code=404, detail="Tile out of range")
+    if layer == 'events':
+        fingerprint = await collection_fingerprint(db.events)
+        version = f"{fingerprint['count']}:{fingerprint['max_id']}"
+    else:
+        version = gi_star_layer.version()
+        if version is None:
+            raise HTTPException(status_code=404, detail="No Gi* result available")
+    etag = tiles.tile_etag(layer, z, x, y, version)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if tiles.etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    data = tile_cache.get(etag)
+    if data is None:
+        if layer == 'events':
+            # Low-zoom tiles are summed from the aggregates once they are built
+            use_aggregates = (z < tiles.AGGREGATE_TILE_MAX_ZOOM and aggregates.AGGREGATES_ENABLED
+                              and await aggregates.is_ready(db.grid_aggregates))
+            data = await tiles.render_events_tile(db.events, z, x, y,
+                                                  db.grid_aggregates if use_aggregates else None)
+        else:
+            cells = await gi_star_layer.cells(lambda path: analysis_jobs.run_in_pool(tiles.load_grid_cells, path))
+            if cells is None:
+                raise HTTPException(status_code=404, detail="No Gi* result available")
+            data = tiles.render_grid_tile(cells, z, x, y)
+        tile_cache.put(etag, data)
+    return Response(content=data, media_type=tiles.CONTENT_TYPE, headers=headers)
 
 # Auth endpoints
 @app.post("/auth/signup", response_model=UserOut)
@@ -248,67 +723,299 @@ async def signup(user: UserCreate):
     existing = await db.credentials.find_one({"email_or_phone": user.email_or_phone})
     if existing:
         raise HTTPException(status_code=400, detail="User already exists")
+    try:
+        password_hash = await password_hasher.hash(user.password)
+    except auth.HasherBusy as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
     user_doc = {
         "email_or_phone": user.email_or_phone,
-        "password_hash": hash_password(user.password),
+        "password_hash": password_hash,
         "role": user.role if user.role in ("admin", "user") else "user",
         "created_at": datetime.utcnow(),
     }
-    res = await db.credentials.insert_one(user_doc)
-    created = await db.credentials.find_one({"_id": res.inserted_id})
+    try:
+        # insert_one sets user_doc["_id"]; no read-back needed
+        await db.credentials.insert_one(user_doc)
+    except DuplicateKeyError:
+        # Lost a race with a concurrent signup for the same account
+        raise HTTPException(status_code=400, detail="User already exists")
     return UserOut(
-        id=str(created["_id"]),
-        email_or_phone=created["email_or_phone"],
-        role=created["role"],
-        created_at=created["created_at"],
+        id=str(user_doc["_id"]),
+        email_or_phone=user_doc["email_or_phone"],
+        role=user_doc["role"],
+        created_at=user_doc["created_at"],
     )
 
 @app.post("/auth/login", response_model=TokenResponse)
 async def login(payload: LoginInput):
     user = await db.credentials.find_one({"email_or_phone": payload.email_or_phone})
-    if not user or not verify_password(payload.password, user.get("password_hash", "")):
+    if not user:
         raise HTTPException(status_code=401, detail="Invalid credentials")
-    token = create_access_token(str(user["_id"]), user.get("role", "user"))
+    try:
+        valid, new_hash = await password_hasher.verify_and_update(payload.password, user.get("password_hash", ""))
+    except auth.HasherBusy as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    if not valid:
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+    if new_hash is not None:
+        # Stored hash predates the current PASSWORD_HASH_ROUNDS
+        await db.credentials.update_one({"_id": user["_id"]}, {"$set": {"password_hash": new_hash}})
+    token = auth.create_access_token(str(user["_id"]), user.get("role", "user"))
     return TokenResponse(access_token=token, role=user.get("role", "user"))
 
+@app.get("/auth/me")
+async def read_current_user(claims: dict = Depends(get_current_user)):
+    return {
+        "id": claims["sub"],
+        "role": claims.get("role", "user"),
+        "expires_at": datetime.utcfromtimestamp(claims["exp"]),
+    }
+
 @app.post("/api/events/", response_model=NearMissEvent)
-async def create_event(event: NearMissEvent):
-    event_dict = event.dict()
-    if "id" in event_dict:
-        del event_dict["id"]
-    
-    result = await db.events.insert_one(event_dict)
-    created_event = await db.events.find_one({"_id": result.inserted_id})
-    return serialize_event(created_event)
+async def create_event(event: NearMissEvent, response: Response,
+                       dedup_mode: Optional[Literal['off', 'link', 'merge']] = None):
+    # A report close in space and time to an earlier one of the same type is
+    # linked to it (stored with duplicate_of) or merged into it (not stored;
+    # the earlier report is returned), per dedup_mode or DEDUP_MODE
+    event_dict = event.dict(exclude={"id", "duplicate_of", "duplicates"})
+    deduplicator = _deduplicator(dedup_mode)
+    keep, duplicates = deduplicator.resolve([event_dict])
+    if not keep:
+        primary_id = next(iter(duplicates))
+        await deduplicator.commit(duplicates)
+        response.headers["X-Duplicate-Of"] = str(primary_id)
+        primary = await db.events.find_one({"_id": primary_id})
+        if primary is None:
+            raise HTTPException(status_code=409, detail="Duplicate of a report that no longer exists")
+        return serialize_event(primary)
 
-@app.get("/api/events/", response_model=List[NearMissEvent])
-async def list_events():
-    events = []
-    async for event in db.events.find():
-        events.append(NearMissEvent(**serialize_event(event)))
-    return events
-
-@app.get("/api/events/nearby", response_model=List[NearMissEvent])
-async def get_nearby_events(lng: float, lat: float, radius_km: int = 5):
-    # Perform a geospatial query using a 2dsphere index on location
-    max_distance_m = max(0, int(radius_km)) * 1000
+    # insert_one keeps event_dict["_id"]; the stored document needs no read-back
     try:
-        cursor = db.events.find({
-            "location": {
-                "$near": {
-                    "$geometry": {"type": "Point", "coordinates": [lng, lat]},
-                    "$maxDistance": max_distance_m
-                }
-            }
-        })
-        results: List[NearMissEvent] = []
-        async for doc in cursor:
-            results.append(NearMissEvent(**serialize_event(doc)))
-        return results
+        await db.events.insert_one(event_dict)
     except Exception as e:
-        # If index is missing or query fails, fall back to empty list
-        print(f"Geo query failed: {e}")
-        return []
+        # Not stored: take it out of the duplicate index again, or later
+        # reports nearby would be linked to a document that does not exist.
+        # A cancelled request may still have inserted it, so that keeps it
+        await deduplicator.commit(duplicates, failed=[event_dict])
+        if isinstance(e, WriteError):
+            raise HTTPException(status_code=400, detail=e.details.get("errmsg", str(e)))
+        raise
+    await deduplicator.commit(duplicates)
+    await _on_events_inserted([event_dict])
+    if event_dict.get("duplicate_of") is not None:
+        response.headers["X-Duplicate-Of"] = str(event_dict["duplicate_of"])
+    return serialize_event(event_dict)
+
+@app.post("/api/events/bulk")
+async def bulk_create_events(
+    request: Request,
+    format: Optional[Literal['ndjson', 'csv', 'geojson']] = None,
+    return_ids: bool = True,
+    dedup_mode: Optional[Literal['off', 'link', 'merge']] = None,
+):
+    # Body is NDJSON (one event or GeoJSON Feature per line, streamed), CSV
+    # with lon/lat columns, or a GeoJSON FeatureCollection of Points; the
+    # format comes from `format` or the Content-Type. Rows are validated and
+    # inserted in unordered chunks; failures are reported per input row
+    try:
+        fmt = ingest.detect_format(request.headers.get("content-type"), format)
+        records = ingest.iter_records(fmt, request.stream())
+        return await ingest.ingest(
+            db.events, records, return_ids=return_ids,
+            on_inserted=_on_events_inserted, deduplicator=_deduplicator(dedup_mode),
+        )
+    except ingest.IngestError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+
+# Listing bounds: JSON pages are validated per item, NDJSON streams are not
+EVENTS_PAGE_DEFAULT_LIMIT = int(os.getenv("EVENTS_PAGE_DEFAULT_LIMIT", "100"))
+EVENTS_PAGE_MAX_LIMIT = int(os.getenv("EVENTS_PAGE_MAX_LIMIT", "1000"))
+EVENTS_STREAM_MAX_LIMIT = int(os.getenv("EVENTS_STREAM_MAX_LIMIT", "100000"))
+EVENTS_STREAM_BATCH_SIZE = 1000
+
+def _parse_bbox(bbox: Optional[str]) -> Optional[List[float]]:
+    # "min_lon,min_lat,max_lon,max_lat" query string -> list for build_event_query
+    if not bbox:
+        return None
+    try:
+        return [float(v) for v in bbox.split(",")]
+    except ValueError:
+        raise HTTPException(status_code=422, detail="bbox must be min_lon,min_lat,max_lon,max_lat")
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+async def _ndjson_lines(cursor):
+    # Serialize raw documents straight off the cursor, one line per event
+    async for doc in cursor:
+        yield json.dumps(serialize_event(doc), default=_json_default) + "\n"
+
+@app.get("/api/events/", response_model=List[NearMissEvent])
+async def list_events(
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1),
+    after: Optional[str] = None,
+    format: Literal['json', 'ndjson'] = 'json',
+    incident_type: Optional[str] = None,
+    severity: Optional[str] = None,
+    status: Optional[str] = None,
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    bbox: Optional[str] = None,
+):
+    # Keyset pagination on _id (ObjectIds increase with insertion time): pass
+    # the X-Next-Cursor header (or the last streamed id) back as `after`
+    filters = EventQueryParams(
+        incident_type=incident_type, severity=severity, status=status,
+        start_date=start_date, end_date=end_date, bbox=_parse_bbox(bbox),
+    )
+    try:
+        query = build_event_query(filters.dict())
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if after:
+        try:
+            query["_id"] = {"$gt": ObjectId(after)}
+        except Exception:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    if format == 'ndjson':
+        limit = min(limit or EVENTS_STREAM_MAX_LIMIT, EVENTS_STREAM_MAX_LIMIT)
+        cursor = db.events.find(query, sort=[("_id", 1)], limit=limit, batch_size=EVENTS_STREAM_BATCH_SIZE)
+        return StreamingResponse(_ndjson_lines(cursor), media_type="application/x-ndjson")
+
+    limit = min(limit or EVENTS_PAGE_DEFAULT_LIMIT, EVENTS_PAGE_MAX_LIMIT)
+    docs = await db.events.find(query, sort=[("_id", 1)], limit=limit).to_list(length=limit)
+    if len(docs) == limit:
+        response.headers["X-Next-Cursor"] = str(docs[-1]["_id"])
+    return [serialize_event(doc) for doc in docs]
+
+@app.get("/api/events/clusters")
+async def get_event_clusters(
+    bbox: str,
+    zoom: int = Query(..., ge=0, le=24),
+    incident_type: Optional[str] = None,
+    severity: Optional[str] = None,
+    status: Optional[str] = None,
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+):
+    # Viewport rendering: clustered counts with max severity per cluster,
+    # individual events only once zoomed in past CLUSTER_MAX_ZOOM
+    filters = EventQueryParams(
+        incident_type=incident_type, severity=severity, status=status,
+        start_date=start_date, end_date=end_date, bbox=_parse_bbox(bbox),
+    )
+    try:
+        query = build_event_query(filters.dict())
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if zoom >= clusters.CLUSTER_MAX_ZOOM:
+        result = await clusters.load_viewport_events(db.events, query, zoom)
+        result["events"] = [NearMissEvent(**serialize_event(doc)) for doc in result["events"]]
+        return result
+    return await clusters.load_clusters(db.events, query, zoom)
+
+# Nearby bounds: results per query point and points per batch
+NEARBY_DEFAULT_LIMIT = int(os.getenv("NEARBY_DEFAULT_LIMIT", "1000"))
+NEARBY_MAX_LIMIT = int(os.getenv("NEARBY_MAX_LIMIT", "10000"))
+NEARBY_BATCH_MAX_POINTS = int(os.getenv("NEARBY_BATCH_MAX_POINTS", "1000"))
+
+async def _nearby(lng: float, lat: float, radius_m: Optional[float], k: Optional[int], limit: Optional[int],
+                  filters: dict, query: dict):
+    # (ids, distances in metres, truncated) nearest first, from the index
+    # once it is built; one extra result is fetched to tell whether the
+    # limit cut the answer short (a k smaller than the limit does not count)
+    limit = min(limit or NEARBY_DEFAULT_LIMIT, NEARBY_MAX_LIMIT)
+    fetch = min(k, limit) if k is not None and k <= limit else limit + 1
+    if event_index.ready:
+        ids, distances = event_index.query(lng, lat, radius_m=radius_m, k=k, limit=fetch, filters=filters)
+    else:
+        try:
+            ids, distances = await nearby.geo_near(db.events, lng, lat, query, radius_m=radius_m, limit=fetch)
+        except Exception as e:
+            raise HTTPException(status_code=503, detail=f"Nearby query failed: {e}")
+    return ids[:limit], distances[:limit], len(ids) > limit
+
+async def _load_events_by_id(ids: List[str]) -> dict:
+    docs = await db.events.find({"_id": {"$in": [ObjectId(i) for i in ids]}}).to_list(length=None)
+    return {str(doc["_id"]): serialize_event(doc) for doc in docs}
+
+def _nearby_filters(filters: EventQueryParams) -> tuple:
+    params = filters.dict()
+    try:
+        return params, build_event_query(params)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+@app.get("/api/events/nearby")
+async def get_nearby_events(
+    response: Response,
+    lng: float = Query(..., ge=-180, le=180),
+    lat: float = Query(..., ge=-90, le=90),
+    radius_m: Optional[float] = Query(None, gt=0),
+    radius_km: Optional[float] = Query(None, gt=0),
+    k: Optional[int] = Query(None, ge=1),
+    limit: Optional[int] = Query(None, ge=1),
+    incident_type: Optional[str] = None,
+    severity: Optional[str] = None,
+    status: Optional[str] = None,
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+):
+    # Events within radius_m (or radius_km; 5 km by default), or the k
+    # nearest (within the radius if one is given), nearest first with
+    # their great-circle distance in `distance_m`. At most `limit` events
+    # (NEARBY_DEFAULT_LIMIT by default) are returned; the X-Truncated
+    # header is set when there were more
+    if radius_m is None and radius_km is not None:
+        radius_m = radius_km * 1000
+    if radius_m is None and k is None:
+        radius_m = 5000.0
+    params, query = _nearby_filters(EventQueryParams(
+        incident_type=incident_type, severity=severity, status=status,
+        start_date=start_date, end_date=end_date,
+    ))
+    ids, distances, truncated = await _nearby(lng, lat, radius_m, k, limit, params, query)
+    if truncated:
+        response.headers["X-Truncated"] = "true"
+    events = await _load_events_by_id(ids)
+    return [dict(events[i], distance_m=d) for i, d in zip(ids, distances) if i in events]
+
+class NearbyBatchRequest(EventQueryParams):
+    # Query points as [lng, lat] (e.g. samples along a route), each answered
+    # like /api/events/nearby (`truncated` per result instead of the
+    # header); radius_m, k or both must be given
+    points: List[List[float]]
+    radius_m: Optional[float] = None
+    k: Optional[int] = None
+    limit: Optional[int] = None  # per point
+    # Event documents, once each, keyed by id (ids and distances only when false)
+    include_events: bool = True
+
+@app.post("/api/events/nearby/batch")
+async def get_nearby_events_batch(req: NearbyBatchRequest):
+    if len(req.points) > NEARBY_BATCH_MAX_POINTS:
+        raise HTTPException(status_code=422, detail=f"At most {NEARBY_BATCH_MAX_POINTS} points per batch")
+    if req.radius_m is None and req.k is None:
+        raise HTTPException(status_code=422, detail="radius_m or k is required")
+    if (req.radius_m is not None and req.radius_m <= 0) or (req.k is not None and req.k < 1):
+        raise HTTPException(status_code=422, detail="radius_m must be positive and k at least 1")
+    if any(len(p) != 2 or not (-180 <= p[0] <= 180 and -90 <= p[1] <= 90) for p in req.points):
+        raise HTTPException(status_code=422, detail="points must be [lng, lat] pairs")
+    params, query = _nearby_filters(req)
+    results = []
+    for lng, lat in req.points:
+        ids, distances, truncated = await _nearby(lng, lat, req.radius_m, req.k, req.limit, params, query)
+        results.append({"ids": ids, "distances_m": distances, "truncated": truncated})
+    out = {"results": results}
+    if req.include_events:
+        out["events"] = await _load_events_by_id(list(dict.fromkeys(i for r in results for i in r["ids"])))
+    return out
 
 @app.delete("/api/events/{event_id}")
 async def delete_event(event_id: str):
@@ -316,11 +1023,41 @@ async def delete_event(event_id: str):
         oid = ObjectId(event_id)
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid event id")
-    res = await db.events.delete_one({"_id": oid})
-    if res.deleted_count == 0:
+    deleted = await db.events.find_one_and_delete(
+        {"_id": oid},
+        projection={"location": 1, "timestamp": 1, "incident_type": 1, "duplicate_of": 1, "duplicates": 1},
+    )
+    if deleted is None:
         raise HTTPException(status_code=404, detail="Event not found")
+    _index_events(removed=[event_id])
+    duplicate_index.remove([event_id])
+    # The earliest linked duplicate takes over as the incident's primary report
+    successor = await dedup.promote(db.events, deleted)
+    if successor is not None:
+        duplicate_index.add([successor])
+        _index_events(removed=[str(successor["_id"])], added=[successor])
+    await _update_aggregates([deleted], -1)
     return {"status": "deleted", "id": event_id}
 
+# Cold-start cost of this worker: module import time here, time to the end of
+# the startup hooks (index creation included) below, RSS at scrape time
+APP_IMPORT_SECONDS = time.perf_counter() - _IMPORT_STARTED
+app_startup_seconds = metrics_registry.gauge(
+    "app_startup_seconds", "Seconds from importing app.main to the end of its startup hooks",
+)
+metrics_registry.gauge("app_import_seconds", "Seconds spent importing app.main",
+                       function=lambda: APP_IMPORT_SECONDS)
+metrics_registry.gauge("process_resident_memory_bytes", "Resident memory of this web worker",
+                       function=metrics.resident_memory_bytes)
+
+@app.on_event("startup")
+async def record_startup_time():
+    # Registered last, so it runs after the other startup hooks
+    seconds = time.perf_counter() - _IMPORT_STARTED
+    app_startup_seconds.set(seconds)
+    print(f"Startup: import {APP_IMPORT_SECONDS:.2f}s, ready after {seconds:.2f}s, "
+          f"RSS {metrics.resident_memory_bytes() / 2 ** 20:.0f} MB")
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
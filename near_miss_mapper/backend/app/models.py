@@ -23,7 +23,7 @@ class NearMissEventBase(MongoModel):
     description: str
     incident_type: str
     severity: str
-    timestamp: datetime = datetime.utcnow()
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
     reported_by: str
     status: str = "reported"
     additional_info: Optional[dict] = {}
@@ -51,3 +51,6 @@ class EventQueryParams(MongoModel):
     status: Optional[str] = None
     start_date: Optional[datetime] = None
     end_date: Optional[datetime] = None
+    bbox: Optional[List[float]] = None  # [min_lon, min_lat, max_lon, max_lat]
+    # Count each incident once: skip reports linked to an earlier one (duplicate_of)
+    deduplicated: bool = False
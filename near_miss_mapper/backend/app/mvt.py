@@ -0,0 +1,109 @@
+# Minimal Mapbox Vector Tile (v2.1) encoder for point and rectangle layers
+import struct
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+POINT = 1
+POLYGON = 3
+
+_MOVE_TO = 1
+_LINE_TO = 2
+_CLOSE_PATH = 7
+
+# (geometry type, command integers, properties, optional feature id)
+Feature = Tuple[int, List[int], Dict[str, Any], Optional[int]]
+
+
+def _varint(n: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _zigzag(n: int) -> int:
+    return (n << 1) ^ (n >> 63)
+
+
+def _tag(field: int, wire_type: int) -> bytes:
+    return _varint((field << 3) | wire_type)
+
+
+def _message(field: int, payload: bytes) -> bytes:
+    return _tag(field, 2) + _varint(len(payload)) + payload
+
+
+def _packed(field: int, values: Iterable[int]) -> bytes:
+    return _message(field, b"".join(_varint(v) for v in values))
+
+
+def _command(command: int, count: int) -> int:
+    return (command & 0x7) | (count << 3)
+
+
+def point(x: int, y: int) -> List[int]:
+    """Geometry commands for a single point in tile coordinates."""
+    return [_command(_MOVE_TO, 1), _zigzag(x), _zigzag(y)]
+
+
+def rectangle(x0: int, y0: int, x1: int, y1: int) -> List[int]:
+    """
+    Geometry commands for an axis-aligned rectangle with x0 < x1 and y0 < y1
+    (y down), wound so the ring is an exterior ring.
+    """
+    w, h = x1 - x0, y1 - y0
+    return [
+        _command(_MOVE_TO, 1), _zigzag(x0), _zigzag(y0),
+        _command(_LINE_TO, 3), _zigzag(w), 0, 0, _zigzag(h), _zigzag(-w), 0,
+        _command(_CLOSE_PATH, 1),
+    ]
+
+
+def _value(value: Any) -> bytes:
+    if isinstance(value, bool):
+        return _tag(7, 0) + _varint(int(value))
+    if isinstance(value, int):
+        if value >= 0:
+            return _tag(5, 0) + _varint(value)
+        return _tag(6, 0) + _varint(_zigzag(value))
+    if isinstance(value, float):
+        return _tag(3, 1) + struct.pack("<d", value)
+    return _message(1, str(value).encode("utf-8"))
+
+
+def encode_layer(name: str, features: Iterable[Feature], extent: int = 4096) -> bytes:
+    """Encode one layer; keys and values are deduplicated across features."""
+    keys: Dict[str, int] = {}
+    values: Dict[Tuple[type, Any], int] = {}
+    body = bytearray(_message(1, name.encode("utf-8")))
+    for geom_type, geometry, properties, feature_id in features:
+        tags: List[int] = []
+        for key, value in properties.items():
+            if value is None:
+                continue
+            tags.append(keys.setdefault(key, len(keys)))
+            tags.append(values.setdefault((type(value), value), len(values)))
+        feature = bytearray()
+        if feature_id is not None:
+            feature += _tag(1, 0) + _varint(feature_id)
+        if tags:
+            feature += _packed(2, tags)
+        feature += _tag(3, 0) + _varint(geom_type)
+        feature += _packed(4, geometry)
+        body += _message(2, bytes(feature))
+    for key in keys:
+        body += _message(3, key.encode("utf-8"))
+    for (_, value) in values:
+        body += _message(4, _value(value))
+    body += _tag(5, 0) + _varint(extent)
+    body += _tag(15, 0) + _varint(2)
+    return bytes(body)
+
+
+def encode_tile(layers: Iterable[bytes]) -> bytes:
+    """Concatenate encoded layers into a tile."""
+    return b"".join(_message(3, layer) for layer in layers)
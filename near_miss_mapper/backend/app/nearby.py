@@ -0,0 +1,359 @@
+# In-memory spatial index of event locations for radius and k-nearest
+# queries, kept in sync with event writes. numpy only, so it lives in the
+# web process: events are bucketed by cell of the global Web Mercator
+# lattice, candidates come from the cells around a query point and
+# distances are exact great-circle metres (same sphere as Mongo $geoNear).
+import math
+import os
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from app.geo import EARTH_RADIUS_M, MAX_MERCATOR_LAT, mercator_xy
+from app.db import bbox_boxes, collection_fingerprint
+
+NEARBY_INDEX_ENABLED = os.getenv("NEARBY_INDEX_ENABLED", "true").lower() in ("1", "true", "yes")
+# Bucket size in Web Mercator metres; roughly the typical query radius works well
+NEARBY_INDEX_CELL_M = float(os.getenv("NEARBY_INDEX_CELL_M", "500"))
+NEARBY_INDEX_BATCH_SIZE = int(os.getenv("NEARBY_INDEX_BATCH_SIZE", "50000"))
+# Queries spanning more cell rows than this scan every event instead
+NEARBY_INDEX_MAX_ROWS = 2048
+# Inserts are buffered unsorted and merged into the sorted base once the
+# buffer exceeds this many rows (or an eighth of the base)
+NEARBY_INDEX_DELTA_ROWS = 4096
+
+FILTER_FIELDS = ("incident_type", "severity", "status")
+COLUMNS = ("id", "lon", "lat", "time", "duplicate") + FILTER_FIELDS
+
+_OFFSET = 1 << 30
+_STRIDE = 1 << 31
+_WORLD_HALF_M = math.pi * EARTH_RADIUS_M
+
+
+def _epoch(value: Any) -> float:
+    # Naive timestamps are taken as UTC, as in the analysis loaders
+    if not isinstance(value, datetime):
+        return math.nan
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def haversine_m(lon: float, lat: float, lons: np.ndarray, lats: np.ndarray) -> np.ndarray:
+    """Great-circle distances in metres from (lon, lat) to each point."""
+    lon1, lat1 = math.radians(lon), math.radians(lat)
+    lon2, lat2 = np.radians(lons), np.radians(lats)
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def _row(doc: dict) -> Optional[tuple]:
+    coords = (doc.get("location") or {}).get("coordinates")
+    try:
+        lon, lat = float(coords[0]), float(coords[1])
+    except (TypeError, ValueError, IndexError, KeyError):
+        return None
+    if not (math.isfinite(lon) and math.isfinite(lat)):
+        return None
+    return ((str(doc["_id"]), lon, lat, _epoch(doc.get("timestamp")), doc.get("duplicate_of") is not None)
+            + tuple(doc.get(f) for f in FILTER_FIELDS))
+
+
+def _columns(rows: List[tuple]) -> Dict[str, np.ndarray]:
+    values = list(zip(*rows)) if rows else [()] * len(COLUMNS)
+    cols = {}
+    for name, column in zip(COLUMNS, values):
+        dtype = float if name in ("lon", "lat", "time") else bool if name == "duplicate" else object
+        cols[name] = np.asarray(column, dtype=dtype) if column else np.empty(0, dtype=dtype)
+    return cols
+
+
+def _take(cols: Dict[str, np.ndarray], idx) -> Dict[str, np.ndarray]:
+    return {name: column[idx] for name, column in cols.items()}
+
+
+def _concat(parts: List[Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+    return {name: np.concatenate([p[name] for p in parts]) for name in parts[0]}
+
+
+def _filter_mask(cols: Dict[str, np.ndarray], filters: Dict[str, Any]) -> np.ndarray:
+    """Same semantics as build_event_query for the indexed fields."""
+    mask = np.ones(len(cols["id"]), dtype=bool)
+    for field in FILTER_FIELDS:
+        if filters.get(field):
+            mask &= cols[field] == filters[field]
+    # NaN (no timestamp) fails both comparisons, like a Mongo range on a missing field
+    if filters.get("start_date"):
+        mask &= cols["time"] >= _epoch(filters["start_date"])
+    if filters.get("end_date"):
+        mask &= cols["time"] <= _epoch(filters["end_date"])
+    if filters.get("deduplicated"):
+        mask &= ~cols["duplicate"]
+    bbox = filters.get("bbox")
+    if bbox:
+        inside = np.zeros(len(mask), dtype=bool)
+        for min_lon, min_lat, max_lon, max_lat in bbox_boxes(bbox):
+            inside |= ((cols["lon"] >= min_lon) & (cols["lon"] <= max_lon)
+                       & (cols["lat"] >= min_lat) & (cols["lat"] <= max_lat))
+        mask &= inside
+    return mask
+
+
+class EventIndex:
+    """
+    Event locations and filter fields as columns, the base sorted by cell
+    key so the cells around a query are a few contiguous ranges. New events
+    go to an unsorted delta that is merged in once it grows; deletes only
+    flag rows. Writes made while ``build`` runs are replayed after it.
+
+    Only writes passed to ``add`` and ``remove`` are seen, so writes from
+    other processes leave the index stale; ``is_stale`` detects them by
+    comparing the collection fingerprint with the one the index expects.
+    """
+
+    def __init__(self, cell_size_m: float = NEARBY_INDEX_CELL_M):
+        self.cell_size_m = cell_size_m
+        self.ready = False
+        self._journal: Optional[List[Tuple[int, Any]]] = None
+        self._before: Optional[str] = None
+        # Ids of events without usable coordinates, still counted in the fingerprint
+        self._unindexed: set = set()
+        self._count_offset = 0
+        self._set_base(_columns([]))
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _keys(self, lon: np.ndarray, lat: np.ndarray) -> np.ndarray:
+        x, y = mercator_xy(lon, lat)
+        ix = np.floor(x / self.cell_size_m).astype(np.int64)
+        iy = np.floor(y / self.cell_size_m).astype(np.int64)
+        return (iy + _OFFSET) * _STRIDE + (ix + _OFFSET)
+
+    def _set_base(self, cols: Dict[str, np.ndarray]) -> None:
+        keys = self._keys(cols["lon"], cols["lat"])
+        order = np.argsort(keys, kind="stable")
+        self._base = _take(cols, order)
+        self._base_keys = keys[order]
+        self._base_alive = np.ones(len(keys), dtype=bool)
+        self._where: Dict[str, Tuple[bool, int]] = {i: (True, pos) for pos, i in enumerate(self._base["id"])}
+        self._delta_rows: List[tuple] = []
+        self._delta_alive: List[bool] = []
+        self._delta_cache: Optional[Tuple[Dict[str, np.ndarray], np.ndarray, np.ndarray]] = None
+        self._count = len(keys)
+
+    async def build(self, collection, batch_size: int = NEARBY_INDEX_BATCH_SIZE) -> int:
+        """Load every event; returns the number indexed."""
+        self.ready = False
+        self._journal = []
+        try:
+            fingerprint = await collection_fingerprint(collection)
+            projection = {"location.coordinates": 1, "timestamp": 1, "duplicate_of": 1, **{f: 1 for f in FILTER_FIELDS}}
+            cursor = collection.find({}, projection=projection, batch_size=batch_size)
+            rows, unindexed = [], set()
+            while True:
+                docs = await cursor.to_list(length=batch_size)
+                if not docs:
+                    break
+                for doc in docs:
+                    row = _row(doc)
+                    if row is None:
+                        unindexed.add(str(doc["_id"]))
+                    else:
+                        rows.append(row)
+            self._set_base(_columns(rows))
+            self._unindexed = unindexed
+            # Events inserted during the scan are not in the fingerprint's
+            # count; events deleted during it are (see _forget)
+            self._before = fingerprint["max_id"]
+            self._count_offset = fingerprint["count"] - sum(1 for i in self._known() if self._predates(i))
+            journal, self._journal = self._journal, None
+            for op, value in journal:
+                if op > 0:
+                    self.add(value)
+                else:
+                    self.remove(value)
+        finally:
+            self._journal = None
+            self._before = None
+        self.ready = True
+        return self._count
+
+    def _known(self) -> Iterable[str]:
+        yield from self._where
+        yield from self._unindexed
+
+    def _predates(self, event_id: str) -> bool:
+        # ObjectIds start with their creation time, so their hex strings sort by it
+        return self._before is not None and event_id <= self._before
+
+    def fingerprint(self) -> Dict[str, Any]:
+        """The ``collection_fingerprint`` of the events this index holds."""
+        return {
+            "count": len(self._where) + len(self._unindexed) + self._count_offset,
+            "max_id": max(self._known(), default=None),
+        }
+
+    async def is_stale(self, collection) -> bool:
+        """
+        Whether the collection was written to behind this index's back. A
+        write still on its way to ``add`` or ``remove`` looks the same, so
+        callers should confirm after a short wait; a write racing ``build``
+        may at worst cause one unnecessary rebuild.
+        """
+        return await collection_fingerprint(collection) != self.fingerprint()
+
+    def add(self, docs: Iterable[dict]) -> None:
+        docs = list(docs)
+        if self._journal is not None:
+            self._journal.append((1, docs))
+            return
+        for doc, row in zip(docs, map(_row, docs)):
+            if row is None:
+                if str(doc["_id"]) not in self._where:
+                    self._unindexed.add(str(doc["_id"]))
+                continue
+            if row[0] in self._where:
+                continue
+            self._unindexed.discard(row[0])
+            self._where[row[0]] = (False, len(self._delta_rows))
+            self._delta_rows.append(row)
+            self._delta_alive.append(True)
+            self._count += 1
+        self._delta_cache = None
+        if len(self._delta_rows) > max(NEARBY_INDEX_DELTA_ROWS, len(self._base_keys) // 8):
+            self.compact()
+
+    def remove(self, ids: Iterable[str]) -> None:
+        ids = [str(i) for i in ids]
+        if self._journal is not None:
+            self._journal.append((-1, ids))
+            return
+        for event_id in ids:
+            where = self._where.pop(event_id, None)
+            if where is None:
+                self._forget(event_id)
+                continue
+            in_base, pos = where
+            if in_base:
+                self._base_alive[pos] = False
+            else:
+                self._delta_alive[pos] = False
+                self._delta_cache = None
+            self._count -= 1
+
+    def _forget(self, event_id: str) -> None:
+        if event_id in self._unindexed:
+            self._unindexed.discard(event_id)
+        elif self._predates(event_id):
+            # Replayed delete of an event that the build's scan already missed
+            self._count_offset -= 1
+
+    def compact(self) -> None:
+        """Merge the delta into the sorted base and drop deleted rows."""
+        delta, _, alive = self._delta()
+        self._set_base(_concat([_take(self._base, self._base_alive), _take(delta, alive)]))
+
+    def _delta(self) -> Tuple[Dict[str, np.ndarray], np.ndarray, np.ndarray]:
+        if self._delta_cache is None:
+            cols = _columns(self._delta_rows)
+            self._delta_cache = (cols, self._keys(cols["lon"], cols["lat"]),
+                                 np.asarray(self._delta_alive, dtype=bool))
+        return self._delta_cache
+
+    def _window(self, lon: float, lat: float, radius_m: Optional[float]) -> Optional[Tuple[int, int, int, int]]:
+        """
+        Cells (ix0, iy0, ix1, iy1) holding every point within ``radius_m``,
+        or None when the circle is too large (or wraps) and all rows are scanned.
+        """
+        if radius_m is None or not math.isfinite(radius_m):
+            return None
+        # Mercator stretches distances by sec(lat); bound it over the whole circle
+        lat_edge = abs(lat) + math.degrees(radius_m / EARTH_RADIUS_M)
+        if lat_edge >= MAX_MERCATOR_LAT:
+            return None
+        reach = radius_m / math.cos(math.radians(lat_edge))
+        x, y = (float(v) for v in mercator_xy(lon, lat))
+        if x - reach < -_WORLD_HALF_M or x + reach > _WORLD_HALF_M:
+            return None
+        c = self.cell_size_m
+        window = (math.floor((x - reach) / c), math.floor((y - reach) / c),
+                  math.floor((x + reach) / c), math.floor((y + reach) / c))
+        if window[3] - window[1] + 1 > NEARBY_INDEX_MAX_ROWS:
+            return None
+        return window
+
+    def _candidates(self, window: Optional[Tuple[int, int, int, int]]) -> Dict[str, np.ndarray]:
+        delta, delta_keys, delta_alive = self._delta()
+        if window is None:
+            return _concat([_take(self._base, self._base_alive), _take(delta, delta_alive)])
+        ix0, iy0, ix1, iy1 = window
+        rows = np.arange(iy0, iy1 + 1, dtype=np.int64) + _OFFSET
+        starts = np.searchsorted(self._base_keys, rows * _STRIDE + (ix0 + _OFFSET), side="left")
+        ends = np.searchsorted(self._base_keys, rows * _STRIDE + (ix1 + _OFFSET), side="right")
+        spans = [np.arange(s, e) for s, e in zip(starts, ends) if e > s]
+        idx = np.concatenate(spans) if spans else np.empty(0, dtype=np.int64)
+        idx = idx[self._base_alive[idx]]
+        ix, iy = delta_keys % _STRIDE - _OFFSET, delta_keys // _STRIDE - _OFFSET
+        in_window = delta_alive & (ix >= ix0) & (ix <= ix1) & (iy >= iy0) & (iy <= iy1)
+        return _concat([_take(self._base, idx), _take(delta, in_window)])
+
+    def _within(self, lon: float, lat: float, radius_m: Optional[float],
+                filters: Dict[str, Any]) -> Tuple[np.ndarray, np.ndarray]:
+        """(ids, distances) within radius (anywhere when None), sorted by distance."""
+        cols = self._candidates(self._window(lon, lat, radius_m))
+        cols = _take(cols, _filter_mask(cols, filters))
+        distances = haversine_m(lon, lat, cols["lon"], cols["lat"])
+        keep = distances <= radius_m if radius_m is not None else np.ones(len(distances), dtype=bool)
+        ids, distances = cols["id"][keep], distances[keep]
+        order = np.argsort(distances, kind="stable")
+        return ids[order], distances[order]
+
+    def query(self, lon: float, lat: float, radius_m: Optional[float] = None, k: Optional[int] = None,
+              limit: Optional[int] = None, filters: Optional[Dict[str, Any]] = None) -> Tuple[List[str], List[float]]:
+        """
+        Ids and distances (metres, ascending) of events within ``radius_m``,
+        or of the ``k`` nearest (within ``radius_m`` if given), at most ``limit``.
+        """
+        filters = filters or {}
+        if k is None:
+            ids, distances = self._within(lon, lat, radius_m, filters)
+        else:
+            # Widen the search until it holds k events: the k nearest are
+            # among them. Past the largest window, scan everything at once
+            reach = self.cell_size_m
+            while True:
+                bound = reach if radius_m is None else min(reach, radius_m)
+                if self._window(lon, lat, bound) is None:
+                    ids, distances = self._within(lon, lat, radius_m, filters)
+                    break
+                ids, distances = self._within(lon, lat, bound, filters)
+                if len(ids) >= k or bound == radius_m:
+                    break
+                reach *= 4
+            limit = k if limit is None else min(k, limit)
+        if limit is not None:
+            ids, distances = ids[:limit], distances[:limit]
+        return ids.tolist(), distances.tolist()
+
+
+async def geo_near(collection, lon: float, lat: float, query: dict, radius_m: Optional[float] = None,
+                   limit: Optional[int] = None) -> Tuple[List[str], List[float]]:
+    """Same result from Mongo $geoNear (2dsphere index), used while the index is not ready."""
+    stage: Dict[str, Any] = {
+        "near": {"type": "Point", "coordinates": [lon, lat]},
+        "distanceField": "distance_m",
+        "key": "location",
+        "spherical": True,
+        "query": query,
+    }
+    if radius_m is not None:
+        stage["maxDistance"] = radius_m
+    pipeline: List[Dict[str, Any]] = [{"$geoNear": stage}]
+    if limit is not None:
+        pipeline.append({"$limit": limit})
+    pipeline.append({"$project": {"_id": 1, "distance_m": 1}})
+    docs = await collection.aggregate(pipeline).to_list(length=None)
+    return [str(d["_id"]) for d in docs], [float(d["distance_m"]) for d in docs]
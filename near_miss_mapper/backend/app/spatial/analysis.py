@@ -0,0 +1,418 @@
+# End-to-end hotspot analysis pipelines, run inside analysis worker processes
+import base64
+import os
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, Any, Iterator, List, Optional
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from scipy.stats import norm
+from esda.moran import Moran
+from libpysal.graph import Graph
+
+from .. import heatmap
+from ..metrics import StageTimer
+from .gi_star import (bin_cells, coarsen_cells, counts_to_grid, events_to_grid, gi_star, save_as_arrow,
+                      save_as_geoparquet, save_as_shapefile, _fdr_correction, _project_lonlat, _weights_matrix)
+from . import emerging, kde
+from .weights_cache import WeightsCache
+
+# Output writers selectable through GiStarRequest.output_formats
+OUTPUT_WRITERS = {
+    'parquet': save_as_geoparquet,
+    'arrow': save_as_arrow,
+    'shapefile': save_as_shapefile,
+}
+
+# Upper bound on cells x time slices in one emerging hot spot analysis
+EMERGING_MAX_UNITS = int(os.getenv("EMERGING_MAX_UNITS", "20000000"))
+
+# Significance labels in code order for compact inline results (0 = not significant)
+SIGNIFICANCE_LEVELS = ['not_significant', 'hot_90', 'hot_95', 'hot_99', 'cold_90', 'cold_95', 'cold_99']
+
+# Neighbour matrices live for the lifetime of the worker process (and on disk)
+_weights_caches: Dict[str, WeightsCache] = {}
+
+
+def _weights_cache(out_dir: str) -> WeightsCache:
+    cache_dir = os.path.join(out_dir, 'weights')
+    if cache_dir not in _weights_caches:
+        _weights_caches[cache_dir] = WeightsCache(cache_dir)
+    return _weights_caches[cache_dir]
+
+
+def run_gi_star_analysis(lon: np.ndarray, lat: np.ndarray, params: Dict[str, Any], out_dir: str,
+                         n_jobs: int = 1, filename: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Grid the event coordinates, compute Gi* and Moran's I, write the
+    requested output files and return the API payload. ``params`` are the fields of
+    GiStarRequest; ``filename`` defaults to a timestamped name. The payload's
+    ``timings`` holds per-stage seconds (and tracemalloc peaks with
+    ``params['trace_memory']``).
+    """
+    timer = StageTimer(trace_memory=params.get('trace_memory', False))
+    # 1) Aggregate events to a grid (counts per cell)
+    with timer.stage('gridding'):
+        events_df = pd.DataFrame({'lon': lon, 'lat': lat})
+        grid_gdf = events_to_grid(events_df, lon_field='lon', lat_field='lat',
+                                  cell_size_m=params['cell_size_m'], buffer_m=params['buffer_m'])
+    return _analyse_grid(grid_gdf, params, out_dir, n_jobs, filename, timer)
+
+
+def run_gi_star_on_cells(ix: np.ndarray, iy: np.ndarray, counts: np.ndarray, params: Dict[str, Any],
+                         out_dir: str, n_jobs: int = 1, filename: Optional[str] = None) -> Dict[str, Any]:
+    """Same as run_gi_star_analysis, starting from pre-aggregated cell counts."""
+    timer = StageTimer(trace_memory=params.get('trace_memory', False))
+    with timer.stage('gridding'):
+        grid_gdf = counts_to_grid(ix, iy, counts, cell_size_m=params['cell_size_m'], buffer_m=params['buffer_m'])
+    return _analyse_grid(grid_gdf, params, out_dir, n_jobs, filename, timer)
+
+
+def run_gi_star_pyramid_analysis(lon: np.ndarray, lat: np.ndarray, params: Dict[str, Any], out_dir: str,
+                                 n_jobs: int = 1, filename: Optional[str] = None) -> Dict[str, Any]:
+    """Multi-resolution Gi*: bin the events once at the finest of ``params['cell_sizes']``."""
+    base = min(params['cell_sizes'])
+    timer = StageTimer(trace_memory=params.get('trace_memory', False))
+    with timer.stage('binning'):
+        ix, iy, counts = bin_cells(lon, lat, base)
+    return run_gi_star_pyramid_on_cells(ix, iy, counts, params, out_dir, n_jobs, filename, timer)
+
+
+def run_gi_star_pyramid_on_cells(ix: np.ndarray, iy: np.ndarray, counts: np.ndarray, params: Dict[str, Any],
+                                 out_dir: str, n_jobs: int = 1, filename: Optional[str] = None,
+                                 timer: Optional[StageTimer] = None) -> Dict[str, Any]:
+    """
+    Multi-resolution Gi* from cell counts at the finest of ``params['cell_sizes']``
+    (all sizes must be whole multiples of it). Each coarser level is summed
+    from the previous one it divides, so events are read once for all
+    levels; results are keyed by level, e.g. ``result['levels']['250']``.
+    Every level carries its own ``timings``; the top-level ``timings``
+    covers the shared binning and coarsening.
+    """
+    if timer is None:
+        timer = StageTimer(trace_memory=params.get('trace_memory', False))
+    sizes = sorted(set(float(s) for s in params['cell_sizes']))
+    if filename is None:
+        filename = f"gi_star_pyramid_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}"
+    levels: Dict[str, Any] = {}
+    built: List[tuple] = [(sizes[0], (ix, iy, counts))]
+    for size in sizes:
+        # Coarsen from the largest level already built that divides this one
+        parent_size, parent = next((s, cells) for s, cells in reversed(built) if _multiple(size, s))
+        if size != parent_size:
+            with timer.stage('coarsening'):
+                cells = coarsen_cells(*parent, int(round(size / parent_size)))
+            built.append((size, cells))
+        else:
+            cells = parent
+        level_params = dict(params, cell_size_m=size)
+        level_timer = StageTimer(trace_memory=timer.trace_memory)
+        with level_timer.stage('gridding'):
+            grid_gdf = counts_to_grid(*cells, cell_size_m=size, buffer_m=params['buffer_m'])
+        levels[f"{size:g}"] = _analyse_grid(grid_gdf, level_params, out_dir, n_jobs, f"{filename}_{size:g}m",
+                                            level_timer)
+    return {
+        'status': 'ok',
+        'cell_sizes': sizes,
+        'levels': levels,
+        'timings': timer.report(),
+    }
+
+
+def _multiple(size: float, base: float) -> bool:
+    ratio = size / base
+    return abs(ratio - round(ratio)) < 1e-9
+
+
+def run_emerging_hotspot_analysis(lon: np.ndarray, lat: np.ndarray, t: np.ndarray, params: Dict[str, Any],
+                                  out_dir: str, n_jobs: int = 1, filename: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Space-time Gi* over (grid cell x time slice) plus a Mann-Kendall trend
+    per cell, classified into emerging hot/cold spot categories. ``t`` is
+    epoch seconds; slices of ``time_step_days`` are aligned to end at
+    ``end_date`` (or the latest event) so the final slice is a full one.
+    Only occupied cells and their neighbours are analysed; the Gi* mean
+    and variance still cover every cell of the grid extent.
+    """
+    cell_size = float(params['cell_size_m'])
+    step = float(params['time_step_days']) * 86400.0
+    t_start = _epoch(params.get('start_date')) if params.get('start_date') else float(t.min())
+    t_end = _epoch(params.get('end_date')) if params.get('end_date') else float(t.max())
+    if t_end < t_start:
+        raise ValueError("end_date must not be before start_date")
+    n_slices = int((t_end - t_start) // step) + 1
+    time_slice = n_slices - 1 - np.floor((t_end - t) / step).astype(np.int64)
+    keep = (time_slice >= 0) & (time_slice < n_slices)
+    lon, lat, time_slice = lon[keep], lat[keep], time_slice[keep]
+
+    # 1) Cells on the global lattice, as counts_to_grid lays them out
+    x, y = _project_lonlat(lon, lat)
+    ix = np.floor(x / cell_size).astype(np.int64)
+    iy = np.floor(y / cell_size).astype(np.int64)
+    occupied, totals = np.unique(np.column_stack([ix, iy]), axis=0, return_counts=True)
+    grid_gdf = counts_to_grid(occupied[:, 0], occupied[:, 1], totals, cell_size_m=cell_size, cells='occupied')
+    grid = grid_gdf.attrs['grid']
+    col0 = int(round(grid['origin'][0] / cell_size))
+    row0 = int(round(grid['origin'][1] / cell_size))
+    position = np.searchsorted(grid_gdf['id'].to_numpy(), (ix - col0) * grid['n_rows'] + (iy - row0))
+
+    # 2) Sparse cube and space-time Gi* z-scores (dense per-unit results are the bound)
+    if len(grid_gdf) * n_slices > EMERGING_MAX_UNITS:
+        raise ValueError(f"{len(grid_gdf)} cells x {n_slices} time slices exceeds {EMERGING_MAX_UNITS} "
+                         "space-time units; use a larger cell size or time step")
+    cube = emerging.build_cube(position, time_slice, len(grid_gdf), n_slices)
+    w = _weights_matrix(grid_gdf, params['neighborhood_method'], cache=_weights_cache(out_dir))
+    # Statistics over every cell of the grid extent, as with cells='all';
+    # z-scores are exact for cells whose neighbours are all materialized
+    z = emerging.space_time_gi_star(cube, w, params['time_window'],
+                                    n_units=grid['n_cols'] * grid['n_rows'] * n_slices)
+    p = 2 * norm.sf(np.abs(z))
+    if params['fdr']:
+        significant = _fdr_correction(p.ravel()).reshape(p.shape)
+    else:
+        significant = p <= 0.05
+
+    # 3) Trend of each cell's z-scores and classification
+    trend_z, trend_p = emerging.mann_kendall(z)
+    hot, cold = significant & (z > 0), significant & (z < 0)
+    categories = emerging.classify(hot, cold, trend_z, trend_p)
+
+    out_gdf = grid_gdf.copy()
+    out_gdf['category'] = categories
+    out_gdf['trend_z'] = trend_z
+    out_gdf['trend_p'] = trend_p
+    out_gdf['final_z'] = z[:, -1]
+    out_gdf['hot_slices'] = hot.sum(axis=1)
+    out_gdf['cold_slices'] = cold.sum(axis=1)
+
+    if filename is None:
+        filename = f"emerging_hotspots_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}"
+    outputs = {
+        fmt: OUTPUT_WRITERS[fmt](out_gdf, out_dir, filename)
+        for fmt in dict.fromkeys(params.get('output_formats', ['parquet']))
+    }
+    labels, counts = np.unique(categories.astype(str), return_counts=True)
+    summary = {
+        'n_cells': int(len(out_gdf)),
+        'n_slices': n_slices,
+        'time_step_days': float(params['time_step_days']),
+        'start': datetime.fromtimestamp(t_end - n_slices * step, tz=timezone.utc).isoformat(),
+        'end': datetime.fromtimestamp(t_end, tz=timezone.utc).isoformat(),
+        'n_events': int(cube.sum()),
+        'categories': {str(k): int(v) for k, v in zip(labels, counts)},
+    }
+    return {
+        'status': 'ok',
+        'outputs': outputs,
+        'summary': summary,
+    }
+
+
+def run_kde_analysis(lon: np.ndarray, lat: np.ndarray, weights: Optional[np.ndarray],
+                     params: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Kernel density raster of the events over ``params['bbox']``, each event
+    counting ``weights`` (e.g. by severity) or 1. Events are binned once;
+    everything after that scales with the raster, not the event count.
+    """
+    timer = StageTimer(trace_memory=params.get('trace_memory', False))
+    with timer.stage('binning'):
+        ix, iy, values = bin_cells(lon, lat, params['cell_size_m'], weights)
+    return run_kde_on_cells(ix, iy, values, params, timer)
+
+
+def run_kde_on_cells(ix: np.ndarray, iy: np.ndarray, values: np.ndarray, params: Dict[str, Any],
+                     timer: Optional[StageTimer] = None) -> Dict[str, Any]:
+    """Same as run_kde_analysis, starting from per-cell counts (or weight sums)."""
+    if timer is None:
+        timer = StageTimer(trace_memory=params.get('trace_memory', False))
+    cell_size = float(params['cell_size_m'])
+    window = heatmap.raster_window(params['bbox'], cell_size,
+                                   heatmap.kernel_radius_m(params['kernel'], params['bandwidth_m']))
+    pad = window['pad']
+    with timer.stage('rasterize'):
+        raster = kde.rasterize(ix, iy, values, window['col0'] - pad, window['row0'] - pad,
+                               window['n_cols'] + 2 * pad, window['n_rows'] + 2 * pad)
+    with timer.stage('convolve'):
+        kernel = kde.kernel_matrix(params['kernel'], params['bandwidth_m'], cell_size)
+        density = kde.smooth(raster, kernel)
+        # Drop the margin and flip to north-up image rows
+        density = density[pad:pad + window['n_rows'], pad:pad + window['n_cols']][::-1]
+    with timer.stage(f"encode_{params['format']}"):
+        encoded = heatmap.encode_raster(density, params['format'])
+    result = {
+        'status': 'ok',
+        'kernel': params['kernel'],
+        'bandwidth_m': float(params['bandwidth_m']),
+        'cell_size_m': cell_size,
+        'crs': 'EPSG:3857',
+        'width': window['n_cols'],
+        'height': window['n_rows'],
+        **heatmap.window_bounds(window, cell_size),
+        'weighted': bool(params.get('weight_by_severity')),
+        # Smoothed events (or weights) per cell; n_events counts the bbox plus kernel margin
+        'units': 'weighted events per cell' if params.get('weight_by_severity') else 'events per cell',
+        'n_events': float(raster.sum()),
+        **encoded,
+    }
+    result['timings'] = timer.report()
+    return result
+
+
+def _epoch(value: datetime) -> float:
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+@contextmanager
+def _seeded(seed: Optional[int]) -> Iterator[None]:
+    """
+    Seed NumPy's global generator (which esda's Moran draws from) for the
+    block and restore its state afterwards, as pool workers are reused.
+    """
+    if seed is None:
+        yield
+        return
+    state = np.random.get_state()
+    np.random.seed(seed)
+    try:
+        yield
+    finally:
+        np.random.set_state(state)
+
+
+def _analyse_grid(grid_gdf: gpd.GeoDataFrame, params: Dict[str, Any], out_dir: str,
+                  n_jobs: int = 1, filename: Optional[str] = None,
+                  timer: Optional[StageTimer] = None) -> Dict[str, Any]:
+    if timer is None:
+        timer = StageTimer(trace_memory=params.get('trace_memory', False))
+    # 2) Compute Gi* on counts
+    weights_cache = _weights_cache(out_dir)
+    gi_gdf = gi_star(
+        grid_gdf,
+        value_field='count',
+        neighborhood_method=params['neighborhood_method'],
+        k=params['k'],
+        distance_band_m=params['distance_band_m'],
+        permutations=params['permutations'],
+        fdr=params['fdr'],
+        use_centroids=params['use_centroids'],
+        n_jobs=n_jobs,
+        seed=params.get('seed'),
+        weights_cache=weights_cache,
+        timer=timer,
+    )
+
+    # 3) Global spatial autocorrelation (Moran's I) on counts for context
+    try:
+        with timer.stage('moran'):
+            # For simplicity, use queen on the grid for Moran's I (shared with Gi* when it used queen)
+            sp = _weights_matrix(gi_gdf, 'queen', cache=weights_cache)
+            w = Graph.from_sparse(sp).transform('r')
+            with _seeded(params.get('seed')):
+                mi = Moran(gi_gdf['count'].to_numpy(dtype=float), w, two_tailed=True,
+                           permutations=params['permutations'])
+        moran_i = float(mi.I)
+        moran_p = float(mi.p_sim)
+        moran_z = float(mi.z_sim)
+    except Exception:
+        moran_i = None
+        moran_p = None
+        moran_z = None
+
+    # 4) Save outputs (GeoParquet by default; shapefile only on request)
+    if filename is None:
+        filename = f"gi_star_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}"
+    outputs = {}
+    for fmt in dict.fromkeys(params.get('output_formats', ['parquet'])):
+        with timer.stage(f'write_{fmt}'):
+            outputs[fmt] = OUTPUT_WRITERS[fmt](gi_gdf, out_dir, filename)
+
+    # 5) Build summary
+    z = gi_gdf['z_score'].to_numpy()
+    sig = gi_gdf['significance'].astype(str)
+
+    summary = {
+        'n_units': int(len(gi_gdf)),
+        'hot_counts': {
+            'hot_99': int((sig == 'hot_99').sum()),
+            'hot_95': int((sig == 'hot_95').sum()),
+            'hot_90': int((sig == 'hot_90').sum()),
+        },
+        'cold_counts': {
+            'cold_99': int((sig == 'cold_99').sum()),
+            'cold_95': int((sig == 'cold_95').sum()),
+            'cold_90': int((sig == 'cold_90').sum()),
+        },
+        'fdr_significant_total': int(gi_gdf['fdr_significant'].sum()),
+        'z_stats': {
+            'min': float(np.nanmin(z)),
+            'mean': float(np.nanmean(z)),
+            'max': float(np.nanmax(z)),
+            'std': float(np.nanstd(z)),
+        },
+        'moran': {
+            'I': moran_i,
+            'z': moran_z,
+            'p_value': moran_p,
+        }
+    }
+
+    result = {
+        'status': 'ok',
+        'outputs': outputs,
+        'shapefile_path': outputs.get('shapefile'),
+        'summary': summary,
+    }
+    if params.get('inline_cells'):
+        with timer.stage('inline_cells'):
+            result['cells'] = compact_cells(gi_gdf, params['inline_cells'])
+    result['timings'] = timer.report()
+    return result
+
+
+def compact_cells(gi_gdf: gpd.GeoDataFrame, encoding: str = 'base64') -> Dict[str, Any]:
+    """
+    Significant cells only (``fdr_significant``, as counted in the
+    summary's ``fdr_significant_total``), addressed on the grid instead of
+    by polygon: cell (col, row) spans ``origin + (col, row) * cell_size`` to
+    ``origin + (col + 1, row + 1) * cell_size`` in EPSG:3857. With
+    ``encoding='base64'`` each array is the base64 of its little-endian
+    typed buffer (see ``dtypes``); with ``'json'`` they are plain lists.
+    ``significance`` holds indices into ``levels`` (the z-score bands).
+    """
+    grid = gi_gdf.attrs['grid']
+    significance = gi_gdf['significance'].astype(str).to_numpy()
+    keep = gi_gdf['fdr_significant'].to_numpy(dtype=bool)
+    codes = {label: i for i, label in enumerate(SIGNIFICANCE_LEVELS)}
+    arrays = {
+        'col': gi_gdf['col'].to_numpy()[keep].astype('<i4'),
+        'row': gi_gdf['row'].to_numpy()[keep].astype('<i4'),
+        'count': gi_gdf['count'].to_numpy()[keep].astype('<u4'),
+        'z': gi_gdf['z_score'].to_numpy()[keep].astype('<f4'),
+        'p': gi_gdf['p_value'].to_numpy()[keep].astype('<f4'),
+        'significance': np.array([codes[s] for s in significance[keep]], dtype='u1'),
+    }
+    payload: Dict[str, Any] = {
+        'crs': 'EPSG:3857',
+        'origin': list(grid['origin']),
+        'cell_size': grid['cell_size'],
+        'n_cols': grid['n_cols'],
+        'n_rows': grid['n_rows'],
+        'n_cells': int(keep.sum()),
+        'levels': SIGNIFICANCE_LEVELS,
+        'encoding': encoding,
+    }
+    if encoding == 'base64':
+        payload['dtypes'] = {name: arr.dtype.name for name, arr in arrays.items()}
+        payload.update({name: base64.b64encode(arr.tobytes()).decode('ascii') for name, arr in arrays.items()})
+    else:
+        # float32 -> shortest decimal that round-trips at float32 precision
+        payload.update({
+            name: [float(f"{v:.7g}") for v in arr] if arr.dtype.kind == 'f' else arr.tolist()
+            for name, arr in arrays.items()
+        })
+    return payload
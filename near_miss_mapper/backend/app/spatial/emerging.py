@@ -0,0 +1,144 @@
+# Space-time Getis-Ord Gi* and emerging hot spot classification on a sparse
+# (cell x time slice) cube
+from typing import Optional, Tuple
+
+import numpy as np
+from scipy import sparse
+from scipy.stats import norm
+
+# Share of time slices a location must be significant in to count as persistent
+PERSISTENT_SHARE = 0.9
+
+CATEGORIES = [
+    'no_pattern',
+    'new_hot_spot', 'consecutive_hot_spot', 'intensifying_hot_spot', 'persistent_hot_spot',
+    'diminishing_hot_spot', 'sporadic_hot_spot', 'oscillating_hot_spot', 'historical_hot_spot',
+    'new_cold_spot', 'consecutive_cold_spot', 'intensifying_cold_spot', 'persistent_cold_spot',
+    'diminishing_cold_spot', 'sporadic_cold_spot', 'oscillating_cold_spot', 'historical_cold_spot',
+]
+
+
+def build_cube(cell: np.ndarray, time_slice: np.ndarray, n_cells: int, n_slices: int) -> sparse.csr_matrix:
+    """Event counts as a sparse (n_cells x n_slices) matrix; duplicates are summed."""
+    data = np.ones(len(cell), dtype=float)
+    return sparse.csr_matrix((data, (cell, time_slice)), shape=(n_cells, n_slices))
+
+
+def time_window(n_slices: int, window: int) -> sparse.csr_matrix:
+    """
+    Temporal neighbourhood: slice s sees slices s - window .. s, so a
+    location's past informs its present but never the other way round.
+    """
+    offsets = list(range(0, -min(window, n_slices - 1) - 1, -1))
+    return sparse.diags([np.ones(n_slices - abs(o)) for o in offsets], offsets,
+                        shape=(n_slices, n_slices), format='csr')
+
+
+def space_time_gi_star(cube: sparse.csr_matrix, w_space: sparse.spmatrix, window: int,
+                       n_units: Optional[int] = None) -> np.ndarray:
+    """
+    Analytic Gi* z-scores for every (cell, slice) of ``cube`` with binary
+    space-time weights: the spatial neighbours in ``w_space`` plus the cell
+    itself, over the current and ``window`` previous slices.
+
+    The weights are the Kronecker product of the spatial and temporal
+    neighbourhoods, so the lag is (W + I) @ X @ T' and the per-unit weight
+    sums are outer products; the full space-time matrix is never built.
+
+    ``n_units`` is the size of the population the mean and standard
+    deviation are taken over, when ``cube`` holds only some of its cells
+    (e.g. occupied cells and their neighbours out of the whole grid extent):
+    the cells left out are empty, so they only add zeros to both sums.
+    Defaults to the units of ``cube``.
+    """
+    n_cells, n_slices = cube.shape
+    n = n_cells * n_slices if n_units is None else int(n_units)
+    if n < n_cells * n_slices:
+        raise ValueError("n_units cannot be smaller than the cube")
+    w_star = sparse.csr_matrix(w_space, dtype=float, copy=True)
+    w_star.data[:] = 1.0
+    w_star = (w_star + sparse.identity(n_cells, format='csr')).tocsr()
+    w_star.data[:] = 1.0
+    t = time_window(n_slices, window)
+
+    lag = (w_star @ cube @ t.T).toarray()
+    w_sum = np.outer(np.asarray(w_star.sum(axis=1)).ravel(), np.asarray(t.sum(axis=1)).ravel())
+
+    mean = cube.sum() / n
+    s = np.sqrt(max(cube.multiply(cube).sum() / n - mean ** 2, 0.0))
+    # Binary weights: the sum of squared weights equals the sum of weights
+    denom = s * np.sqrt((n * w_sum - w_sum ** 2) / (n - 1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = (lag - mean * w_sum) / denom
+    z[~np.isfinite(z)] = 0.0
+    return z
+
+
+def mann_kendall(series: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Mann-Kendall trend test on each row of ``series`` (cells x slices),
+    with the tie correction; returns (z, two-sided p) per row.
+    """
+    n_rows, n = series.shape
+    if n < 3:
+        return np.zeros(n_rows), np.ones(n_rows)
+    s = np.zeros(n_rows)
+    for lag in range(1, n):
+        s += np.sign(series[:, lag:] - series[:, :-lag]).sum(axis=1)
+
+    # Tie groups per row: run lengths of equal values in each sorted row
+    ordered = np.sort(series, axis=1)
+    starts = np.ones_like(ordered, dtype=bool)
+    starts[:, 1:] = ordered[:, 1:] != ordered[:, :-1]
+    group = np.cumsum(starts.ravel()) - 1
+    sizes = np.bincount(group).astype(float)
+    group_row = np.repeat(np.arange(n_rows), starts.sum(axis=1))
+    ties = np.bincount(group_row, weights=sizes * (sizes - 1) * (2 * sizes + 5), minlength=n_rows)
+
+    var = (n * (n - 1) * (2 * n + 5) - ties) / 18.0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = np.where(s > 0, (s - 1) / np.sqrt(var), np.where(s < 0, (s + 1) / np.sqrt(var), 0.0))
+    z[~np.isfinite(z)] = 0.0
+    return z, 2 * norm.sf(np.abs(z))
+
+
+def _trailing_run(flags: np.ndarray) -> np.ndarray:
+    """Length of the run of True values ending at the last column, per row."""
+    reversed_flags = flags[:, ::-1]
+    run = np.argmin(reversed_flags, axis=1)
+    run[reversed_flags.all(axis=1)] = flags.shape[1]
+    return run
+
+
+def classify(significant_hot: np.ndarray, significant_cold: np.ndarray,
+             trend_z: np.ndarray, trend_p: np.ndarray, alpha: float = 0.05) -> np.ndarray:
+    """
+    Emerging hot spot categories per cell from the per-slice significance
+    of its Gi* z-scores and the Mann-Kendall trend of those z-scores.
+    """
+    n_cells, n_slices = significant_hot.shape
+    labels = np.full(n_cells, 'no_pattern', dtype=object)
+    trend_up = (trend_p <= alpha) & (trend_z > 0)
+    trend_down = (trend_p <= alpha) & (trend_z < 0)
+
+    for kind, spots, opposite, intensifying, diminishing in (
+        ('hot', significant_hot, significant_cold, trend_up, trend_down),
+        ('cold', significant_cold, significant_hot, trend_down, trend_up),
+    ):
+        final = spots[:, -1]
+        count = spots.sum(axis=1)
+        persistent = count >= PERSISTENT_SHARE * n_slices
+        run = _trailing_run(spots)
+        rules = [
+            ('historical', ~final & persistent),
+            ('intensifying', final & persistent & intensifying),
+            ('diminishing', final & persistent & diminishing),
+            ('persistent', final & persistent & ~intensifying & ~diminishing),
+            ('new', final & (count == 1)),
+            ('consecutive', final & ~persistent & (run >= 2) & (run == count)),
+            ('oscillating', final & ~persistent & (count > 1) & (run != count) & opposite.any(axis=1)),
+            ('sporadic', final & ~persistent & (count > 1) & (run != count) & ~opposite.any(axis=1)),
+        ]
+        for name, mask in rules:
+            labels[mask & (labels == 'no_pattern')] = f"{name}_{kind}_spot"
+    return labels
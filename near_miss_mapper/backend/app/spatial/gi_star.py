@@ -5,12 +5,18 @@ from typing import Literal, Optional, Tuple, Dict, Any
 import numpy as np
 import pandas as pd
 import geopandas as gpd
-from shapely.geometry import Point, Polygon
+import shapely
 from pyproj import CRS
+from scipy.stats import norm
 from statsmodels.stats.multitest import multipletests
 
-from libpysal.weights import Queen, Rook, KNN, DistanceBand
-from esda.getisord import G_Local
+from libpysal.weights import Queen, Rook, KNN, DistanceBand, WSP
+
+from ..geo import mercator_xy
+from ..metrics import StageTimer
+from .lattice import lattice_weights
+from .local_g import local_gi_star
+from .weights_cache import WeightsCache, weights_key
 
 
 def _ensure_metric_crs(gdf: gpd.GeoDataFrame) -> Tuple[gpd.GeoDataFrame, CRS]:
@@ -23,11 +29,62 @@ def _ensure_metric_crs(gdf: gpd.GeoDataFrame) -> Tuple[gpd.GeoDataFrame, CRS]:
     return gdf, gdf.crs
 
 
+def _project_lonlat(lon: np.ndarray, lat: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Project WGS84 lon/lat arrays to Web Mercator metres (same CRS as
+    _ensure_metric_crs) the way the aggregates do: latitudes beyond the
+    projection's limit land on its edge row, non-finite coordinates are NaN.
+    """
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    x, y = mercator_xy(lon, lat)
+    invalid = ~(np.isfinite(lon) & np.isfinite(lat))
+    return np.where(invalid, np.nan, x), np.where(invalid, np.nan, y)
+
+
+def _grid_lattice(gdf: gpd.GeoDataFrame) -> Optional[Dict[str, Any]]:
+    """Return the lattice layout if gdf is (a subset of) a grid from events_to_grid."""
+    grid = gdf.attrs.get('grid')
+    if not grid or 'col' not in gdf.columns or 'row' not in gdf.columns:
+        return None
+    return grid
+
+
+def _lattice_sparse(gdf: gpd.GeoDataFrame,
+                    method: Literal['queen', 'rook', 'knn', 'distance_band'],
+                    k: int = 8,
+                    distance_band: Optional[float] = None):
+    """Neighbour matrix derived from grid (col, row) indices, or None if gdf is not a lattice."""
+    grid = _grid_lattice(gdf)
+    if grid is None:
+        return None
+    return lattice_weights(
+        gdf['col'].to_numpy(), gdf['row'].to_numpy(),
+        grid['n_cols'], grid['n_rows'], grid['cell_size'],
+        method, k=k, distance_band=distance_band,
+    )
+
+
 def _build_weights(gdf: gpd.GeoDataFrame,
                    method: Literal['queen', 'rook', 'knn', 'distance_band'],
                    k: int = 8,
                    distance_band: Optional[float] = None,
                    use_centroids: bool = False):
+    # Grids from events_to_grid are perfect lattices: skip polygon topology
+    sp = _lattice_sparse(gdf, method, k=k, distance_band=distance_band)
+    if sp is not None:
+        w = WSP(sp).to_W(silence_warnings=True)
+        w.transform = 'R'
+        return w
+    return _geometry_weights(gdf, method, k=k, distance_band=distance_band, use_centroids=use_centroids)
+
+
+def _geometry_weights(gdf: gpd.GeoDataFrame,
+                      method: Literal['queen', 'rook', 'knn', 'distance_band'],
+                      k: int = 8,
+                      distance_band: Optional[float] = None,
+                      use_centroids: bool = False):
+    """libpysal weights from the geometries themselves (no lattice fast path)."""
     # For non-polygonal geometries, or if requested, use centroids
     if use_centroids or not gdf.geom_type.isin(['Polygon', 'MultiPolygon']).all():
         geoms = gdf.geometry.centroid
@@ -52,6 +109,25 @@ def _build_weights(gdf: gpd.GeoDataFrame,
     return w
 
 
+def _weights_matrix(gdf: gpd.GeoDataFrame,
+                    method: Literal['queen', 'rook', 'knn', 'distance_band'],
+                    k: int = 8,
+                    distance_band: Optional[float] = None,
+                    use_centroids: bool = False,
+                    cache: Optional[WeightsCache] = None):
+    """Sparse neighbour matrix for gdf (lattice fast path when possible), optionally cached."""
+    def build():
+        sp = _lattice_sparse(gdf, method, k=k, distance_band=distance_band)
+        if sp is None:
+            sp = _geometry_weights(gdf, method, k=k, distance_band=distance_band, use_centroids=use_centroids).sparse
+        return sp
+
+    if cache is None:
+        return build()
+    key = weights_key(gdf, method, k=k, distance_band=distance_band, use_centroids=use_centroids)
+    return cache.get_or_build(key, build)
+
+
 def _fdr_correction(p_values: np.ndarray, alpha: float = 0.05) -> np.ndarray:
     rejected, pval_corr, _, _ = multipletests(p_values, alpha=alpha, method='fdr_bh')
     return rejected
@@ -80,10 +156,21 @@ def gi_star(
     permutations: int = 999,
     fdr: bool = True,
     use_centroids: bool = False,
+    n_jobs: int = 1,
+    seed: Optional[int] = None,
+    weights_cache: Optional[WeightsCache] = None,
+    timer: Optional[StageTimer] = None,
 ) -> gpd.GeoDataFrame:
     """
     Compute Getis-Ord Gi* statistics on a GeoDataFrame.
 
+    Statistics match esda.getisord.G_Local(star=True) on row-standardized
+    weights; permutations run in batched blocks over ``n_jobs`` processes
+    (-1 for all CPUs) and ``seed`` makes p-values reproducible. Neighbour
+    matrices are reused from ``weights_cache`` when given. With ``timer``
+    the weights, gi_star (including permutations), fdr and classify stages
+    are recorded on it.
+
     Returns the input GeoDataFrame with added columns:
       - gi_star
       - z_score
@@ -94,24 +181,22 @@ def gi_star(
     if value_field not in gdf.columns:
         raise ValueError(f"value_field '{value_field}' not found in GeoDataFrame")
 
+    if timer is None:
+        timer = StageTimer()
+
     gdf_metric, _ = _ensure_metric_crs(gdf)
-    w = _build_weights(gdf_metric, neighborhood_method, k=k, distance_band=distance_band_m, use_centroids=use_centroids)
+    with timer.stage('weights'):
+        sp = _weights_matrix(gdf_metric, neighborhood_method, k=k, distance_band=distance_band_m,
+                             use_centroids=use_centroids, cache=weights_cache)
 
     y = gdf_metric[value_field].to_numpy(dtype=float)
     y = np.nan_to_num(y, nan=0.0)
 
-    # Compute local G*
-    gl = G_Local(y, w, star=True, permutations=permutations)
-
-    # Extract stats
-    gi = gl.Gs  # local G or G*
-    # z-scores are available as standardized values
-    try:
-        z = gl.Zs
-    except Exception:
-        # Fallback: standardize Gi by its mean/std
-        z = (gi - np.nanmean(gi)) / (np.nanstd(gi) + 1e-9)
-    p = gl.p_sim if hasattr(gl, 'p_sim') else gl.p_z_sim
+    # Compute local G* (analytic z-scores plus conditional permutation p-values)
+    with timer.stage('gi_star'):
+        gi, z, p_sim = local_gi_star(y, sp, permutations=permutations, n_jobs=n_jobs, seed=seed)
+    # Without permutations fall back to the normal approximation (one-sided)
+    p = p_sim if p_sim is not None else norm.sf(np.abs(z))
 
     gdf_out = gdf_metric.copy()
     gdf_out['gi_star'] = gi
@@ -119,13 +204,15 @@ def gi_star(
     gdf_out['p_value'] = p
 
     # FDR correction
-    if fdr:
-        gdf_out['fdr_significant'] = _fdr_correction(gdf_out['p_value'].to_numpy())
-    else:
-        gdf_out['fdr_significant'] = gdf_out['p_value'] <= 0.05
+    with timer.stage('fdr'):
+        if fdr:
+            gdf_out['fdr_significant'] = _fdr_correction(gdf_out['p_value'].to_numpy())
+        else:
+            gdf_out['fdr_significant'] = gdf_out['p_value'] <= 0.05
 
     # Significance classification by z-score thresholds
-    gdf_out['significance'] = _classify_hot_cold(gdf_out['z_score'].to_numpy())
+    with timer.stage('classify'):
+        gdf_out['significance'] = _classify_hot_cold(gdf_out['z_score'].to_numpy())
 
     return gdf_out
 
@@ -141,45 +228,187 @@ def save_as_shapefile(gdf: gpd.GeoDataFrame, out_dir: str, filename: str) -> str
     return out_path
 
 
+def save_as_geoparquet(gdf: gpd.GeoDataFrame, out_dir: str, filename: str) -> str:
+    """Write GeoParquet in the grid's own CRS (no reprojection, full column names)."""
+    os.makedirs(out_dir, exist_ok=True)
+    if gdf.crs is None:
+        gdf = gdf.set_crs(3857, allow_override=True)
+    out_path = os.path.join(out_dir, f"{filename}.parquet")
+    gdf.to_parquet(out_path, index=False)
+    return out_path
+
+
+def save_as_arrow(gdf: gpd.GeoDataFrame, out_dir: str, filename: str) -> str:
+    """
+    Write an uncompressed Arrow IPC (Feather v2) file with GeoArrow WKB
+    geometry, so readers can memory-map it (pyarrow.memory_map) zero-copy.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    if gdf.crs is None:
+        gdf = gdf.set_crs(3857, allow_override=True)
+    out_path = os.path.join(out_dir, f"{filename}.arrow")
+    gdf.to_feather(out_path, index=False, compression='uncompressed')
+    return out_path
+
+
+def _grid_polygons(cols: np.ndarray, rows: np.ndarray, col: np.ndarray, row: np.ndarray) -> np.ndarray:
+    """Build cell polygons for the given (col, row) indices in one vectorized call."""
+    x0, x1 = cols[col], cols[col + 1]
+    y0, y1 = rows[row], rows[row + 1]
+    # Same vertex order as the original fishnet loop
+    rings = np.stack([
+        np.column_stack([x0, y0]),
+        np.column_stack([x1, y0]),
+        np.column_stack([x1, y1]),
+        np.column_stack([x0, y1]),
+        np.column_stack([x0, y0]),
+    ], axis=1)
+    return shapely.polygons(rings)
+
+
 def events_to_grid(
     events_df: pd.DataFrame,
     lon_field: str = 'lon',
     lat_field: str = 'lat',
     cell_size_m: float = 250.0,
     buffer_m: float = 0.0,
+    cells: Literal['all', 'occupied'] = 'all',
 ) -> gpd.GeoDataFrame:
     """
     Create a fishnet grid over the events' extent and count points per cell.
-    Returns a GeoDataFrame with a 'count' field.
+    Returns a GeoDataFrame with 'id', 'col', 'row' and 'count' fields.
+
+    Cells belong to the global Web Mercator lattice anchored at the
+    projection origin, as in counts_to_grid, so gridding raw events and
+    their pre-aggregated counts gives the same cells; buffer_m is rounded
+    up to whole cells. Cell indices are computed arithmetically from the
+    projected coordinates and counted with a single bincount pass, so no
+    per-cell Python objects or spatial join are needed. With
+    cells='occupied' only non-empty cells and their queen neighbours are
+    materialized.
+
+    The grid layout is stored in ``gdf.attrs['grid']`` so lattice-aware code
+    can work from (row, col) indices instead of polygon topology.
     """
     if events_df.empty:
         raise ValueError("No events available to build grid")
-    pts = gpd.GeoDataFrame(events_df.copy(), geometry=gpd.points_from_xy(events_df[lon_field], events_df[lat_field]), crs=4326)
-    pts, _ = _ensure_metric_crs(pts)
-
-    xmin, ymin, xmax, ymax = pts.total_bounds
-    if buffer_m > 0:
-        xmin -= buffer_m
-        ymin -= buffer_m
-        xmax += buffer_m
-        ymax += buffer_m
-
-    cols = list(np.arange(xmin, xmax + cell_size_m, cell_size_m))
-    rows = list(np.arange(ymin, ymax + cell_size_m, cell_size_m))
-
-    polygons = []
-    for x in range(len(cols) - 1):
-        for y in range(len(rows) - 1):
-            poly = Polygon([(cols[x], rows[y]),
-                            (cols[x+1], rows[y]),
-                            (cols[x+1], rows[y+1]),
-                            (cols[x], rows[y+1])])
-            polygons.append(poly)
-    grid = gpd.GeoDataFrame({'id': np.arange(len(polygons))}, geometry=polygons, crs=pts.crs)
-
-    # Spatial join for counts
-    join = gpd.sjoin(pts, grid, predicate='within', how='left')
-    counts = join.groupby('id').size().rename('count').to_frame().reset_index()
-    grid = grid.merge(counts, on='id', how='left')
-    grid['count'] = grid['count'].fillna(0).astype(int)
+    x, y = _project_lonlat(events_df[lon_field].to_numpy(dtype=float),
+                           events_df[lat_field].to_numpy(dtype=float))
+    valid = np.isfinite(x) & np.isfinite(y)
+    x, y = x[valid], y[valid]
+    if x.size == 0:
+        raise ValueError("No events available to build grid")
+    ix = np.floor(x / cell_size_m).astype(np.int64)
+    iy = np.floor(y / cell_size_m).astype(np.int64)
+    return counts_to_grid(ix, iy, np.ones(len(ix)), cell_size_m=cell_size_m, buffer_m=buffer_m, cells=cells)
+
+
+def _grid_from_flat(
+    cols: np.ndarray,
+    rows: np.ndarray,
+    flat: np.ndarray,
+    cell_size_m: float,
+    cells: Literal['all', 'occupied'] = 'all',
+    weights: Optional[np.ndarray] = None,
+) -> gpd.GeoDataFrame:
+    """
+    Build the grid GeoDataFrame from flat cell indices (col * n_rows + row)
+    of points, or of pre-aggregated cells when ``weights`` holds their counts.
+    """
+    n_cols, n_rows = len(cols) - 1, len(rows) - 1
+
+    if cells == 'all':
+        ids = np.arange(n_cols * n_rows, dtype=np.int64)
+        counts = np.bincount(flat, weights=weights, minlength=n_cols * n_rows)
+    elif cells == 'occupied':
+        occupied, inverse = np.unique(flat, return_inverse=True)
+        occupied_counts = np.bincount(inverse, weights=weights, minlength=len(occupied))
+        occ_col, occ_row = occupied // n_rows, occupied % n_rows
+        neighbours = [occupied]
+        for dc in (-1, 0, 1):
+            for dr in (-1, 0, 1):
+                if dc == 0 and dr == 0:
+                    continue
+                nc, nr = occ_col + dc, occ_row + dr
+                inside = (nc >= 0) & (nc < n_cols) & (nr >= 0) & (nr < n_rows)
+                neighbours.append(nc[inside] * n_rows + nr[inside])
+        ids = np.unique(np.concatenate(neighbours))
+        counts = np.zeros(len(ids), dtype=np.int64)
+        counts[np.searchsorted(ids, occupied)] = occupied_counts
+    else:
+        raise ValueError(f"Unknown cells mode: {cells}")
+
+    grid_col, grid_row = ids // n_rows, ids % n_rows
+    grid = gpd.GeoDataFrame(
+        {'id': ids, 'col': grid_col, 'row': grid_row},
+        geometry=_grid_polygons(cols, rows, grid_col, grid_row),
+        crs=3857,
+    )
+    grid['count'] = np.rint(counts).astype(int)
+    grid.attrs['grid'] = {
+        'origin': (float(cols[0]), float(rows[0])),
+        'cell_size': float(cell_size_m),
+        'n_cols': int(n_cols),
+        'n_rows': int(n_rows),
+    }
     return grid
+
+
+def counts_to_grid(
+    ix: np.ndarray,
+    iy: np.ndarray,
+    counts: np.ndarray,
+    cell_size_m: float = 250.0,
+    buffer_m: float = 0.0,
+    cells: Literal['all', 'occupied'] = 'all',
+) -> gpd.GeoDataFrame:
+    """
+    Build the same grid as events_to_grid from pre-aggregated cell counts.
+
+    ``ix``/``iy`` index cells of the global Web Mercator lattice anchored at
+    the projection origin (floor(x / cell_size_m)); repeated cells are
+    summed. buffer_m is rounded up to whole cells.
+    """
+    ix = np.asarray(ix, dtype=np.int64)
+    iy = np.asarray(iy, dtype=np.int64)
+    counts = np.asarray(counts, dtype=float)
+    if ix.size == 0:
+        raise ValueError("No events available to build grid")
+    pad = int(np.ceil(buffer_m / cell_size_m)) if buffer_m > 0 else 0
+    col0, row0 = int(ix.min()) - pad, int(iy.min()) - pad
+    n_cols = int(ix.max()) + pad - col0 + 1
+    n_rows = int(iy.max()) + pad - row0 + 1
+    cols = (col0 + np.arange(n_cols + 1)) * float(cell_size_m)
+    rows = (row0 + np.arange(n_rows + 1)) * float(cell_size_m)
+    flat = (ix - col0) * n_rows + (iy - row0)
+    return _grid_from_flat(cols, rows, flat, cell_size_m, cells=cells, weights=counts)
+
+
+def bin_cells(lon: np.ndarray, lat: np.ndarray, cell_size_m: float,
+              weights: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Counts of WGS84 points per non-empty cell of the global lattice used by
+    counts_to_grid, or float sums of ``weights`` when given.
+    """
+    x, y = _project_lonlat(lon, lat)
+    ix = np.floor(x / cell_size_m).astype(np.int64)
+    iy = np.floor(y / cell_size_m).astype(np.int64)
+    values = np.ones(len(ix), dtype=np.int64) if weights is None else np.asarray(weights, dtype=float)
+    return _sum_cells(ix, iy, values)
+
+
+def coarsen_cells(ix: np.ndarray, iy: np.ndarray, counts: np.ndarray,
+                  factor: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Sum lattice cell counts into cells ``factor`` times larger (both lattices share the origin)."""
+    return _sum_cells(np.floor_divide(ix, factor), np.floor_divide(iy, factor), counts)
+
+
+def _sum_cells(ix: np.ndarray, iy: np.ndarray, counts: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    if len(ix) == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+    cells, inverse = np.unique(np.column_stack([ix, iy]), axis=0, return_inverse=True)
+    summed = np.bincount(inverse.ravel(), weights=counts, minlength=len(cells))
+    if np.issubdtype(np.asarray(counts).dtype, np.integer):
+        summed = np.rint(summed).astype(np.int64)
+    return cells[:, 0], cells[:, 1], summed
@@ -0,0 +1,56 @@
+# Kernel density surfaces on the global lattice: kernels and FFT smoothing
+import numpy as np
+from scipy.signal import fftconvolve
+
+from ..heatmap import GAUSSIAN_TRUNCATE
+
+
+def kernel_matrix(kernel: str, bandwidth_m: float, cell_size_m: float) -> np.ndarray:
+    """
+    Square kernel sampled at cell-centre offsets, normalised to sum 1 so the
+    smoothed raster keeps the total (weighted) event count.
+    """
+    h = bandwidth_m / cell_size_m
+    radius = int(np.ceil(GAUSSIAN_TRUNCATE * h if kernel == 'gaussian' else h))
+    offsets = np.arange(-radius, radius + 1, dtype=float)
+    d2 = offsets[:, None] ** 2 + offsets[None, :] ** 2
+    if kernel == 'gaussian':
+        k = np.exp(-0.5 * d2 / h ** 2)
+        k[d2 > (GAUSSIAN_TRUNCATE * h) ** 2] = 0.0
+    elif kernel == 'quartic':
+        k = np.clip(1.0 - d2 / h ** 2, 0.0, None) ** 2
+    else:
+        raise ValueError(f"Unknown kernel: {kernel}")
+    total = k.sum()
+    if total <= 0:
+        # Bandwidth well below the cell size: no smoothing
+        k = np.zeros_like(d2)
+        k[radius, radius] = 1.0
+        total = 1.0
+    return k / total
+
+
+def rasterize(ix: np.ndarray, iy: np.ndarray, values: np.ndarray, col0: int, row0: int,
+              n_cols: int, n_rows: int) -> np.ndarray:
+    """
+    Dense (n_rows, n_cols) raster of cell values, row 0 at ``row0`` (south);
+    cells outside the window are dropped.
+    """
+    col, row = ix - col0, iy - row0
+    keep = (col >= 0) & (col < n_cols) & (row >= 0) & (row < n_rows)
+    raster = np.zeros((n_rows, n_cols), dtype=float)
+    np.add.at(raster, (row[keep], col[keep]), np.asarray(values, dtype=float)[keep])
+    return raster
+
+
+def smooth(raster: np.ndarray, kernel: np.ndarray) -> np.ndarray:
+    """
+    Convolve via FFT: O(cells log cells) whatever the number of events or
+    the kernel width. Round-off below zero is clipped.
+    """
+    if not raster.any():
+        return np.zeros_like(raster)
+    out = fftconvolve(raster, kernel, mode='same')
+    # FFT noise leaves tiny non-zero values far from any event
+    out[out < raster.sum() * 1e-12] = 0.0
+    return out
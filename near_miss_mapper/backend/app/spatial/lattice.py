@@ -0,0 +1,138 @@
+# Neighbour structures for regular grids built by events_to_grid
+from typing import Literal, Optional, List, Tuple
+
+import numpy as np
+from scipy import sparse
+
+# Largest search radius (in cells) tried for KNN on partial grids
+MAX_KNN_RADIUS = 16
+
+
+def _offsets(radius: int) -> np.ndarray:
+    """All (dc, dr) offsets within a Chebyshev radius, excluding (0, 0), nearest first."""
+    r = np.arange(-radius, radius + 1)
+    dc, dr = np.meshgrid(r, r, indexing='ij')
+    offs = np.column_stack([dc.ravel(), dr.ravel()])
+    offs = offs[(offs[:, 0] != 0) | (offs[:, 1] != 0)]
+    dist2 = offs[:, 0] ** 2 + offs[:, 1] ** 2
+    # Deterministic order: distance, then row offset, then column offset
+    return offs[np.lexsort((offs[:, 0], offs[:, 1], dist2))]
+
+
+class _CellLookup:
+    """Map (col, row) lattice indices back to positions in the input arrays."""
+
+    def __init__(self, col: np.ndarray, row: np.ndarray, n_cols: int, n_rows: int):
+        self.n_cols = n_cols
+        self.n_rows = n_rows
+        self.col = col
+        self.row = row
+        keys = col * n_rows + row
+        self.order = np.argsort(keys, kind='stable')
+        self.sorted_keys = keys[self.order]
+        # Full grids in fishnet order need no search at all
+        self.dense = (len(keys) == n_cols * n_rows) and np.array_equal(keys, np.arange(len(keys)))
+
+    def neighbour(self, dc: int, dr: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (source positions, neighbour positions) for one offset."""
+        nc, nr = self.col + dc, self.row + dr
+        inside = (nc >= 0) & (nc < self.n_cols) & (nr >= 0) & (nr < self.n_rows)
+        src = np.nonzero(inside)[0]
+        keys = nc[inside] * self.n_rows + nr[inside]
+        if self.dense:
+            return src, keys
+        pos = np.searchsorted(self.sorted_keys, keys)
+        pos_c = np.minimum(pos, len(self.sorted_keys) - 1)
+        found = self.sorted_keys[pos_c] == keys
+        return src[found], self.order[pos_c[found]]
+
+
+def _from_offsets(lookup: _CellLookup, offsets: np.ndarray, values: np.ndarray, n: int) -> sparse.csr_matrix:
+    rows: List[np.ndarray] = []
+    cols: List[np.ndarray] = []
+    data: List[np.ndarray] = []
+    for (dc, dr), v in zip(offsets, values):
+        src, dst = lookup.neighbour(int(dc), int(dr))
+        rows.append(src)
+        cols.append(dst)
+        data.append(np.full(len(src), v, dtype=float))
+    if not rows:
+        return sparse.csr_matrix((n, n), dtype=float)
+    return sparse.csr_matrix(
+        (np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(n, n),
+    )
+
+
+def _knn(lookup: _CellLookup, k: int, n: int) -> Optional[sparse.csr_matrix]:
+    radius = max(1, int(np.ceil(np.sqrt(k + 1))))
+    # Beyond this radius every cell of the grid is in reach
+    full_radius = int(np.ceil(np.hypot(lookup.n_cols, lookup.n_rows)))
+    max_radius = min(MAX_KNN_RADIUS, full_radius)
+    while True:
+        # Only offsets within the Euclidean radius: the corners of the square
+        # are farther away than cells just outside it
+        offsets = _offsets(radius)
+        offsets = offsets[offsets[:, 0] ** 2 + offsets[:, 1] ** 2 <= radius ** 2]
+        taken = np.zeros(n, dtype=np.int64)
+        rows: List[np.ndarray] = []
+        cols: List[np.ndarray] = []
+        for dc, dr in offsets:
+            src, dst = lookup.neighbour(int(dc), int(dr))
+            keep = taken[src] < k
+            src, dst = src[keep], dst[keep]
+            taken[src] += 1
+            rows.append(src)
+            cols.append(dst)
+        # Every cell has k neighbours, or the search already covers the whole grid
+        if (taken >= min(k, n - 1)).all() or radius >= full_radius:
+            break
+        if radius >= max_radius:
+            return None
+        radius = min(radius * 2, max_radius)
+    r = np.concatenate(rows)
+    c = np.concatenate(cols)
+    return sparse.csr_matrix((np.ones(len(r)), (r, c)), shape=(n, n))
+
+
+def lattice_weights(
+    col: np.ndarray,
+    row: np.ndarray,
+    n_cols: int,
+    n_rows: int,
+    cell_size: float,
+    method: Literal['queen', 'rook', 'knn', 'distance_band'],
+    k: int = 8,
+    distance_band: Optional[float] = None,
+) -> Optional[sparse.csr_matrix]:
+    """
+    Build an (unstandardized) neighbour matrix for grid cells from their
+    (col, row) indices, without touching geometries.
+
+    Matches the libpysal builders used on the fishnet polygons: queen/rook
+    are binary contiguity, knn is binary on cell centres and distance_band
+    uses inverse-distance weights within the threshold (metres).
+    Returns None when a KNN neighbourhood cannot be resolved locally.
+    """
+    col = np.asarray(col, dtype=np.int64)
+    row = np.asarray(row, dtype=np.int64)
+    n = len(col)
+    lookup = _CellLookup(col, row, int(n_cols), int(n_rows))
+
+    if method == 'queen':
+        offsets = _offsets(1)
+        return _from_offsets(lookup, offsets, np.ones(len(offsets)), n)
+    if method == 'rook':
+        offsets = np.array([(0, -1), (-1, 0), (1, 0), (0, 1)])
+        return _from_offsets(lookup, offsets, np.ones(len(offsets)), n)
+    if method == 'knn':
+        return _knn(lookup, k, n)
+    if method == 'distance_band':
+        if distance_band is None:
+            raise ValueError("distance_band (meters) is required for distance_band method")
+        radius = int(np.floor(distance_band / cell_size))
+        offsets = _offsets(radius) if radius > 0 else np.empty((0, 2), dtype=np.int64)
+        dist = cell_size * np.hypot(offsets[:, 0], offsets[:, 1])
+        inside = dist <= distance_band
+        return _from_offsets(lookup, offsets[inside], 1.0 / dist[inside], n)
+    raise ValueError(f"Unknown neighborhood method: {method}")
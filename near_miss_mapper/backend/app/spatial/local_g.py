@@ -0,0 +1,173 @@
+# Sparse-matrix Getis-Ord Gi* kernel with conditional permutation inference
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple
+
+import numpy as np
+from scipy import sparse
+
+# Target number of float64 values materialized per permutation block (~32 MB)
+BLOCK_ELEMENTS = 4_000_000
+# Simulated values within this relative distance of the observed one count as ties
+TIE_RTOL = 1e-9
+
+# Per-process state for permutation workers, set once by _init_worker
+_worker_state: dict = {}
+
+
+def star_weights(w: sparse.spmatrix) -> sparse.csr_matrix:
+    """
+    Gi* weights as esda.G_Local(star=True, transform='R') builds them: the
+    self-weight is set to the row's largest neighbour weight and every row
+    is then standardized to sum to one. Islands keep an all-zero row.
+    """
+    w = sparse.csr_matrix(w, dtype=float, copy=True)
+    w.setdiag(0)
+    w.eliminate_zeros()
+    row_max = np.asarray(w.max(axis=1).todense()).ravel()
+    w = (w + sparse.diags(row_max)).tocsr()
+    w.eliminate_zeros()
+    row_sum = np.asarray(w.sum(axis=1)).ravel()
+    scale = np.divide(1.0, row_sum, out=np.zeros_like(row_sum), where=row_sum > 0)
+    return sparse.diags(scale) @ w
+
+
+def analytic_gi_star(y: np.ndarray, w: sparse.csr_matrix) -> Tuple[np.ndarray, np.ndarray]:
+    """Return (Gs, Zs) for star weights ``w`` under the normality assumption."""
+    n = len(y)
+    y_sum = y.sum()
+    gs = (w @ y) / y_sum
+    mean = y_sum / n
+    variance = (y ** 2).sum() / n - mean ** 2
+    cardinality = np.asarray(w.sum(axis=1)).ravel()
+    expected = cardinality / n
+    expected_var = cardinality * (n - cardinality) / (n - 1) / n ** 2 * variance / mean ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        zs = (gs - expected) / np.sqrt(expected_var)
+    return gs, zs
+
+
+def permutation_ids(max_card: int, n: int, permutations: int, seed: Optional[int] = None) -> np.ndarray:
+    """
+    Draw ``permutations`` sets of ``max_card`` distinct ids out of n - 1.
+
+    As in esda's conditional randomization the same draws are shared by all
+    observations; id j >= i is shifted by one for observation i so that the
+    focal value itself is never drawn.
+    """
+    rng = np.random.default_rng(seed)
+    size = min(max_card, n - 1)
+    ids = np.zeros((permutations, max(max_card, 1)), dtype=np.int64)
+    for p in range(permutations):
+        ids[p, :size] = rng.choice(n - 1, size=size, replace=False)
+    return ids
+
+
+def _init_worker(y, perm_ids, indptr, indices, data, self_weights, observed):
+    _worker_state.update(
+        y=y, perm_ids=perm_ids, indptr=indptr, indices=indices,
+        data=data, self_weights=self_weights, observed=observed,
+    )
+
+
+def _block_p_values(start: int, stop: int) -> np.ndarray:
+    s = _worker_state
+    return _conditional_p(
+        s['y'], s['perm_ids'], s['indptr'], s['indices'], s['data'],
+        s['self_weights'], s['observed'], start, stop,
+    )
+
+
+def _conditional_p(y, perm_ids, indptr, indices, data, self_weights, observed,
+                   start: int, stop: int) -> np.ndarray:
+    """Folded one-sided pseudo p-values for observations [start, stop)."""
+    permutations = perm_ids.shape[0]
+    card = np.diff(indptr[start:stop + 1])
+    k_max = max(int(card.max()) if len(card) else 0, 1)
+    perm = perm_ids[:, :k_max]
+    y_sum = y.sum()
+    block = max(1, BLOCK_ELEMENTS // (permutations * k_max))
+    out = np.empty(stop - start)
+
+    for b0 in range(start, stop, block):
+        b1 = min(b0 + block, stop)
+        focal = np.arange(b0, b1)
+        # Neighbour weights padded to k_max; padding has weight zero
+        weights = np.zeros((b1 - b0, k_max))
+        lo, hi = indptr[b0], indptr[b1]
+        block_card = np.diff(indptr[b0:b1 + 1])
+        owner = np.repeat(np.arange(b1 - b0), block_card)
+        slot = np.arange(hi - lo) - np.repeat(indptr[b0:b1] - lo, block_card)
+        weights[owner, slot] = data[lo:hi]
+        draws = perm[None, :, :] + (perm[None, :, :] >= focal[:, None, None])
+        sims = np.matmul(y[draws], weights[:, :, None])[:, :, 0]
+        sims += (self_weights[b0:b1] * y[b0:b1])[:, None]
+        sims /= y_sum
+        # Ties are common with count data but the sums here run in another
+        # order than w @ y, so compare with a relative tolerance
+        threshold = observed[b0:b1] - TIE_RTOL * np.abs(observed[b0:b1])
+        larger = (sims >= threshold[:, None]).sum(axis=1)
+        low = (permutations - larger) < larger
+        larger[low] = permutations - larger[low]
+        out[b0 - start:b1 - start] = (larger + 1.0) / (permutations + 1.0)
+    return out
+
+
+def permutation_p_values(
+    y: np.ndarray,
+    w: sparse.csr_matrix,
+    observed: np.ndarray,
+    permutations: int = 999,
+    n_jobs: int = 1,
+    seed: Optional[int] = None,
+) -> np.ndarray:
+    """
+    Conditional-permutation pseudo p-values for Gi* (esda's p_sim).
+
+    Observations are processed in batched NumPy blocks; with n_jobs > 1
+    (or -1 for all CPUs) the blocks are spread across a process pool. The
+    permutation draws are made up front, so a fixed seed gives the same
+    result for any n_jobs.
+    """
+    n = len(y)
+    self_weights = w.diagonal()
+    others = sparse.csr_matrix(w, copy=True)
+    others.setdiag(0)
+    others.eliminate_zeros()
+    others.sort_indices()
+    max_card = int(np.diff(others.indptr).max()) if n else 0
+    perm_ids = permutation_ids(max_card, n, permutations, seed)
+    args = (y, perm_ids, others.indptr, others.indices, others.data, self_weights, observed)
+
+    if n_jobs == -1:
+        n_jobs = os.cpu_count() or 1
+    n_jobs = max(1, min(n_jobs, n))
+    if n_jobs == 1:
+        return _conditional_p(*args, 0, n)
+
+    bounds = np.linspace(0, n, n_jobs * 4 + 1).astype(int)
+    chunks = [(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=args) as pool:
+        parts = pool.map(_block_p_values, *zip(*chunks))
+        return np.concatenate(list(parts))
+
+
+def local_gi_star(
+    y: np.ndarray,
+    w: sparse.spmatrix,
+    permutations: int = 999,
+    n_jobs: int = 1,
+    seed: Optional[int] = None,
+) -> Tuple[np.ndarray, np.ndarray, Optional[np.ndarray]]:
+    """
+    Compute Gi* for values ``y`` with neighbour matrix ``w`` (any scaling,
+    no self-weights). Returns (Gs, Zs, p_sim); p_sim is None when
+    permutations is 0.
+    """
+    y = np.asarray(y, dtype=float)
+    w_star = star_weights(w)
+    gs, zs = analytic_gi_star(y, w_star)
+    p_sim = None
+    if permutations:
+        p_sim = permutation_p_values(y, w_star, gs, permutations, n_jobs=n_jobs, seed=seed)
+    return gs, zs, p_sim
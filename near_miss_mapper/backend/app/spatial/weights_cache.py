@@ -0,0 +1,86 @@
+# Cache of spatial neighbour matrices shared by Gi* and Moran's I
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from typing import Callable, Optional
+
+import numpy as np
+import geopandas as gpd
+import shapely
+from scipy import sparse
+
+
+def weights_key(gdf: gpd.GeoDataFrame,
+                method: str,
+                k: int = 8,
+                distance_band: Optional[float] = None,
+                use_centroids: bool = False) -> str:
+    """
+    Signature of the neighbour structure for ``gdf``: the grid layout and
+    cell indices for lattices from events_to_grid, the geometries otherwise,
+    plus only the neighbourhood parameters that affect ``method``.
+    """
+    h = hashlib.sha256()
+    grid = gdf.attrs.get('grid')
+    if grid and 'col' in gdf.columns and 'row' in gdf.columns:
+        h.update(json.dumps(grid, sort_keys=True).encode('utf-8'))
+        h.update(np.ascontiguousarray(gdf['col'].to_numpy(dtype=np.int64)).tobytes())
+        h.update(np.ascontiguousarray(gdf['row'].to_numpy(dtype=np.int64)).tobytes())
+    else:
+        h.update(str(gdf.crs).encode('utf-8'))
+        for wkb in shapely.to_wkb(gdf.geometry.values):
+            h.update(wkb)
+        h.update(b'centroids' if use_centroids else b'geoms')
+    h.update(method.encode('utf-8'))
+    if method == 'knn':
+        h.update(f"k={k}".encode('utf-8'))
+    elif method == 'distance_band':
+        h.update(f"d={distance_band!r}".encode('utf-8'))
+    return h.hexdigest()
+
+
+class WeightsCache:
+    """
+    Small in-process LRU of CSR neighbour matrices, persisted as
+    ``<cache_dir>/<key>.npz`` so analysis workers reuse them across
+    requests and restarts.
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None, max_entries: int = 16):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, sparse.csr_matrix]" = OrderedDict()
+
+    def _path(self, key: str) -> Optional[str]:
+        return os.path.join(self.cache_dir, f"{key}.npz") if self.cache_dir else None
+
+    def get_or_build(self, key: str, build: Callable[[], sparse.spmatrix]) -> sparse.csr_matrix:
+        w = self._entries.get(key)
+        if w is not None:
+            self._entries.move_to_end(key)
+            return w
+        path = self._path(key)
+        if path and os.path.exists(path):
+            try:
+                w = sparse.load_npz(path).tocsr()
+            except (OSError, ValueError):
+                w = None
+        if w is None:
+            w = sparse.csr_matrix(build())
+            if path:
+                self._save(path, w)
+        self._entries[key] = w
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return w
+
+    def _save(self, path: str, w: sparse.csr_matrix) -> None:
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write then rename so concurrent workers never read a partial file
+            tmp_path = f"{path[:-len('.npz')]}.{os.getpid()}.tmp.npz"
+            sparse.save_npz(tmp_path, w, compressed=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Weights cache write warning: {e}")
@@ -0,0 +1,267 @@
+# Vector tiles (MVT) for the events layer and the latest Gi* grid
+import asyncio
+import glob
+import hashlib
+import math
+import os
+import re
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from app import aggregates, clusters, mvt
+from app.geo import mercator_lonlat, mercator_xy, tile_bounds
+from app.db import build_event_query
+
+TILE_EXTENT = 4096
+TILE_BUFFER = 64
+MAX_TILE_ZOOM = 24
+# Must divide 256 so cluster cells never straddle tile edges
+TILE_CLUSTER_PX = 64
+# Below this zoom a tile spans so much of the globe that clustering its raw
+# events reads most of the collection; its clusters are summed from the
+# coarsest per-cell aggregates instead (counts only) when they are ready
+AGGREGATE_TILE_MAX_ZOOM = 5
+TILE_CACHE_MAX_ENTRIES = int(os.getenv("TILE_CACHE_MAX_ENTRIES", "1024"))
+
+CONTENT_TYPE = "application/vnd.mapbox-vector-tile"
+
+
+def valid_tile(z: int, x: int, y: int) -> bool:
+    return 0 <= z <= MAX_TILE_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def _tile_query(z: int, x: int, y: int) -> Dict[str, Any]:
+    """Event query covering the tile."""
+    minx, miny, maxx, maxy = tile_bounds(z, x, y)
+    min_lon, min_lat = mercator_lonlat(minx, miny)
+    max_lon, max_lat = mercator_lonlat(maxx, maxy)
+    return build_event_query({"bbox": [min_lon, min_lat, max_lon, max_lat]})
+
+
+def _to_tile(mx: np.ndarray, my: np.ndarray, bounds: Tuple[float, float, float, float]) -> Tuple[np.ndarray, np.ndarray]:
+    minx, _, maxx, maxy = bounds
+    scale = TILE_EXTENT / (maxx - minx)
+    px = np.floor((np.asarray(mx) - minx) * scale).astype(np.int64)
+    py = np.floor((maxy - np.asarray(my)) * scale).astype(np.int64)
+    return px, py
+
+
+def _in_tile(px: np.ndarray, py: np.ndarray) -> np.ndarray:
+    return (px >= 0) & (px < TILE_EXTENT) & (py >= 0) & (py < TILE_EXTENT)
+
+
+def _clean(value: Any) -> Any:
+    # NaN cannot be a property value (and never equals itself as a dict key)
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+
+async def _aggregate_clusters(collection, bounds: Tuple[float, float, float, float]) -> List[mvt.Feature]:
+    """Quarter-tile clusters of the coarsest aggregate cells, at their count-weighted centre."""
+    size = max(aggregates.AGGREGATE_CELL_SIZES)
+    minx, miny, maxx, maxy = bounds
+    cell_range = (math.floor(minx / size), math.floor(miny / size),
+                  math.ceil(maxx / size) - 1, math.ceil(maxy / size) - 1)
+    ix, iy, counts = await aggregates.load_cell_counts(collection, size, {}, cell_range=cell_range)
+    # Cells straddling the tile (or world) edge count towards the nearest cluster inside
+    px, py = _to_tile((ix + 0.5) * size, (iy + 0.5) * size, bounds)
+    px, py = np.clip(px, 0, TILE_EXTENT - 1), np.clip(py, 0, TILE_EXTENT - 1)
+    span = TILE_EXTENT * TILE_CLUSTER_PX // 256
+    groups, owner = np.unique((py // span) * (TILE_EXTENT // span) + px // span, return_inverse=True)
+    owner = owner.ravel()
+    total = np.bincount(owner, weights=counts, minlength=len(groups))
+    cx = np.bincount(owner, weights=counts * px, minlength=len(groups)) / total
+    cy = np.bincount(owner, weights=counts * py, minlength=len(groups)) / total
+    return [
+        (mvt.POINT, mvt.point(int(cx[i]), int(cy[i])), {"count": int(total[i]), "max_severity": None, "id": None}, None)
+        for i in range(len(groups))
+    ]
+
+
+async def render_events_tile(collection, z: int, x: int, y: int, aggregates_collection=None) -> bytes:
+    """
+    Events layer: clusters on a quarter-tile grid (count, max_severity, id
+    for singletons) below CLUSTER_MAX_ZOOM, individual events above it.
+    Below AGGREGATE_TILE_MAX_ZOOM the clusters come from
+    ``aggregates_collection`` when given, without max_severity or id.
+    """
+    bounds = tile_bounds(z, x, y)
+    query = _tile_query(z, x, y)
+    features: List[mvt.Feature] = []
+    if z < AGGREGATE_TILE_MAX_ZOOM and aggregates_collection is not None:
+        features = await _aggregate_clusters(aggregates_collection, bounds)
+    elif z < clusters.CLUSTER_MAX_ZOOM:
+        result = await clusters.load_clusters(collection, query, z, radius_px=TILE_CLUSTER_PX)
+        rows = result["clusters"]
+        mx, my = mercator_xy([c["lon"] for c in rows], [c["lat"] for c in rows])
+        px, py = _to_tile(mx, my, bounds)
+        for i in np.flatnonzero(_in_tile(px, py)):
+            c = rows[i]
+            props = {"count": int(c["count"]), "max_severity": c["max_severity"], "id": c.get("id")}
+            features.append((mvt.POINT, mvt.point(int(px[i]), int(py[i])), props, None))
+    else:
+        result = await clusters.load_viewport_events(collection, query, z)
+        docs = result["events"]
+        coords = [(doc.get("location") or {}).get("coordinates") or [np.nan, np.nan] for doc in docs]
+        mx, my = mercator_xy([c[0] for c in coords], [c[1] for c in coords])
+        px, py = _to_tile(mx, my, bounds)
+        for i in np.flatnonzero(_in_tile(px, py)):
+            doc = docs[i]
+            timestamp = doc.get("timestamp")
+            props = {
+                "id": str(doc["_id"]),
+                "severity": doc.get("severity"),
+                "incident_type": doc.get("incident_type"),
+                "status": doc.get("status"),
+                "timestamp": timestamp.isoformat() if hasattr(timestamp, "isoformat") else timestamp,
+            }
+            features.append((mvt.POINT, mvt.point(int(px[i]), int(py[i])), props, None))
+    return mvt.encode_tile([mvt.encode_layer("events", features, TILE_EXTENT)])
+
+
+def load_grid_cells(path: str) -> Dict[str, np.ndarray]:
+    """
+    Read a Gi* output into per-cell Web Mercator bounds and attributes.
+    Runs in an analysis worker so the web process never imports geopandas.
+    """
+    import geopandas as gpd
+
+    if path.endswith(".arrow"):
+        gdf = gpd.read_feather(path)
+    elif path.endswith(".parquet"):
+        gdf = gpd.read_parquet(path)
+    else:
+        gdf = gpd.read_file(path)
+    b = gdf.geometry.bounds
+    if gdf.crs is not None and gdf.crs.to_epsg() == 3857:
+        minx, miny = b["minx"].to_numpy(), b["miny"].to_numpy()
+        maxx, maxy = b["maxx"].to_numpy(), b["maxy"].to_numpy()
+    else:
+        if gdf.crs is not None:
+            b = gdf.geometry.to_crs(4326).bounds
+        # Cells are axis-aligned in EPSG:3857, so projecting the bounds is exact
+        minx, miny = mercator_xy(b["minx"].to_numpy(), b["miny"].to_numpy())
+        maxx, maxy = mercator_xy(b["maxx"].to_numpy(), b["maxy"].to_numpy())
+    # Shapefile field names are truncated to 10 characters
+    significance = gdf["significance"] if "significance" in gdf.columns else gdf["significan"]
+    return {
+        "minx": minx, "miny": miny, "maxx": maxx, "maxy": maxy,
+        "count": gdf["count"].to_numpy(dtype=np.int64),
+        "z_score": gdf["z_score"].to_numpy(dtype=float),
+        "p_value": gdf["p_value"].to_numpy(dtype=float),
+        "significance": significance.astype(str).to_numpy(),
+    }
+
+
+def render_grid_tile(cells: Dict[str, np.ndarray], z: int, x: int, y: int) -> bytes:
+    """Gi* layer: one clipped rectangle per grid cell touching the tile."""
+    bounds = tile_bounds(z, x, y)
+    x0, y1 = _to_tile(cells["minx"], cells["miny"], bounds)
+    x1, y0 = _to_tile(cells["maxx"], cells["maxy"], bounds)
+    lo, hi = -TILE_BUFFER, TILE_EXTENT + TILE_BUFFER
+    x0, x1 = np.clip(x0, lo, hi), np.clip(x1, lo, hi)
+    y0, y1 = np.clip(y0, lo, hi), np.clip(y1, lo, hi)
+    features: List[mvt.Feature] = []
+    for i in np.flatnonzero((x1 > x0) & (y1 > y0)):
+        props = {
+            "z_score": _clean(float(cells["z_score"][i])),
+            "p_value": _clean(float(cells["p_value"][i])),
+            "significance": str(cells["significance"][i]),
+            "count": int(cells["count"][i]),
+        }
+        geometry = mvt.rectangle(int(x0[i]), int(y0[i]), int(x1[i]), int(y1[i]))
+        features.append((mvt.POLYGON, geometry, props, None))
+    return mvt.encode_tile([mvt.encode_layer("gi_star", features, TILE_EXTENT)])
+
+
+class GridLayer:
+    """
+    The most recent Gi* output: set explicitly as analyses complete, or
+    the newest output file on disk after a restart. Its cells are loaded
+    once per output and kept in memory.
+    """
+
+    # Preferred order when one analysis wrote several formats
+    EXTENSIONS = (".arrow", ".parquet", ".shp")
+    # Single-resolution Gi* outputs (gi_star_<key> or the timestamped
+    # default), not gi_star_pyramid_* levels
+    NAME = r"gi_star_(?:[0-9a-f]{16}|\d{8}_\d{6})"
+
+    def __init__(self, out_dir: str, name: str = NAME):
+        self.out_dir = out_dir
+        self._name = re.compile(name)
+        self.path: Optional[str] = None
+        self._cells: Optional[Tuple[str, Dict[str, np.ndarray]]] = None
+        self._lock = asyncio.Lock()
+
+    def set_latest(self, outputs: Dict[str, str]) -> None:
+        """Record a finished analysis from its {format: path} outputs."""
+        for ext in self.EXTENSIONS:
+            for path in outputs.values():
+                if path and path.endswith(ext):
+                    self.path = path
+                    return
+
+    def _current_path(self) -> Optional[str]:
+        if self.path and os.path.exists(self.path):
+            return self.path
+        candidates = [
+            path for ext in self.EXTENSIONS
+            for path in glob.glob(os.path.join(self.out_dir, f"*{ext}"))
+            if self._name.fullmatch(os.path.basename(path)[:-len(ext)])
+        ]
+        if not candidates:
+            return None
+        # Newest output; among one analysis' files prefer the mmap-friendly format
+        return max(candidates, key=lambda p: (os.path.getmtime(p), -self.EXTENSIONS.index(os.path.splitext(p)[1])))
+
+    def version(self) -> Optional[str]:
+        path = self._current_path()
+        if path is None:
+            return None
+        return f"{os.path.basename(path)}:{os.stat(path).st_mtime_ns}"
+
+    async def cells(self, load: Callable[[str], Awaitable[Dict[str, np.ndarray]]]) -> Optional[Dict[str, np.ndarray]]:
+        async with self._lock:
+            version = self.version()
+            if version is None:
+                return None
+            if self._cells is None or self._cells[0] != version:
+                self._cells = (version, await load(self._current_path()))
+            return self._cells[1]
+
+
+def tile_etag(layer: str, z: int, x: int, y: int, version: str) -> str:
+    digest = hashlib.sha1(f"{layer}/{z}/{x}/{y}@{version}".encode("utf-8")).hexdigest()
+    return f'"{digest}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    # Weak comparison, as If-None-Match requires
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or etag in [t[2:] if t.startswith("W/") else t for t in tags]
+
+
+class TileCache:
+    """LRU of encoded tiles keyed by ETag (layer, tile and data version)."""
+
+    def __init__(self, max_entries: int = TILE_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+
+    def get(self, etag: str) -> Optional[bytes]:
+        data = self._entries.get(etag)
+        if data is not None:
+            self._entries.move_to_end(etag)
+        return data
+
+    def put(self, etag: str, data: bytes) -> None:
+        self._entries[etag] = data
+        self._entries.move_to_end(etag)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
@@ -0,0 +1,236 @@
+"""
+Benchmarks for the spatial pipeline on synthetic clustered events.
+
+Times each stage of a Gi* analysis separately (gridding, neighbour
+weights per method, Gi* with permutations, FDR, Moran's I and each output
+writer) and records wall time plus the tracemalloc peak of every stage.
+Results are written as JSON so runs before and after a change can be
+compared:
+
+    cd backend
+    python -m benchmarks.bench_spatial --sizes 10000,100000 --out before.json
+    # ... change something ...
+    python -m benchmarks.bench_spatial --sizes 10000,100000 --out after.json --compare before.json
+
+Sizes up to 10M events are supported (``--sizes 10000000``); the grid,
+not the event count, drives most stages, so vary ``--extents-km`` and
+``--cell-sizes`` as well.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import tracemalloc
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app.geo import EARTH_RADIUS_M  # noqa: E402
+from app.metrics import StageTimer  # noqa: E402
+from app.spatial.gi_star import (  # noqa: E402
+    _classify_hot_cold, _fdr_correction, _weights_matrix, events_to_grid,
+    save_as_arrow, save_as_geoparquet, save_as_shapefile,
+)
+from app.spatial.local_g import local_gi_star  # noqa: E402
+
+METHODS = ['queen', 'rook', 'knn', 'distance_band']
+WRITERS = {
+    'parquet': save_as_geoparquet,
+    'arrow': save_as_arrow,
+    'shapefile': save_as_shapefile,
+}
+
+
+def clustered_events(n: int, extent_km: float, n_clusters: int = 50, cluster_sd_m: float = 150.0,
+                     background: float = 0.3, center=(-0.1, 51.5), seed: int = 0) -> pd.DataFrame:
+    """
+    Thomas-process points: ``background`` share uniform over a square of
+    ``extent_km`` around ``center``, the rest Gaussian around cluster
+    centres with Zipf-like weights, so a few hotspots dominate.
+    """
+    rng = np.random.default_rng(seed)
+    half = extent_km * 500.0
+    n_background = int(n * background)
+    n_clustered = n - n_background
+    centres = rng.uniform(-half, half, size=(n_clusters, 2))
+    weights = 1.0 / np.arange(1, n_clusters + 1)
+    members = rng.choice(n_clusters, size=n_clustered, p=weights / weights.sum())
+    xy = np.concatenate([
+        rng.uniform(-half, half, size=(n_background, 2)),
+        centres[members] + rng.normal(0.0, cluster_sd_m, size=(n_clustered, 2)),
+    ])
+    xy = np.clip(xy, -half, half)
+    # Metres around the centre to lon/lat (local equirectangular approximation)
+    lat0 = np.radians(center[1])
+    lon = center[0] + np.degrees(xy[:, 0] / (EARTH_RADIUS_M * np.cos(lat0)))
+    lat = center[1] + np.degrees(xy[:, 1] / EARTH_RADIUS_M)
+    return pd.DataFrame({'lon': lon, 'lat': lat})
+
+
+def run_case(n_events: int, extent_km: float, cell_size_m: float, args: argparse.Namespace,
+             out_dir: str) -> Dict[str, Any]:
+    events = clustered_events(n_events, extent_km, seed=args.seed)
+    # Trace once for the whole case: StageTimer then only resets the peak per stage
+    tracing = not args.no_memory and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    try:
+        best, n_cells = _repeat_case(events, cell_size_m, args, out_dir, n_events)
+    finally:
+        if tracing:
+            tracemalloc.stop()
+
+    return {
+        'n_events': n_events,
+        'extent_km': extent_km,
+        'cell_size_m': cell_size_m,
+        'n_cells': n_cells,
+        'stages': best,
+        'total_seconds': round(sum(r['seconds'] for r in best.values()), 6),
+    }
+
+
+def _repeat_case(events: pd.DataFrame, cell_size_m: float, args: argparse.Namespace, out_dir: str,
+                 n_events: int) -> Tuple[Dict[str, Dict[str, float]], int]:
+    """(fastest record per stage, number of grid cells) over ``args.repeat`` runs."""
+    best: Optional[Dict[str, Dict[str, float]]] = None
+    n_cells = 0
+    for _ in range(args.repeat):
+        timer = StageTimer(trace_memory=not args.no_memory)
+        with timer.stage('events_to_grid'):
+            grid = events_to_grid(events, lon_field='lon', lat_field='lat', cell_size_m=cell_size_m)
+        n_cells = len(grid)
+        y = grid['count'].to_numpy(dtype=float)
+
+        matrices = {}
+        for method in args.methods:
+            with timer.stage(f'weights_{method}'):
+                matrices[method] = _weights_matrix(grid, method, k=args.k, distance_band=2 * cell_size_m)
+
+        sp = matrices.get(args.gi_method)
+        if sp is None:
+            sp = _weights_matrix(grid, args.gi_method, k=args.k, distance_band=2 * cell_size_m)
+        with timer.stage('gi_star'):
+            _, z, p_sim = local_gi_star(y, sp, permutations=args.permutations, n_jobs=args.n_jobs, seed=args.seed)
+        p = p_sim if p_sim is not None else np.full(len(y), 0.5)
+        with timer.stage('fdr'):
+            _fdr_correction(p)
+        with timer.stage('classify'):
+            labels = _classify_hot_cold(z)
+
+        if not args.skip_moran:
+            from esda.moran import Moran
+            from libpysal.graph import Graph
+            queen = matrices.get('queen')
+            if queen is None:
+                queen = _weights_matrix(grid, 'queen')
+            with timer.stage('moran'):
+                Moran(y, Graph.from_sparse(queen).transform('r'), two_tailed=True, permutations=args.permutations)
+
+        out = grid.assign(gi_star=z, z_score=z, p_value=p, fdr_significant=p <= 0.05, significance=labels)
+        for fmt in args.writers:
+            with timer.stage(f'write_{fmt}'):
+                WRITERS[fmt](out, out_dir, f"bench_{n_events}_{int(cell_size_m)}")
+
+        if best is None:
+            best = timer.stages
+        else:
+            # Keep the fastest repetition per stage
+            for name, record in timer.stages.items():
+                if record['seconds'] < best[name]['seconds']:
+                    best[name] = record
+    return best, n_cells
+
+
+def _case_key(case: Dict[str, Any]) -> tuple:
+    return case['n_events'], case['extent_km'], case['cell_size_m']
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]) -> List[str]:
+    """Per-stage time ratios (current / baseline) for cases present in both runs."""
+    base_cases = {_case_key(c): c for c in baseline.get('cases', [])}
+    lines = []
+    for case in current['cases']:
+        base = base_cases.get(_case_key(case))
+        if base is None:
+            continue
+        lines.append(f"n={case['n_events']} extent={case['extent_km']}km cell={case['cell_size_m']}m")
+        for name, record in case['stages'].items():
+            before = base['stages'].get(name)
+            if not before:
+                continue
+            ratio = record['seconds'] / before['seconds'] if before['seconds'] else float('inf')
+            lines.append(f"  {name:<24} {before['seconds']:>10.4f}s -> {record['seconds']:>10.4f}s  x{ratio:.2f}")
+    return lines
+
+
+def _floats(value: str) -> List[float]:
+    return [float(v) for v in value.split(',') if v.strip()]
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=lambda v: [int(x) for x in _floats(v)], default=[10_000, 100_000],
+                        help='comma-separated event counts (10k to 10M)')
+    parser.add_argument('--extents-km', type=_floats, default=[10.0], help='side of the square extent in km')
+    parser.add_argument('--cell-sizes', type=_floats, default=[250.0], help='grid cell sizes in metres')
+    parser.add_argument('--methods', type=lambda v: v.split(','), default=METHODS)
+    parser.add_argument('--gi-method', default='queen', choices=METHODS)
+    parser.add_argument('--k', type=int, default=8)
+    parser.add_argument('--permutations', type=int, default=999)
+    parser.add_argument('--n-jobs', type=int, default=1)
+    parser.add_argument('--writers', type=lambda v: [w for w in v.split(',') if w], default=['parquet', 'arrow'],
+                        help='output writers to time: parquet, arrow, shapefile')
+    parser.add_argument('--skip-moran', action='store_true')
+    parser.add_argument('--no-memory', action='store_true', help='skip tracemalloc (it slows allocation-heavy stages)')
+    parser.add_argument('--repeat', type=int, default=1, help='repetitions per case; the fastest is kept')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default=None, help='JSON results path (default: benchmarks/results/<timestamp>.json)')
+    parser.add_argument('--compare', default=None, help='baseline JSON to compare against')
+    args = parser.parse_args(argv)
+
+    results: Dict[str, Any] = {
+        'meta': {
+            'created_at': datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'args': {k: v for k, v in vars(args).items() if k not in ('out', 'compare')},
+        },
+        'cases': [],
+    }
+    with tempfile.TemporaryDirectory() as out_dir:
+        for n_events in args.sizes:
+            for extent_km in args.extents_km:
+                for cell_size_m in args.cell_sizes:
+                    case = run_case(n_events, extent_km, cell_size_m, args, out_dir)
+                    results['cases'].append(case)
+                    print(f"n={n_events} extent={extent_km}km cell={cell_size_m}m cells={case['n_cells']} "
+                          f"total={case['total_seconds']:.3f}s")
+                    for name, record in case['stages'].items():
+                        peak = f"  peak={record['peak_mb']:.1f}MB" if 'peak_mb' in record else ''
+                        print(f"  {name:<24} {record['seconds']:>10.4f}s{peak}")
+
+    out = args.out or os.path.join(os.path.dirname(__file__), 'results',
+                                   f"spatial_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {out}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        print('\n'.join(compare(results, baseline)))
+    return results
+
+
+if __name__ == '__main__':
+    main()
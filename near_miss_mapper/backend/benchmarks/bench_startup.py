@@ -0,0 +1,78 @@
+"""
+Cold-start cost of a web worker: time and peak RSS to import app.main in a
+fresh interpreter, and whether any of the spatial stack was imported with
+it (it should only load in analysis pool workers):
+
+    cd backend
+    python -m benchmarks.bench_startup --runs 5
+
+Exits non-zero when a heavy module is imported or ``--max-seconds`` is
+exceeded, so it can guard cold start in CI.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from typing import Any, Dict, List, Optional
+
+BACKEND_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+HEAVY_MODULES = ['pandas', 'geopandas', 'shapely', 'pyproj', 'esda', 'libpysal', 'statsmodels', 'scipy', 'pyarrow']
+
+_PROBE = """
+import json, resource, sys, time
+start = time.perf_counter()
+import app.main
+seconds = time.perf_counter() - start
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({
+    'seconds': seconds,
+    'peak_rss_mb': (peak if sys.platform == 'darwin' else peak * 1024) / 2 ** 20,
+    'heavy_modules': [m for m in %r if m in sys.modules],
+}))
+""" % (HEAVY_MODULES,)
+
+
+def measure_once() -> Dict[str, Any]:
+    # Fresh interpreter per run: nothing cached in sys.modules
+    out = subprocess.run([sys.executable, '-c', _PROBE], cwd=BACKEND_DIR, check=True,
+                         capture_output=True, text=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--max-seconds', type=float, default=None, help='fail if the median import exceeds this')
+    parser.add_argument('--out', default=None, help='optional JSON results path')
+    args = parser.parse_args(argv)
+
+    runs = [measure_once() for _ in range(args.runs)]
+    seconds = [r['seconds'] for r in runs]
+    heavy = sorted({m for r in runs for m in r['heavy_modules']})
+    result = {
+        'runs': runs,
+        'median_seconds': statistics.median(seconds),
+        'min_seconds': min(seconds),
+        'max_peak_rss_mb': max(r['peak_rss_mb'] for r in runs),
+        'heavy_modules': heavy,
+    }
+    print(f"import app.main: median {result['median_seconds']:.3f}s, min {result['min_seconds']:.3f}s, "
+          f"peak RSS {result['max_peak_rss_mb']:.0f} MB over {args.runs} runs")
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+
+    failed = False
+    if heavy:
+        print(f"Heavy modules imported by app.main: {', '.join(heavy)}")
+        failed = True
+    if args.max_seconds is not None and result['median_seconds'] > args.max_seconds:
+        print(f"Median import time exceeds {args.max_seconds:.3f}s")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,341 @@
+import asyncio
+import operator
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+from app import aggregates
+
+T0 = datetime(2026, 10, 1, 8, 0)
+_MISSING = object()
+_COMPARE = {"$lt": operator.lt, "$lte": operator.le, "$gt": operator.gt, "$gte": operator.ge}
+
+
+def _get(doc, key):
+    for part in key.split("."):
+        if not isinstance(doc, dict) or part not in doc:
+            return _MISSING
+        doc = doc[part]
+    return doc
+
+
+def _set(doc, key, value):
+    *parents, last = key.split(".")
+    for part in parents:
+        doc = doc.setdefault(part, {})
+    doc[last] = value
+
+
+def _matches(doc, query):
+    for key, cond in query.items():
+        if key == "$or":
+            if not any(_matches(doc, q) for q in cond):
+                return False
+            continue
+        value = _get(doc, key)
+        if isinstance(cond, dict) and cond and all(op.startswith("$") for op in cond):
+            for op, arg in cond.items():
+                if op in _COMPARE:
+                    ok = value is not _MISSING and value is not None and _COMPARE[op](value, arg)
+                elif op == "$nin":
+                    ok = value not in arg
+                elif op == "$exists":
+                    ok = (value is not _MISSING) == arg
+                else:
+                    raise NotImplementedError(op)
+                if not ok:
+                    return False
+        elif (None if value is _MISSING else value) != cond:
+            return False
+    return True
+
+
+def _update(doc, update):
+    for key, value in update.get("$set", {}).items():
+        _set(doc, key, value)
+    for key in update.get("$unset", {}):
+        *parents, last = key.split(".")
+        parent = _get(doc, ".".join(parents)) if parents else doc
+        if isinstance(parent, dict):
+            parent.pop(last, None)
+    for key, amount in update.get("$inc", {}).items():
+        current = _get(doc, key)
+        _set(doc, key, (0 if current is _MISSING else current) + amount)
+
+
+class FakeDatabase:
+    """Collections by name, so handles follow a rename like Motor's do."""
+
+    def __init__(self):
+        self.data = {}
+        self.on_batch = None
+
+    def __getitem__(self, name):
+        return FakeCollection(self, name)
+
+    def __getattr__(self, name):
+        return FakeCollection(self, name)
+
+
+class FakeCollection:
+    """The collection calls aggregates makes; ``on_batch`` of a database runs before each scanned batch."""
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+
+    @property
+    def docs(self):
+        return self.database.data.setdefault(self.name, [])
+
+    async def find_one(self, query, projection=None, sort=None):
+        docs = [d for d in self.docs if _matches(d, query)]
+        if sort:
+            (key, direction), = sort
+            docs.sort(key=lambda d: d[key], reverse=direction < 0)
+        return dict(docs[0]) if docs else None
+
+    def find(self, query, projection=None, batch_size=None):
+        docs = [d for d in self.docs if _matches(d, query)]
+        collection = self
+
+        class Cursor:
+            async def to_list(self, length=None):
+                nonlocal docs
+                if collection.database.on_batch is not None and collection.name == "events":
+                    await collection.database.on_batch()
+                # Documents deleted since the find are not returned
+                live = {id(d) for d in collection.docs}
+                docs = [d for d in docs if id(d) in live]
+                batch, docs = (docs, []) if length is None else (docs[:length], docs[length:])
+                return [dict(d) for d in batch]
+
+        return Cursor()
+
+    async def insert_one(self, doc):
+        doc = dict(doc)
+        doc.setdefault("_id", ObjectId())
+        if any(d["_id"] == doc["_id"] for d in self.docs):
+            raise DuplicateKeyError("duplicate _id")
+        self.docs.append(doc)
+
+    async def update_one(self, query, update, upsert=False):
+        await self.find_one_and_update(query, update, upsert=upsert)
+
+    async def find_one_and_update(self, query, update, upsert=False):
+        for doc in self.docs:
+            if _matches(doc, query):
+                before = dict(doc)
+                _update(doc, update)
+                return before
+        if upsert:
+            doc = {k: v for k, v in query.items() if not k.startswith("$") and not isinstance(v, dict)}
+            _update(doc, update)
+            await self.insert_one(doc)
+        return None
+
+    async def bulk_write(self, requests, ordered=True):
+        for request in requests:
+            await self.update_one(request._filter, request._doc, upsert=request._upsert)
+
+    async def delete_one(self, query):
+        for doc in self.docs:
+            if _matches(doc, query):
+                self.docs.remove(doc)
+                return
+
+    async def delete_many(self, query):
+        self.database.data[self.name] = [d for d in self.docs if not _matches(d, query)]
+
+    async def drop(self):
+        self.database.data.pop(self.name, None)
+
+    async def create_index(self, keys, **kwargs):
+        pass
+
+    async def rename(self, new_name, dropTarget=False):
+        self.database.data[new_name] = self.database.data.pop(self.name, [])
+
+
+def event(lon, lat, minutes=0.0, incident_type="car"):
+    return {
+        "_id": ObjectId(),
+        "location": {"type": "Point", "coordinates": [lon, lat]},
+        "timestamp": T0 + timedelta(minutes=minutes),
+        "incident_type": incident_type,
+    }
+
+
+def _counts(collection):
+    """Non-zero aggregate rows keyed by everything but the count."""
+    return {
+        (d["cell_size"], d["ix"], d["iy"], d["level"], d.get("day"), d.get("incident_type")): d["count"]
+        for d in collection.docs if d["count"]
+    }
+
+
+def _expected(docs):
+    fresh = FakeDatabase()
+    asyncio.run(aggregates.apply_events(fresh.grid_aggregates, docs, 1))
+    return _counts(fresh.grid_aggregates)
+
+
+@pytest.fixture(autouse=True)
+def _config(monkeypatch):
+    monkeypatch.setattr(aggregates, "AGGREGATE_CELL_SIZES", [250.0, 1000.0])
+    monkeypatch.setattr(aggregates, "AGGREGATES_WRITE_GRACE_S", 0.0)
+
+
+@pytest.fixture
+def events():
+    rng = np.random.default_rng(0)
+    lons, lats = rng.normal(-0.1, 0.02, 250), rng.normal(51.5, 0.02, 250)
+    return [event(float(x), float(y), minutes=float(i) * 90, incident_type=("car", "bike")[i % 2])
+            for i, (x, y) in enumerate(zip(lons, lats))]
+
+
+def _database(docs):
+    database = FakeDatabase()
+    database.data["events"] = list(docs)
+    # Leftovers of an earlier, drifted build are replaced
+    database.data["grid_aggregates"] = [{"cell_size": 250.0, "ix": 0, "iy": 0, "level": "total",
+                                         "day": None, "incident_type": None, "count": 7}]
+    return database
+
+
+def test_rebuild_from_scratch(events):
+    database = _database(events)
+    assert asyncio.run(aggregates.rebuild(database.grid_aggregates, database.events, batch_size=100)) == 250
+    assert _counts(database.grid_aggregates) == _expected(events)
+    assert asyncio.run(aggregates.is_ready(database.grid_aggregates))
+    assert "rebuild" not in database.data["aggregates_meta"][0]
+    assert not database.data.get("grid_aggregates_staging")
+
+
+def test_writes_during_a_rebuild_count_exactly_once(events, monkeypatch):
+    database = _database(events)
+    live = list(events)
+    aggregates_collection = database.grid_aggregates
+
+    async def insert(doc):
+        live.append(doc)
+        database.data["events"].append(doc)
+        await aggregates.apply_live(aggregates_collection, [doc], 1)
+
+    async def delete(doc):
+        live.remove(doc)
+        database.data["events"].remove(doc)
+        await aggregates.apply_live(aggregates_collection, [doc], -1)
+
+    new = [event(-0.1, 51.5, minutes=i) for i in range(4)]
+    scans = iter([
+        # Before the first batch: a new event, and an old one deleted before it is read
+        lambda: asyncio.gather(insert(new[0]), delete(events[10])),
+        # After it: an old event deleted after it was read, a new one inserted then deleted
+        lambda: delete(events[20]),
+        lambda: insert(new[1]),
+        lambda: delete(new[1]),
+    ])
+
+    async def on_batch():
+        step = next(scans, None)
+        if step is not None:
+            await step()
+
+    sleeps = iter([
+        # Flag still set: journaled and replayed onto the renamed collection
+        lambda: insert(new[2]),
+        # Flag cleared: applied directly
+        lambda: insert(new[3]),
+    ])
+
+    async def sleep(seconds):
+        step = next(sleeps, None)
+        if step is not None:
+            await step()
+
+    database.on_batch = on_batch
+    monkeypatch.setattr(aggregates, "asyncio", SimpleNamespace(sleep=sleep))
+    total = asyncio.run(aggregates.rebuild(aggregates_collection, database.events, batch_size=100))
+    assert total == 249
+    assert _counts(aggregates_collection) == _expected(live)
+    assert asyncio.run(aggregates.is_ready(aggregates_collection))
+    assert not database.data["aggregates_journal"]
+    assert not [d for d in database.data["aggregates_meta"] if d["_id"] == aggregates.LEASE_ID]
+
+
+def test_rebuild_waits_for_a_live_lease_and_takes_over_an_expired_one(events):
+    database = _database(events)
+    meta = database.aggregates_meta
+    held = aggregates._Lease(meta, 300)
+    assert asyncio.run(held.acquire())
+    assert asyncio.run(aggregates.rebuild(database.grid_aggregates, database.events)) is None
+    assert not asyncio.run(aggregates.is_ready(database.grid_aggregates))
+
+    asyncio.run(meta.update_one({"_id": aggregates.LEASE_ID},
+                                {"$set": {"expires_at": datetime.utcnow() - timedelta(seconds=1)}}))
+    assert asyncio.run(aggregates.rebuild(database.grid_aggregates, database.events)) == 250
+    with pytest.raises(aggregates.RebuildLeaseLost):
+        asyncio.run(held.renew())
+
+
+def test_rebuild_that_loses_its_lease_stays_not_ready(events):
+    database = _database(events)
+    meta = database.aggregates_meta
+
+    async def take_over():
+        # This rebuild stalled past its lease: another process took it
+        await meta.update_one({"_id": aggregates.LEASE_ID},
+                              {"$set": {"owner": "other", "expires_at": datetime.utcnow() + timedelta(minutes=5)}})
+        await aggregates.apply_live(database.grid_aggregates, [event(-0.1, 51.5)], 1)
+
+    database.on_batch = take_over
+    with pytest.raises(aggregates.RebuildLeaseLost):
+        asyncio.run(aggregates.rebuild(database.grid_aggregates, database.events, batch_size=100))
+    state = next(d for d in database.data["aggregates_meta"] if d["_id"] == aggregates.META_ID)
+    assert not state["ready"] and "rebuild" not in state
+    assert not database.data["aggregates_journal"]
+    # The new holder's lease is left alone
+    assert asyncio.run(meta.find_one({"_id": aggregates.LEASE_ID}))["owner"] == "other"
+
+
+def test_apply_live_ignores_the_flag_of_a_dead_rebuild(events):
+    database = _database([])
+    asyncio.run(database.aggregates_meta.insert_one({
+        "_id": aggregates.META_ID, "rebuild": {"id": "dead", "expires_at": datetime.utcnow() - timedelta(seconds=1)},
+    }))
+    database.data["grid_aggregates"] = []
+    asyncio.run(aggregates.apply_live(database.grid_aggregates, events[:5], 1))
+    assert _counts(database.grid_aggregates) == _expected(events[:5])
+    assert not database.data.get("aggregates_journal")
+
+
+def test_replay_is_idempotent_per_event(events):
+    database = _database([])
+    database.data["grid_aggregates"] = []
+    journal = database.aggregates_journal
+    scanned = np.sort(aggregates._id_keys(d["_id"] for d in events[:3]))
+    replay = aggregates._Replay(database.grid_aggregates, "r", scanned)
+
+    async def run():
+        # Scanned then deleted; unscanned insert; repeated journal entries
+        await journal.insert_one({"rebuild": "r", "sign": -1, "events": [events[0]]})
+        await journal.insert_one({"rebuild": "r", "sign": 1, "events": [events[5]]})
+        await replay.apply(database.grid_aggregates)
+        await journal.insert_one({"rebuild": "r", "sign": 1, "events": [events[5]]})
+        await journal.insert_one({"rebuild": "other", "sign": 1, "events": [events[6]]})
+        await replay.apply(database.grid_aggregates)
+        await replay.clear()
+
+    asyncio.run(run())
+    got = _counts(database.grid_aggregates)
+    expected = _expected([events[5]])
+    removed = {k: -v for k, v in _expected([events[0]]).items()}
+    for key, value in removed.items():
+        expected[key] = expected.get(key, 0) + value
+    assert got == {k: v for k, v in expected.items() if v}
+    assert [e["rebuild"] for e in database.data["aggregates_journal"]] == ["other"]
@@ -0,0 +1,88 @@
+import base64
+
+import numpy as np
+import pandas as pd
+import pytest
+from esda.moran import Moran
+from libpysal.weights import lat2W
+
+from app import aggregates
+from app.geo import MAX_MERCATOR_LAT, mercator_xy
+from app.spatial.analysis import _seeded, compact_cells
+from app.spatial.gi_star import _classify_hot_cold, counts_to_grid, events_to_grid
+
+
+def _moran_p(seed):
+    y = np.random.default_rng(0).poisson(2, 100).astype(float)
+    with _seeded(seed):
+        return Moran(y, lat2W(10, 10), permutations=99).p_sim
+
+
+def test_seeded_moran_is_reproducible_and_restores_global_state():
+    np.random.seed(123)
+    expected_next = np.random.random()
+    np.random.seed(123)
+    ps = {_moran_p(7) for _ in range(5)}
+    assert len(ps) == 1
+    assert np.random.random() == expected_next
+    assert len({_moran_p(None) for _ in range(5)}) > 1
+
+
+def _aggregate_grid(lon, lat, **kwargs):
+    ix, iy = aggregates.cell_indices(lon, lat, kwargs['cell_size_m'])
+    cells, counts = np.unique(np.column_stack([ix, iy]), axis=0, return_counts=True)
+    return counts_to_grid(cells[:, 0], cells[:, 1], counts, **kwargs)
+
+
+@pytest.mark.parametrize("lat_range, kwargs", [
+    ((52.50, 52.52), dict(cell_size_m=250.0, buffer_m=600.0)),
+    ((84.9, 90.0), dict(cell_size_m=1000.0, cells='occupied')),
+])
+def test_raw_events_grid_like_their_aggregates(lat_range, kwargs):
+    rng = np.random.default_rng(0)
+    lon, lat = rng.uniform(13.30, 13.33, 500), rng.uniform(*lat_range, 500)
+    raw = events_to_grid(pd.DataFrame({'lon': np.append(lon, 13.3), 'lat': np.append(lat, np.inf)}), **kwargs)
+    agg = _aggregate_grid(lon, lat, **kwargs)
+    assert raw.attrs['grid'] == agg.attrs['grid']
+    for column in ('id', 'col', 'row', 'count'):
+        np.testing.assert_array_equal(raw[column], agg[column])
+    assert raw['count'].sum() == 500
+    np.testing.assert_allclose(raw.total_bounds, agg.total_bounds)
+    # Beyond the Mercator limit events share the edge row
+    if lat_range[1] > MAX_MERCATOR_LAT:
+        _, top = mercator_xy(0.0, MAX_MERCATOR_LAT)
+        assert raw.loc[raw['count'] > 0, 'row'].max() == raw.attrs['grid']['n_rows'] - 1
+        assert raw.total_bounds[3] == pytest.approx(np.ceil(top / 1000.0) * 1000.0)
+
+
+def _gi_grid():
+    grid = events_to_grid(pd.DataFrame({'lon': [13.30, 13.31, 13.31, 13.32], 'lat': [52.50, 52.51, 52.51, 52.50]}),
+                          cell_size_m=500.0)
+    n = len(grid)
+    z = np.linspace(-3.0, 3.0, n)
+    return grid.assign(
+        z_score=z,
+        p_value=np.linspace(0.001, 0.9, n),
+        # Significance after FDR need not follow the z bands
+        fdr_significant=np.arange(n) % 3 == 0,
+        significance=_classify_hot_cold(z),
+    )
+
+
+def _decode(payload, name):
+    return np.frombuffer(base64.b64decode(payload[name]), dtype=np.dtype(payload['dtypes'][name]).newbyteorder('<'))
+
+
+def test_compact_cells_round_trip_the_fdr_significant_cells():
+    gi = _gi_grid()
+    expected = gi[gi['fdr_significant']]
+    packed, plain = compact_cells(gi, 'base64'), compact_cells(gi, 'json')
+    assert packed['n_cells'] == plain['n_cells'] == len(expected) > 0
+    assert packed['origin'] == list(gi.attrs['grid']['origin'])
+    for name, column in [('col', 'col'), ('row', 'row'), ('count', 'count'), ('z', 'z_score'), ('p', 'p_value')]:
+        decoded = _decode(packed, name)
+        np.testing.assert_allclose(decoded, expected[column].to_numpy(), rtol=1e-6)
+        np.testing.assert_allclose(plain[name], decoded, rtol=1e-6)
+    levels = np.array(packed['levels'])[_decode(packed, 'significance')]
+    np.testing.assert_array_equal(levels, expected['significance'].astype(str))
+    assert plain['significance'] == _decode(packed, 'significance').tolist()
@@ -0,0 +1,146 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import jwt
+import pytest
+from fastapi import HTTPException
+from passlib.context import CryptContext
+
+from app import auth
+
+FAST = CryptContext(schemes=["pbkdf2_sha256"], pbkdf2_sha256__rounds=1000)
+
+
+class FakeCredentials:
+    """The users collection calls login makes."""
+
+    def __init__(self, *users):
+        self.users = {u["email_or_phone"]: dict(u) for u in users}
+        self.updates = []
+
+    async def find_one(self, query):
+        return self.users.get(query["email_or_phone"])
+
+    async def update_one(self, query, update):
+        self.updates.append((query, update))
+        for user in self.users.values():
+            if user["_id"] == query["_id"]:
+                user.update(update["$set"])
+
+
+def test_token_cache_serves_entries_until_they_expire(monkeypatch):
+    now = [1_000.0]
+    monkeypatch.setattr(auth, "time", SimpleNamespace(time=lambda: now[0]))
+    cache = auth.TokenCache(max_entries=10)
+    cache.put("t", {"sub": "u", "exp": 1_060})
+    assert cache.get("t") == {"sub": "u", "exp": 1_060}
+    now[0] = 1_060.0
+    assert cache.get("t") is None
+    assert "t" not in cache._entries
+    # Claims without exp are never cached
+    cache.put("forever", {"sub": "u"})
+    assert cache.get("forever") is None
+
+
+def test_token_cache_evicts_least_recently_used():
+    cache = auth.TokenCache(max_entries=2)
+    exp = time.time() + 60
+    for token in ("a", "b"):
+        cache.put(token, {"sub": token, "exp": exp})
+    cache.get("a")
+    cache.put("c", {"sub": "c", "exp": exp})
+    assert list(cache._entries) == ["a", "c"]
+    disabled = auth.TokenCache(max_entries=0)
+    disabled.put("a", {"sub": "a", "exp": exp})
+    assert disabled.get("a") is None
+
+
+def test_decode_caches_verified_claims_and_rejects_expired_tokens(monkeypatch):
+    cache = auth.TokenCache()
+    token = auth.create_access_token("user-1", "admin")
+    claims = auth.decode_access_token(token, cache)
+    assert claims["sub"] == "user-1" and claims["role"] == "admin"
+    assert cache.get(token) is claims
+
+    monkeypatch.setattr(auth, "ACCESS_TOKEN_EXPIRE_MINUTES", -1)
+    expired = auth.create_access_token("user-1", "admin")
+    with pytest.raises(jwt.ExpiredSignatureError):
+        auth.decode_access_token(expired, cache)
+    assert cache.get(expired) is None
+
+
+def test_hasher_sheds_load_beyond_max_pending():
+    release = threading.Event()
+
+    class SlowContext:
+        def hash(self, password):
+            release.wait(5)
+            return FAST.hash(password)
+
+    hasher = auth.PasswordHasher(SlowContext(), max_workers=1, max_pending=1)
+
+    async def run():
+        first = asyncio.ensure_future(hasher.hash("secret"))
+        await asyncio.sleep(0)
+        assert hasher.pending() == 1
+        with pytest.raises(auth.HasherBusy):
+            await hasher.hash("other")
+        release.set()
+        hashed = await first
+        assert hasher.pending() == 0
+        return hashed
+
+    try:
+        assert FAST.verify("secret", asyncio.run(run()))
+    finally:
+        hasher.shutdown()
+
+
+def test_verify_rejects_missing_or_malformed_hashes():
+    hasher = auth.PasswordHasher(FAST)
+    try:
+        assert asyncio.run(hasher.verify_and_update("secret", "")) == (False, None)
+        assert asyncio.run(hasher.verify_and_update("secret", "not-a-hash")) == (False, None)
+    finally:
+        hasher.shutdown()
+
+
+def test_login_returns_503_when_the_hasher_is_busy(monkeypatch):
+    from app import main
+
+    credentials = FakeCredentials({"_id": 1, "email_or_phone": "a@b.c", "password_hash": FAST.hash("secret")})
+    monkeypatch.setattr(main, "db", SimpleNamespace(credentials=credentials))
+    monkeypatch.setattr(main, "password_hasher", auth.PasswordHasher(FAST, max_pending=0))
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(main.login(main.LoginInput(email_or_phone="a@b.c", password="secret")))
+    assert e.value.status_code == 503
+    assert e.value.headers["Retry-After"] == "1"
+
+
+def test_login_rehashes_passwords_with_outdated_rounds(monkeypatch):
+    from app import main
+
+    current = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto", pbkdf2_sha256__rounds=2000)
+    old_hash = FAST.hash("secret")
+    credentials = FakeCredentials({"_id": 1, "email_or_phone": "a@b.c", "password_hash": old_hash, "role": "user"})
+    hasher = auth.PasswordHasher(current)
+    monkeypatch.setattr(main, "db", SimpleNamespace(credentials=credentials))
+    monkeypatch.setattr(main, "password_hasher", hasher)
+    try:
+        with pytest.raises(HTTPException) as e:
+            asyncio.run(main.login(main.LoginInput(email_or_phone="a@b.c", password="wrong")))
+        assert e.value.status_code == 401 and not credentials.updates
+
+        token = asyncio.run(main.login(main.LoginInput(email_or_phone="a@b.c", password="secret")))
+        assert auth.decode_access_token(token.access_token)["sub"] == "1"
+        new_hash = credentials.users["a@b.c"]["password_hash"]
+        assert new_hash != old_hash and "$2000$" in new_hash
+        assert current.verify("secret", new_hash) and not current.needs_update(new_hash)
+
+        # Already current: no further write
+        asyncio.run(main.login(main.LoginInput(email_or_phone="a@b.c", password="secret")))
+        assert len(credentials.updates) == 1
+    finally:
+        hasher.shutdown()
@@ -0,0 +1,89 @@
+import json
+import os
+
+from app.cache import ResultCache, cache_key, cleanup_outputs
+
+
+def _write(path, size, mtime):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+    os.utime(path, (mtime, mtime))
+
+
+def _size(result):
+    return len(json.dumps(result, default=str))
+
+
+def test_cache_key_ignores_parameter_order():
+    assert cache_key("gi", {"a": 1, "b": 2}, {"count": 3}) == cache_key("gi", {"b": 2, "a": 1}, {"count": 3})
+    assert cache_key("gi", {"a": 1}, {"count": 3}) != cache_key("gi", {"a": 1}, {"count": 4})
+
+
+def test_lru_evicts_by_entry_count(tmp_path):
+    cache = ResultCache(str(tmp_path), max_entries=2)
+    for key in ("a", "b"):
+        cache.put(key, {"value": key})
+    assert cache.get("a") == {"value": "a"}
+    cache.put("c", {"value": "c"})
+    # "b" was least recently used
+    assert list(cache._entries) == ["a", "c"]
+    # ... and comes back from disk
+    assert cache.get("b") == {"value": "b"}
+    assert list(cache._entries) == ["c", "b"]
+
+
+def test_lru_evicts_by_bytes(tmp_path):
+    small, large = {"value": "s"}, {"value": "l" * 100}
+    cache = ResultCache(str(tmp_path), max_entries=10, max_bytes=_size(large) + 2 * _size(small) - 1)
+    cache.put("s1", small)
+    cache.put("s2", small)
+    cache.put("l", large)
+    assert list(cache._entries) == ["s2", "l"]
+    assert cache._bytes == _size(small) + _size(large)
+    # Larger than the whole budget: on disk only
+    cache.put("huge", {"value": "h" * 1000})
+    assert "huge" not in cache._entries
+    assert os.path.exists(tmp_path / "huge.json")
+
+
+def test_entries_whose_outputs_disappear_are_dropped(tmp_path):
+    out = tmp_path / "gi.parquet"
+    _write(str(out), 10, 0)
+    result = {"outputs": {"parquet": str(out)}}
+    cache = ResultCache(str(tmp_path / "cache"))
+    cache.put("k", result)
+    assert cache.get("k") == result
+    os.remove(out)
+    assert cache.get("k") is None
+    assert "k" not in cache._entries and cache._bytes == 0
+    # A fresh process reading the entry from disk checks the outputs too
+    assert ResultCache(str(tmp_path / "cache")).get("k") is None
+
+
+def test_unreadable_cache_file_is_a_miss(tmp_path):
+    (tmp_path / "k.json").write_text("{not json")
+    assert ResultCache(str(tmp_path)).get("k") is None
+
+
+def test_cleanup_deletes_expired_outputs(tmp_path):
+    now = 1_000_000.0
+    _write(str(tmp_path / "old.parquet"), 10, now - 7200)
+    _write(str(tmp_path / "new.parquet"), 10, now - 60)
+    _write(str(tmp_path / "cache" / "old.json"), 10, now - 7200)
+    assert cleanup_outputs(str(tmp_path), max_age_s=3600, now=now) == 2
+    assert sorted(os.listdir(tmp_path)) == ["cache", "new.parquet"]
+    assert not os.listdir(tmp_path / "cache")
+
+
+def test_cleanup_trims_oldest_outputs_to_the_size_budget(tmp_path):
+    now = 1_000_000.0
+    # A shapefile and its sidecars go together, dated by the newest of them
+    for ext, age in ((".shp", 300), (".dbf", 300), (".shx", 100)):
+        _write(str(tmp_path / f"grid{ext}"), 40, now - age)
+    _write(str(tmp_path / "oldest.parquet"), 50, now - 400)
+    _write(str(tmp_path / "newest.parquet"), 50, now - 10)
+    assert cleanup_outputs(str(tmp_path), max_bytes=100, now=now) == 4
+    assert os.listdir(tmp_path) == ["newest.parquet"]
+    assert cleanup_outputs(str(tmp_path), max_bytes=100, now=now) == 0
+    assert cleanup_outputs(str(tmp_path / "missing")) == 0
@@ -0,0 +1,184 @@
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from pymongo.errors import AutoReconnect, WriteError
+
+from app import ingest
+from app.dedup import Deduplicator, DuplicateIndex
+
+T0 = datetime(2026, 10, 1, 8, 0)
+
+
+def report(lon=-0.1, lat=51.5, minutes=0.0, incident_type="car", **extra):
+    return dict({
+        "location": {"type": "Point", "coordinates": [lon, lat]},
+        "timestamp": T0 + timedelta(minutes=minutes),
+        "incident_type": incident_type,
+        "severity": "low",
+        "description": "d",
+        "reported_by": "u",
+    }, **extra)
+
+
+class FakeEvents:
+    """Records bulk_write calls; insert_many / insert_one raise ``insert_error`` when set."""
+
+    def __init__(self, insert_error=None):
+        self.insert_error = insert_error
+        self.writes = []
+
+    async def bulk_write(self, requests, ordered=True):
+        self.writes.extend(requests)
+
+    async def insert_many(self, docs, ordered=True):
+        if self.insert_error is not None:
+            raise self.insert_error
+
+    async def insert_one(self, doc):
+        if self.insert_error is not None:
+            raise self.insert_error
+
+
+@pytest.fixture
+def index():
+    index = DuplicateIndex(distance_m=30, window_s=15 * 60, retention_s=24 * 3600)
+    index.ready = True
+    return index
+
+
+def test_match_within_distance_window_and_type(index):
+    index.add([report(_id="a")])
+    assert index.match(report(lon=-0.1002, minutes=10)) == "a"
+    # ~111 m away, outside the window, or another incident type
+    assert index.match(report(lat=51.501)) is None
+    assert index.match(report(minutes=20)) is None
+    assert index.match(report(incident_type="bike")) is None
+
+
+def test_match_prefers_nearest_primary(index):
+    index.add([report(_id="far", lon=-0.10025), report(_id="near", lon=-0.10005)])
+    assert index.match(report()) == "near"
+
+
+def test_match_at_high_latitude_spans_stretched_cells(index):
+    index.add([report(_id="a", lon=25.0, lat=70.0)])
+    # 25 m east at 70N is about 0.00066 degrees of longitude
+    assert index.match(report(lon=25.00066, lat=70.0)) == "a"
+
+
+def test_remove_and_reinsert(index):
+    index.add([report(_id="a")])
+    index.remove(["a"])
+    assert len(index) == 0 and index.match(report()) is None
+    index.add([report(_id="a")])
+    index.add([report(_id="a")])
+    assert len(index) == 1
+
+
+def test_retention_evicts_old_primaries(index):
+    index.add([report(_id="old")])
+    index.add([report(_id="new", lon=10.0, minutes=3 * 24 * 60)])
+    assert len(index) == 1
+    # Reports older than the retention are not indexed at all
+    index.add([report(_id="older", lon=20.0)])
+    assert index.match(report(lon=20.0)) is None
+
+
+def test_writes_during_build_are_replayed(index):
+    class Collection:
+        async def find_one(self, *args, **kwargs):
+            index.add([report(_id="during", lon=1.0)])
+            index.remove(["stored"])
+            return {"timestamp": T0}
+
+        def find(self, *args, **kwargs):
+            async def docs():
+                yield report(_id="stored")
+            return docs()
+
+    assert asyncio.run(index.build(Collection())) == 1
+    assert index.match(report(lon=1.0)) == "during"
+    assert index.match(report()) is None
+
+
+def test_resolve_links_duplicates_within_one_batch(index):
+    deduplicator = Deduplicator(index, FakeEvents(), mode="link")
+    docs = [report(), report(lon=-0.1001, minutes=1), report(lon=5.0)]
+    keep, duplicates = deduplicator.resolve(docs)
+    assert keep == [0, 1, 2]
+    assert docs[1]["duplicate_of"] == docs[0]["_id"]
+    assert list(duplicates) == [docs[0]["_id"]]
+    assert deduplicator.linked == 1
+
+
+def test_merge_does_not_insert_duplicates(index):
+    events = FakeEvents()
+    deduplicator = Deduplicator(index, events, mode="merge")
+    docs = [report(), report(minutes=1)]
+    keep, duplicates = deduplicator.resolve(docs)
+    assert keep == [0]
+    asyncio.run(deduplicator.commit(duplicates))
+    (update,) = events.writes
+    assert update._doc["$inc"] == {"duplicates": 1}
+    assert len(update._doc["$push"]["merged_reports"]["$each"]) == 1
+
+
+def test_commit_forgets_failed_primaries(index):
+    deduplicator = Deduplicator(index, FakeEvents(), mode="link")
+    doc = report()
+    _, duplicates = deduplicator.resolve([doc])
+    asyncio.run(deduplicator.commit(duplicates, failed=[doc]))
+    assert len(index) == 0
+    assert index.match(report(minutes=1)) is None
+
+
+def test_bulk_chunk_failure_leaves_no_phantom_primaries(index):
+    events = FakeEvents(insert_error=AutoReconnect("connection reset"))
+    deduplicator = Deduplicator(index, events, mode="link")
+    docs = [report(), report(lon=3.0)]
+    keep, duplicates = deduplicator.resolve(docs)
+    with pytest.raises(AutoReconnect):
+        asyncio.run(ingest._insert_chunk(events, keep, docs, ingest.IngestReport(), None,
+                                         deduplicator, duplicates))
+    assert len(index) == 0
+
+
+def test_create_event_failure_leaves_no_phantom_primary(index, monkeypatch):
+    from fastapi import HTTPException, Response
+
+    from app import main
+    from app.models import NearMissEvent
+
+    events = FakeEvents(insert_error=WriteError("Can't extract geo keys", 16755, {"errmsg": "Can't extract geo keys"}))
+    monkeypatch.setattr(main, "db", SimpleNamespace(events=events))
+    monkeypatch.setattr(main, "duplicate_index", index)
+    event = NearMissEvent(**report(lon=200.0, _id="new"))
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(main.create_event(event, Response(), dedup_mode="link"))
+    assert e.value.status_code == 400
+    assert len(index) == 0
+
+
+def test_cancelled_inserts_keep_their_primaries(index, monkeypatch):
+    from fastapi import Response
+
+    from app import main
+    from app.models import NearMissEvent
+
+    # The server may have stored them before the cancellation reached us
+    events = FakeEvents(insert_error=asyncio.CancelledError())
+    deduplicator = Deduplicator(index, events, "link")
+    docs = [report(), report(lon=3.0)]
+    keep, duplicates = deduplicator.resolve(docs)
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(ingest._insert_chunk(events, keep, docs, ingest.IngestReport(), None,
+                                         deduplicator, duplicates))
+    assert len(index) == 2
+
+    monkeypatch.setattr(main, "db", SimpleNamespace(events=events))
+    monkeypatch.setattr(main, "duplicate_index", index)
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(main.create_event(NearMissEvent(**report(lon=6.0, _id="new")), Response(), dedup_mode="link"))
+    assert len(index) == 3
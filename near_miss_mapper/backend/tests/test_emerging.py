@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+
+from app.spatial import emerging
+from app.spatial.lattice import lattice_weights
+
+N_COLS, N_ROWS, N_SLICES, WINDOW = 6, 5, 7, 2
+
+
+def _dense_gi_star(x, w_space, window):
+    """Textbook Gi* on the explicit (cell x slice) Kronecker weights matrix."""
+    n_cells, n_slices = x.shape
+    w_star = (w_space.toarray() > 0).astype(float) + np.eye(n_cells)
+    t = np.array([[1.0 if 0 <= s - r <= window else 0.0 for r in range(n_slices)] for s in range(n_slices)])
+    w = np.kron(w_star, t)
+    values = x.ravel()
+    n = values.size
+    mean = values.mean()
+    s = np.sqrt((values ** 2).mean() - mean ** 2)
+    w_sum = w.sum(axis=1)
+    denom = s * np.sqrt((n * (w ** 2).sum(axis=1) - w_sum ** 2) / (n - 1))
+    return ((w @ values - mean * w_sum) / denom).reshape(x.shape)
+
+
+@pytest.fixture
+def counts():
+    rng = np.random.default_rng(0)
+    x = np.zeros((N_COLS * N_ROWS, N_SLICES))
+    # A growing cluster in one corner; the far corner stays empty
+    x[:8] = rng.poisson(np.linspace(1, 6, N_SLICES), (8, N_SLICES))
+    return x
+
+
+def _cube(x, cells):
+    cell, time_slice = np.nonzero(x[cells])
+    return emerging.build_cube(np.repeat(cell, x[cells][cell, time_slice].astype(int)),
+                               np.repeat(time_slice, x[cells][cell, time_slice].astype(int)),
+                               len(cells), x.shape[1])
+
+
+def test_space_time_gi_star_matches_the_dense_kronecker_reference(counts):
+    ids = np.arange(N_COLS * N_ROWS)
+    w = lattice_weights(ids // N_ROWS, ids % N_ROWS, N_COLS, N_ROWS, 1.0, 'queen')
+    z = emerging.space_time_gi_star(_cube(counts, ids), w, WINDOW)
+    np.testing.assert_allclose(z, _dense_gi_star(counts, w, WINDOW))
+
+
+def test_occupied_subset_uses_the_whole_extent_population(counts):
+    ids = np.arange(N_COLS * N_ROWS)
+    w = lattice_weights(ids // N_ROWS, ids % N_ROWS, N_COLS, N_ROWS, 1.0, 'queen')
+    expected = _dense_gi_star(counts, w, WINDOW)
+
+    # Occupied cells plus their queen ring, as cells='occupied' materializes them
+    occupied = np.flatnonzero(counts.any(axis=1))
+    col, row = occupied // N_ROWS, occupied % N_ROWS
+    ring = {(c + dc) * N_ROWS + r + dr for c, r in zip(col, row) for dc in (-1, 0, 1) for dr in (-1, 0, 1)
+            if 0 <= c + dc < N_COLS and 0 <= r + dr < N_ROWS}
+    cells = np.array(sorted(ring))
+    assert len(cells) < len(ids)
+    w_sub = lattice_weights(cells // N_ROWS, cells % N_ROWS, N_COLS, N_ROWS, 1.0, 'queen')
+    z = emerging.space_time_gi_star(_cube(counts, cells), w_sub, WINDOW, n_units=counts.size)
+    positions = np.searchsorted(cells, occupied)
+    np.testing.assert_allclose(z[positions], expected[occupied])
+    with pytest.raises(ValueError):
+        emerging.space_time_gi_star(_cube(counts, cells), w_sub, WINDOW, n_units=len(cells))
+
+
+def test_mann_kendall_on_known_series():
+    series = np.array([
+        [1, 2, 3, 4, 5],
+        [5, 4, 3, 2, 1],
+        [1, 1, 2, 2, 3],
+        [2, 2, 2, 2, 2],
+    ], dtype=float)
+    z, p = emerging.mann_kendall(series)
+    # S = 10, var = 5 * 4 * 15 / 18; two tie pairs take 2 * 18 off 18 * var
+    np.testing.assert_allclose(z[:2], [9 / np.sqrt(50 / 3), -9 / np.sqrt(50 / 3)])
+    np.testing.assert_allclose(z[2], 7 / np.sqrt((300 - 36) / 18))
+    np.testing.assert_allclose(p[:2], [0.027486, 0.027486], atol=1e-6)
+    assert z[3] == 0 and p[3] == 1
+    z, p = emerging.mann_kendall(series[:, :2])
+    assert not z.any() and (p == 1).all()
@@ -0,0 +1,159 @@
+import asyncio
+import math
+import os
+
+import numpy as np
+import pytest
+
+from app.geo import EARTH_RADIUS_M, MAX_MERCATOR_LAT
+from app.db import bbox_boxes, build_event_query, create_indexes
+from app.nearby import _filter_mask
+
+
+def _polygons(query):
+    geometry = query["location"]["$geoWithin"]["$geometry"]
+    return [geometry["coordinates"]] if geometry["type"] == "Polygon" else geometry["coordinates"]
+
+
+def _bounds(polygon):
+    ring = np.array(polygon[0])
+    return ring[:, 0].min(), ring[:, 1].min(), ring[:, 0].max(), ring[:, 1].max()
+
+
+def _unit(lon, lat):
+    lon, lat = math.radians(lon), math.radians(lat)
+    return np.array([math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat)])
+
+
+def test_plain_bbox_is_one_closed_polygon():
+    query = build_event_query({"bbox": [-0.2, 51.4, 0.1, 51.6], "severity": "high"})
+    (polygon,) = _polygons(query)
+    assert polygon[0][0] == polygon[0][-1]
+    np.testing.assert_allclose(_bounds(polygon), [-0.2, 51.4, 0.1, 51.6])
+    assert query["severity"] == "high"
+
+
+@pytest.mark.parametrize("bbox", [
+    [170, -10, 190, 10],
+    [170, -10, -170, 10],
+    [-190, -10, -170, 10],
+    [530, -10, 550, 10],
+])
+def test_antimeridian_bbox_is_split(bbox):
+    polygons = _polygons(build_event_query({"bbox": bbox}))
+    np.testing.assert_allclose([_bounds(p) for p in polygons], [[170, -10, 180, 10], [-180, -10, -170, 10]])
+
+
+def test_wide_bbox_is_split_below_a_hemisphere():
+    polygons = _polygons(build_event_query({"bbox": [-540, -30, 540, 30]}))
+    np.testing.assert_allclose([_bounds(p) for p in polygons],
+                               [[lon, -30, lon + 90, 30] for lon in (-180, -90, 0, 90)])
+
+
+@pytest.mark.parametrize("bbox", [[-0.2, 51.4, 0.1, 51.6], [-30, 40, 30, 70], [100, -60, 140, -20],
+                                  [-180, 35, 180, 45]])
+def test_geodesic_edges_follow_the_parallels(bbox):
+    for polygon in _polygons(build_event_query({"bbox": bbox})):
+        ring = polygon[0]
+        for (lon1, lat1), (lon2, lat2) in zip(ring[:-1], ring[1:]):
+            if lat1 != lat2:
+                assert lon1 == lon2  # meridians are geodesics
+                continue
+            mid = _unit(lon1, lat1) + _unit(lon2, lat2)
+            mid_lat = math.degrees(math.asin(mid[2] / np.linalg.norm(mid)))
+            assert abs(mid_lat - lat1) * math.pi / 180 * EARTH_RADIUS_M <= 1.0
+
+
+def test_mercator_edge_becomes_a_pole_vertex():
+    (polygon,) = _polygons(build_event_query({"bbox": [0, 80, 10, MAX_MERCATOR_LAT]}))
+    assert [lon_lat for lon_lat in polygon[0] if lon_lat[1] == 90] == [[5, 90]]
+
+
+def test_wrapped_bbox_is_shifted_into_range():
+    assert bbox_boxes([190, 0, 200, 10]) == [(-170, 0, -160, 10)]
+    assert bbox_boxes([-180, 0, 180, 10]) == [(-180, 0, 180, 10)]
+
+
+def test_world_wide_bbox_covers_every_longitude():
+    assert bbox_boxes([-540, -30, 540, 30]) == [(-180, -30, 180, 30)]
+
+
+def test_latitudes_clamp_and_mercator_edges_reach_the_pole():
+    assert bbox_boxes([0, -MAX_MERCATOR_LAT, 10, MAX_MERCATOR_LAT]) == [(0, -90, 10, 90)]
+    assert bbox_boxes([0, -120, 10, 95]) == [(0, -90, 10, 90)]
+    assert bbox_boxes([0, 10, 10, 20]) == [(0, 10, 10, 20)]
+
+
+@pytest.mark.parametrize("bbox", [
+    [0, 0, 1],
+    [0, 0, 0, 1],
+    [0, 1, 1, 1],
+    [0, 0, 1, float("nan")],
+    [0, 95, 1, 96],
+])
+def test_invalid_bbox_is_rejected(bbox):
+    with pytest.raises(ValueError):
+        build_event_query({"bbox": bbox})
+
+
+def test_filter_mask_matches_the_planar_boxes():
+    rng = np.random.default_rng(0)
+    n = 2000
+    cols = {
+        "id": np.arange(n),
+        "lon": rng.uniform(-180, 180, n),
+        "lat": rng.uniform(-90, 90, n),
+        "time": np.zeros(n),
+        "duplicate": np.zeros(n, dtype=bool),
+    }
+    for bbox in ([170, -10, 190, 10], [-20, 80, 20, MAX_MERCATOR_LAT], [-540, -5, 540, 5]):
+        expected = np.zeros(n, dtype=bool)
+        for min_lon, min_lat, max_lon, max_lat in bbox_boxes(bbox):
+            expected |= ((cols["lon"] >= min_lon) & (cols["lon"] <= max_lon)
+                         & (cols["lat"] >= min_lat) & (cols["lat"] <= max_lat))
+        mask = _filter_mask(cols, {"bbox": bbox})
+        assert mask.any()
+        np.testing.assert_array_equal(mask, expected)
+
+
+@pytest.mark.skipif(not os.getenv("MONGO_TEST_URI"), reason="needs a MongoDB server (MONGO_TEST_URI)")
+def test_bbox_queries_are_served_by_the_2dsphere_indexes():
+    import motor.motor_asyncio
+
+    def stages(plan):
+        # (stage, index name) pairs of a winningPlan tree
+        found = set()
+        if isinstance(plan, dict):
+            if "stage" in plan:
+                found.add((plan["stage"], plan.get("indexName")))
+            for value in plan.values():
+                found |= stages(value)
+        elif isinstance(plan, list):
+            for value in plan:
+                found |= stages(value)
+        return found
+
+    async def run():
+        client = motor.motor_asyncio.AsyncIOMotorClient(os.environ["MONGO_TEST_URI"])
+        collection = client["near_miss_test"]["events_explain"]
+        try:
+            await collection.drop()
+            await create_indexes(collection)
+            await collection.insert_one({"location": {"type": "Point", "coordinates": [175.0, 0.0]}})
+            assert await collection.count_documents(build_event_query({"bbox": [170, -10, 190, 10]})) == 1
+            plans = []
+            for filters in ({"bbox": [-0.2, 51.4, 0.1, 51.6]}, {"bbox": [170, -10, 190, 10]},
+                            {"bbox": [-0.2, 51.4, 0.1, 51.6], "severity": "high"}):
+                explain = await collection.find(build_event_query(filters)).explain()
+                plans.append(stages(explain["queryPlanner"]["winningPlan"]))
+            return plans
+        finally:
+            await collection.drop()
+            client.close()
+
+    plans = asyncio.run(run())
+    for plan in plans:
+        assert not any(stage == "COLLSCAN" for stage, _ in plan)
+        assert any(stage == "IXSCAN" for stage, _ in plan)
+    # bbox alone: the location 2dsphere index (or a compound one ending in it)
+    assert all(any(name and "location_2dsphere" in name for _, name in plan) for plan in plans[:2])
@@ -0,0 +1,185 @@
+import asyncio
+import json
+
+import pytest
+from pymongo.errors import BulkWriteError
+
+from app import ingest
+
+
+def row(lon=-0.1, lat=51.5, **extra):
+    return dict({
+        "location": {"type": "Point", "coordinates": [lon, lat]},
+        "description": "d",
+        "incident_type": "car",
+        "severity": "low",
+        "timestamp": "2026-10-01T08:00:00",
+        "reported_by": "u",
+    }, **extra)
+
+
+def feature(lon=-0.1, lat=51.5, geometry_type="Point", **properties):
+    props = row(**properties)
+    props.pop("location")
+    return {"type": "Feature", "geometry": {"type": geometry_type, "coordinates": [lon, lat]}, "properties": props}
+
+
+class FakeEvents:
+    """insert_many that fails the documents at ``fail`` (positions across all calls) like ordered=False does."""
+
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.docs = []
+        self.calls = 0
+        self.seen = 0
+
+    async def insert_many(self, docs, ordered=True):
+        assert not ordered
+        self.calls += 1
+        errors = []
+        for i, doc in enumerate(docs):
+            if self.seen in self.fail:
+                errors.append({"index": i, "errmsg": f"E11000 duplicate key {i}"})
+            else:
+                doc.setdefault("_id", f"id{self.seen}")
+                self.docs.append(doc)
+            self.seen += 1
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "nInserted": len(docs) - len(errors)})
+
+
+def _stream(body, chunk=7):
+    async def chunks():
+        for i in range(0, len(body), chunk):
+            yield body[i:i + chunk]
+    return chunks()
+
+
+def _ingest(fmt, body, collection=None, **kwargs):
+    collection = collection if collection is not None else FakeEvents()
+
+    async def run():
+        return await ingest.ingest(collection, ingest.iter_records(fmt, _stream(body)), **kwargs)
+
+    return asyncio.run(run()), collection
+
+
+def test_detect_format():
+    assert ingest.detect_format("application/x-ndjson") == "ndjson"
+    assert ingest.detect_format("text/csv; charset=utf-8") == "csv"
+    assert ingest.detect_format("application/geo+json") == "geojson"
+    assert ingest.detect_format("text/plain", explicit="csv") == "csv"
+    with pytest.raises(ingest.IngestError):
+        ingest.detect_format("text/plain")
+
+
+def test_ndjson_rows_stream_across_chunk_boundaries():
+    lines = [
+        json.dumps(row()),
+        "",
+        json.dumps(feature(lon=2.0, note="x")),
+        "{not json",
+        "[1, 2]",
+        json.dumps(row(lon=200.0)),
+        json.dumps({"location": {"type": "Point", "coordinates": [0, 0]}}),
+        json.dumps(row(lat=1.0)),
+    ]
+    report, events = _ingest("ndjson", "\n".join(lines).encode())
+    assert report["received"] == 7
+    assert report["inserted"] == 3 and report["failed"] == 4
+    # Blank lines are not rows
+    assert [e["row"] for e in report["errors"]] == [2, 3, 4, 5]
+    assert "must be a JSON object" in report["errors"][1]["error"]
+    assert "coordinates" in report["errors"][2]["error"]
+    assert "description" in report["errors"][3]["error"]
+    assert [d["location"]["coordinates"] for d in events.docs] == [[-0.1, 51.5], [2.0, 51.5], [-0.1, 1.0]]
+    assert events.docs[1]["additional_info"] == {"note": "x"}
+    assert report["ids"] == [str(d["_id"]) for d in events.docs]
+
+
+def test_csv_columns_map_to_events():
+    body = (
+        "\ufeffLongitude,LAT,description,incident_type,severity,reported_by,camera,additional_info\n"
+        "-0.1,51.5,d,car,low,u,cam-1,\"{\"\"weather\"\": \"\"rain\"\"}\"\n"
+        ",51.5,d,car,low,u,,\n"
+        "abc,51.5,d,car,low,u,,\n"
+    ).encode("utf-8")
+    report, events = _ingest("csv", body)
+    assert report["inserted"] == 1
+    assert [e["row"] for e in report["errors"]] == [1, 2]
+    assert "lon and lat" in report["errors"][0]["error"]
+    (doc,) = events.docs
+    assert doc["location"]["coordinates"] == [-0.1, 51.5]
+    assert doc["status"] == "reported"
+    assert doc["additional_info"] == {"camera": "cam-1", "weather": "rain"}
+
+
+def test_csv_must_be_utf8():
+    with pytest.raises(ingest.IngestError):
+        _ingest("csv", "lon,lat\n1,2\n".encode("utf-16"))
+
+
+def test_geojson_features_map_to_events():
+    body = json.dumps({"type": "FeatureCollection", "features": [
+        feature(status="open", additional_info={"a": 1}, camera="c"),
+        feature(geometry_type="LineString"),
+        "not a feature",
+    ]}).encode()
+    report, events = _ingest("geojson", body)
+    assert report["inserted"] == 1
+    assert [(e["row"], e["error"]) for e in report["errors"]] == [
+        (1, "Feature geometry must be a Point"), (2, "Feature must be an object"),
+    ]
+    (doc,) = events.docs
+    assert doc["status"] == "open"
+    assert doc["additional_info"] == {"camera": "c", "a": 1}
+
+
+@pytest.mark.parametrize("body", [b"{", b'{"type": "Feature"}', b"[]"])
+def test_geojson_body_must_be_a_feature_collection(body):
+    with pytest.raises(ingest.IngestError) as e:
+        _ingest("geojson", body)
+    assert e.value.status_code == 400
+
+
+def test_whole_bodies_are_capped(monkeypatch):
+    monkeypatch.setattr(ingest, "INGEST_MAX_BYTES", 10)
+    with pytest.raises(ingest.IngestError) as e:
+        _ingest("csv", b"lon,lat\n1.0,2.0\n")
+    assert e.value.status_code == 413
+
+
+def test_listed_errors_are_capped_but_counted():
+    body = "\n".join(["{bad"] * (ingest.INGEST_MAX_ERRORS + 5) + [json.dumps(row())]).encode()
+    report, _ = _ingest("ndjson", body, chunk_size=400)
+    assert report["failed"] == ingest.INGEST_MAX_ERRORS + 5
+    assert len(report["errors"]) == ingest.INGEST_MAX_ERRORS
+    assert report["errors_truncated"]
+    assert report["inserted"] == 1
+
+    report = ingest.IngestReport(max_errors=2)
+    for i in (5, 1, 3):
+        report.error(i, "bad")
+    # The first max_errors recorded, listed by row
+    assert report.view()["errors"] == [{"row": 1, "error": "bad"}, {"row": 5, "error": "bad"}]
+    assert report.view()["failed"] == 3
+
+
+def test_partial_insert_failures_are_reported_per_row():
+    inserted_batches = []
+
+    async def on_inserted(docs):
+        inserted_batches.append([d["location"]["coordinates"][1] for d in docs])
+
+    # Rows 0-6 with row 2 invalid; writes 1 and 4 (rows 1 and 5) fail server-side
+    rows = [row(lat=float(i)) for i in range(7)]
+    rows[2] = {"bad": True}
+    body = "\n".join(json.dumps(r) for r in rows).encode()
+    report, events = _ingest("ndjson", body, collection=FakeEvents(fail={1, 4}),
+                             chunk_size=3, on_inserted=on_inserted)
+    assert events.calls == 3
+    assert report["received"] == 7 and report["inserted"] == 4 and report["failed"] == 3
+    assert [e["row"] for e in report["errors"]] == [1, 2, 5]
+    assert report["errors"][0]["error"].startswith("E11000")
+    assert inserted_batches == [[0.0], [3.0, 4.0], [6.0]]
+    assert report["ids"] == [str(d["_id"]) for d in events.docs]
@@ -0,0 +1,28 @@
+import asyncio
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from app.jobs import JobManager
+
+
+def test_dead_worker_fails_only_its_job():
+    async def run():
+        jobs = JobManager(max_workers=1)
+        try:
+            assert await jobs.run_in_pool("math:sqrt", 16.0) == 4.0
+            broken = jobs.executor
+            with pytest.raises(BrokenProcessPool):
+                await jobs.run_in_pool("os:_exit", 1)
+            assert jobs.executor is not broken
+            assert await jobs.run_in_pool("math:sqrt", 9.0) == 3.0
+
+            job = jobs.submit("crash", lambda job: jobs.run_in_pool("os:_exit", 1))
+            await job["task"]
+            assert job["status"] == "failed" and job["error"]
+            job = jobs.submit("ok", lambda job: jobs.run_in_pool("math:sqrt", 4.0))
+            assert await jobs.wait(job) == 2.0
+        finally:
+            jobs.shutdown()
+
+    asyncio.run(run())
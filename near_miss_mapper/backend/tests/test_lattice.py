@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+import pytest
+from libpysal.weights import DistanceBand, KNN, Queen, Rook
+
+from app.spatial.gi_star import events_to_grid
+from app.spatial.lattice import lattice_weights
+
+
+def _neighbour_distances(w, col, row):
+    """Sorted neighbour distances (in cells) per row: tie-agnostic comparison of KNN sets."""
+    w = w.tocsr()
+    out = []
+    for i in range(w.shape[0]):
+        j = w.indices[w.indptr[i]:w.indptr[i + 1]]
+        out.append(np.sort(np.hypot(col[j] - col[i], row[j] - row[i])))
+    return out
+
+
+@pytest.mark.parametrize("trial", range(50))
+def test_knn_matches_brute_force_on_partial_grids(trial):
+    rng = np.random.default_rng(trial)
+    n_cols = n_rows = 30
+    flat = np.sort(rng.choice(n_cols * n_rows, size=int(rng.integers(20, 300)), replace=False))
+    col, row = flat // n_rows, flat % n_rows
+    k = int(rng.integers(1, 12))
+    w = lattice_weights(col, row, n_cols, n_rows, 1.0, 'knn', k=k)
+    if w is None:
+        pytest.skip("neighbourhood not resolvable within MAX_KNN_RADIUS")
+    dist = np.hypot(col[:, None] - col[None, :], row[:, None] - row[None, :])
+    np.fill_diagonal(dist, np.inf)
+    expected = np.sort(dist, axis=1)[:, :k]
+    got = _neighbour_distances(w, col, row)
+    for i in range(len(col)):
+        np.testing.assert_allclose(got[i], expected[i])
+
+
+@pytest.fixture(scope="module")
+def grid():
+    rng = np.random.default_rng(0)
+    events = pd.DataFrame({'lon': rng.uniform(13.30, 13.33, 400), 'lat': rng.uniform(52.50, 52.52, 400)})
+    return events_to_grid(events, cell_size_m=250.0, cells='occupied')
+
+
+def _same_neighbours(w, ref):
+    a, b = w.tocsr(), ref.sparse.tocsr()
+    a.sort_indices()
+    b.sort_indices()
+    np.testing.assert_array_equal(a.indptr, b.indptr)
+    np.testing.assert_array_equal(a.indices, b.indices)
+    np.testing.assert_allclose(a.data, b.data)
+
+
+def _lattice(grid, method, **kwargs):
+    layout = grid.attrs['grid']
+    return lattice_weights(grid['col'].to_numpy(), grid['row'].to_numpy(), layout['n_cols'],
+                           layout['n_rows'], layout['cell_size'], method, **kwargs)
+
+
+def test_contiguity_matches_libpysal(grid):
+    _same_neighbours(_lattice(grid, 'queen'), Queen.from_dataframe(grid, use_index=False))
+    _same_neighbours(_lattice(grid, 'rook'), Rook.from_dataframe(grid, use_index=False))
+
+
+def test_distance_band_matches_libpysal(grid):
+    centroids = grid.copy()
+    centroids.geometry = grid.geometry.centroid
+    ref = DistanceBand.from_dataframe(centroids, threshold=600.0, binary=False, silence_warnings=True,
+                                      use_index=False)
+    _same_neighbours(_lattice(grid, 'distance_band', distance_band=600.0), ref)
+
+
+def test_knn_matches_libpysal_distances(grid):
+    centroids = grid.copy()
+    centroids.geometry = grid.geometry.centroid
+    ref = KNN.from_dataframe(centroids, k=6, use_index=False)
+    col, row = grid['col'].to_numpy(), grid['row'].to_numpy()
+    got = _neighbour_distances(_lattice(grid, 'knn', k=6), col, row)
+    expected = _neighbour_distances(ref.sparse, col, row)
+    for a, b in zip(got, expected):
+        np.testing.assert_allclose(a, b)
@@ -0,0 +1,64 @@
+import warnings
+
+import numpy as np
+import pytest
+from libpysal.weights import lat2W
+
+from app.spatial.local_g import local_gi_star, permutation_p_values, star_weights
+
+esda = pytest.importorskip("esda")
+
+PERMUTATIONS = 9999
+
+
+def _folded_p(sims: np.ndarray, observed: np.ndarray, rtol: float = 1e-9) -> np.ndarray:
+    # esda's "directed" p_sim, counting float ties as ties
+    larger = (sims >= (observed - rtol * np.abs(observed))[:, None]).sum(axis=1)
+    permutations = sims.shape[1]
+    low = (permutations - larger) < larger
+    larger[low] = permutations - larger[low]
+    return (larger + 1.0) / (permutations + 1.0)
+
+
+@pytest.fixture(scope="module")
+def counts():
+    rng = np.random.default_rng(1)
+    w = lat2W(20, 20, rook=False)
+    y = rng.poisson(2, w.n).astype(float)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        ref = esda.G_Local(y, w, transform="R", star=True, permutations=PERMUTATIONS,
+                           seed=1, keep_simulations=True)
+    return y, w, ref
+
+
+def test_statistics_match_esda(counts):
+    y, w, ref = counts
+    gs, zs, _ = local_gi_star(y, w.sparse, permutations=0)
+    np.testing.assert_allclose(gs, ref.Gs, rtol=1e-12)
+    np.testing.assert_allclose(zs, ref.Zs, rtol=1e-9)
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_p_values_match_esda_simulations_on_counts(counts, seed):
+    y, w, ref = counts
+    expected = _folded_p(ref.rGs, ref.Gs)
+    _, _, p_sim = local_gi_star(y, w.sparse, permutations=PERMUTATIONS, seed=seed)
+    # Different draws: only Monte Carlo noise (about 0.02 at 9999 permutations) remains
+    assert np.abs(p_sim - expected).max() < 0.04
+
+
+def test_p_values_do_not_depend_on_rounding_of_ties(counts):
+    y, w, _ = counts
+    w_star = star_weights(w.sparse)
+    gs = (w_star @ y) / y.sum()
+    p = permutation_p_values(y, w_star, gs, permutations=999, seed=0)
+    for shift in (-1e-12, 1e-12):
+        np.testing.assert_array_equal(permutation_p_values(y, w_star, gs * (1 + shift), permutations=999, seed=0), p)
+
+
+def test_seed_is_reproducible_across_jobs(counts):
+    y, w, _ = counts
+    _, _, p1 = local_gi_star(y, w.sparse, permutations=199, seed=7)
+    _, _, p2 = local_gi_star(y, w.sparse, permutations=199, seed=7, n_jobs=2)
+    np.testing.assert_array_equal(p1, p2)
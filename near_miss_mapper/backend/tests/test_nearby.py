@@ -0,0 +1,187 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+from bson import ObjectId
+
+from app import nearby
+from app.nearby import EventIndex, haversine_m
+
+T0 = datetime(2026, 10, 1, 8, 0)
+
+
+def event(lon, lat, minutes=0.0, severity="low", **extra):
+    return dict({
+        "_id": ObjectId(),
+        "location": {"type": "Point", "coordinates": [lon, lat]},
+        "timestamp": T0 + timedelta(minutes=minutes),
+        "incident_type": "car",
+        "severity": severity,
+        "status": "open",
+    }, **extra)
+
+
+class FakeEvents:
+    """The collection reads EventIndex and collection_fingerprint make; ``on_batch`` runs mid-scan."""
+
+    def __init__(self, docs=(), on_batch=None):
+        self.docs = list(docs)
+        self.on_batch = on_batch
+
+    def find(self, query, projection=None, batch_size=None):
+        docs, on_batch = list(self.docs), self.on_batch
+
+        class Cursor:
+            async def to_list(self, length=None):
+                nonlocal docs
+                if on_batch is not None:
+                    on_batch()
+                batch, docs = docs[:length], docs[length:]
+                return batch
+
+        return Cursor()
+
+    async def estimated_document_count(self):
+        return len(self.docs)
+
+    async def find_one(self, query, projection=None, sort=None):
+        return max(self.docs, key=lambda d: str(d["_id"]), default=None)
+
+    def delete(self, doc):
+        self.docs = [d for d in self.docs if d["_id"] != doc["_id"]]
+
+
+@pytest.fixture
+def events():
+    rng = np.random.default_rng(0)
+    lons, lats = rng.normal(-0.1, 0.02, 3000), rng.normal(51.5, 0.02, 3000)
+    return [event(float(x), float(y), minutes=float(i), severity=("low", "high")[i % 2])
+            for i, (x, y) in enumerate(zip(lons, lats))]
+
+
+def _brute(docs, lon, lat, radius_m, severity=None):
+    docs = [d for d in docs if severity is None or d["severity"] == severity]
+    coords = np.array([d["location"]["coordinates"] for d in docs])
+    distances = haversine_m(lon, lat, coords[:, 0], coords[:, 1])
+    order = np.argsort(distances, kind="stable")
+    keep = order[distances[order] <= radius_m] if radius_m is not None else order
+    return [str(docs[i]["_id"]) for i in keep], distances[keep]
+
+
+def test_radius_and_knn_match_brute_force(events):
+    index = EventIndex(cell_size_m=200)
+    index.add(events[:1000])
+    index.compact()
+    index.add(events[1000:])
+    assert len(index) == len(events)
+    for lon, lat in [(-0.1, 51.5), (-0.13, 51.47), (-0.05, 51.55)]:
+        ids, distances = index.query(lon, lat, radius_m=800)
+        expected_ids, expected = _brute(events, lon, lat, 800)
+        assert sorted(ids) == sorted(expected_ids)
+        np.testing.assert_allclose(distances, expected)
+        ids, distances = index.query(lon, lat, k=25)
+        _, expected = _brute(events, lon, lat, None)
+        np.testing.assert_allclose(distances, expected[:25])
+        ids, _ = index.query(lon, lat, radius_m=800, filters={"severity": "high"})
+        assert sorted(ids) == sorted(_brute(events, lon, lat, 800, "high")[0])
+
+
+def test_remove_and_readd(events):
+    index = EventIndex(cell_size_m=200)
+    index.add(events)
+    removed = [str(d["_id"]) for d in events[::3]]
+    index.remove(removed)
+    rest = [d for d in events if str(d["_id"]) not in set(removed)]
+    assert len(index) == len(rest)
+    ids, _ = index.query(-0.1, 51.5, radius_m=1500)
+    assert sorted(ids) == sorted(_brute(rest, -0.1, 51.5, 1500)[0])
+    index.add(events[:3])
+    assert len(index) == len(rest) + 1
+    assert str(events[0]["_id"]) in index.query(-0.1, 51.5, radius_m=None)[0]
+
+
+def test_limit_truncates_nearest_first(events):
+    index = EventIndex()
+    index.add(events)
+    ids, distances = index.query(-0.1, 51.5, radius_m=5000, limit=10)
+    assert len(ids) == 10
+    np.testing.assert_allclose(distances, _brute(events, -0.1, 51.5, 5000)[1][:10])
+
+
+def test_build_detects_outside_writes(events):
+    collection = FakeEvents(events[:500] + [dict(events[500], location=None)])
+    index = EventIndex()
+    assert asyncio.run(index.build(collection)) == 500
+    assert not asyncio.run(index.is_stale(collection))
+
+    # Writes made through this index keep it fresh
+    own = events[501]
+    collection.docs.append(own)
+    index.add([own])
+    collection.delete(events[0])
+    index.remove([str(events[0]["_id"])])
+    assert not asyncio.run(index.is_stale(collection))
+
+    # Writes from elsewhere do not
+    collection.docs.append(events[502])
+    assert asyncio.run(index.is_stale(collection))
+    asyncio.run(index.build(collection))
+    assert not asyncio.run(index.is_stale(collection))
+    collection.delete(events[10])
+    assert asyncio.run(index.is_stale(collection))
+    asyncio.run(index.build(collection))
+    assert not asyncio.run(index.is_stale(collection))
+
+
+def test_writes_during_build_are_replayed_without_staleness(events):
+    collection = FakeEvents(events[:300])
+    index = EventIndex()
+    pending = [events[300], events[301]]
+
+    def write_during_scan():
+        # Own insert and delete while build is scanning
+        if pending:
+            doc = pending.pop()
+            collection.docs.append(doc)
+            index.add([doc])
+        if len(pending) == 1:
+            collection.delete(events[299])
+            index.remove([str(events[299]["_id"])])
+
+    collection.on_batch = write_during_scan
+    asyncio.run(index.build(collection, batch_size=100))
+    assert len(index) == 301
+    assert str(events[299]["_id"]) not in index.query(-0.1, 51.5, radius_m=None)[0]
+    assert not asyncio.run(index.is_stale(collection))
+
+
+def test_unindexed_events_count_towards_the_fingerprint(events):
+    index = EventIndex()
+    index.add([dict(events[0], location=None), events[1]])
+    assert len(index) == 1
+    assert index.fingerprint() == {"count": 2, "max_id": max(str(events[0]["_id"]), str(events[1]["_id"]))}
+    index.remove([str(events[0]["_id"])])
+    assert index.fingerprint()["count"] == 1
+
+
+def test_row_rejects_missing_coordinates():
+    assert nearby._row({"_id": 1, "location": {"coordinates": [float("nan"), 1.0]}}) is None
+
+
+def test_nearby_reports_truncation(events, monkeypatch):
+    from app import main
+
+    index = EventIndex()
+    index.add(events)
+    index.ready = True
+    monkeypatch.setattr(main, "event_index", index)
+    ids, distances, truncated = asyncio.run(main._nearby(-0.1, 51.5, 5000, None, 10, {}, {}))
+    assert len(ids) == 10 and truncated
+    ids, _, truncated = asyncio.run(main._nearby(-0.1, 51.5, 50000, None, len(events), {}, {}))
+    assert len(ids) == len(events) and not truncated
+    # k nearest within the limit are complete by definition
+    ids, _, truncated = asyncio.run(main._nearby(-0.1, 51.5, None, 10, 10, {}, {}))
+    assert len(ids) == 10 and not truncated
+    ids, _, truncated = asyncio.run(main._nearby(-0.1, 51.5, None, 50, 10, {}, {}))
+    assert len(ids) == 10 and truncated
@@ -0,0 +1,86 @@
+import asyncio
+import os
+
+import numpy as np
+
+from app import aggregates, clusters, tiles
+from app.geo import WORLD_SIZE_M, mercator_lonlat, mercator_xy, tile_bounds
+from app.tiles import TILE_CLUSTER_PX, GridLayer
+
+
+def _touch(path, mtime):
+    with open(path, "wb"):
+        pass
+    os.utime(path, (mtime, mtime))
+
+
+def test_grid_layer_skips_pyramid_outputs(tmp_path):
+    _touch(tmp_path / "gi_star_0123456789abcdef.parquet", 100)
+    _touch(tmp_path / "gi_star_0123456789abcdef.arrow", 100)
+    _touch(tmp_path / "gi_star_20261001_080000.parquet", 50)
+    _touch(tmp_path / "gi_star_pyramid_fedcba9876543210_250m.arrow", 200)
+    _touch(tmp_path / "gi_star_pyramid_20261001_090000_500m.parquet", 300)
+    layer = GridLayer(str(tmp_path))
+    assert os.path.basename(layer._current_path()) == "gi_star_0123456789abcdef.arrow"
+    os.utime(tmp_path / "gi_star_20261001_080000.parquet", (400, 400))
+    assert os.path.basename(layer._current_path()) == "gi_star_20261001_080000.parquet"
+
+
+def test_grid_layer_without_outputs(tmp_path):
+    _touch(tmp_path / "gi_star_pyramid_fedcba9876543210_250m.arrow", 200)
+    assert GridLayer(str(tmp_path)).version() is None
+
+
+class FakeAggregates:
+    """Total rows of the aggregates, as load_cell_counts reads them."""
+
+    def __init__(self, lons, lats):
+        self.rows = {}
+        for size in aggregates.AGGREGATE_CELL_SIZES:
+            ix, iy = aggregates.cell_indices(lons, lats, size)
+            for key in zip(ix.tolist(), iy.tolist()):
+                self.rows[(size,) + key] = self.rows.get((size,) + key, 0) + 1
+
+    def find(self, match, projection=None):
+        rows = [
+            {"ix": ix, "iy": iy, "count": n} for (size, ix, iy), n in self.rows.items()
+            if size == match["cell_size"] and n > 0
+            and match["ix"]["$gte"] <= ix <= match["ix"]["$lte"] and match["iy"]["$gte"] <= iy <= match["iy"]["$lte"]
+        ]
+
+        class Cursor:
+            async def to_list(self, length=None):
+                return rows
+
+        return Cursor()
+
+
+def test_low_zoom_clusters_from_aggregates_match_raw_counts():
+    rng = np.random.default_rng(0)
+    # Three cities, far from quarter-tile edges at z=3
+    centres = [(-0.1, 51.5), (2.35, 48.85), (-74.0, 40.7)]
+    lons = np.concatenate([rng.normal(lon, 0.05, 200) for lon, _ in centres])
+    lats = np.concatenate([rng.normal(lat, 0.05, 200) for _, lat in centres])
+    z = 3
+    cell = clusters.cluster_cell_size(z, TILE_CLUSTER_PX)
+    mx, my = mercator_xy(lons, lats)
+    tx = np.floor((mx + WORLD_SIZE_M / 2) / (WORLD_SIZE_M / 2 ** z)).astype(int)
+    ty = np.floor((WORLD_SIZE_M / 2 - my) / (WORLD_SIZE_M / 2 ** z)).astype(int)
+    for x, y in set(zip(tx.tolist(), ty.tolist())):
+        inside = (tx == x) & (ty == y)
+        _, expected = np.unique(np.column_stack([np.floor(mx[inside] / cell), np.floor(my[inside] / cell)]),
+                                axis=0, return_counts=True)
+        features = asyncio.run(tiles._aggregate_clusters(FakeAggregates(lons, lats), tile_bounds(z, x, y)))
+        assert sorted(f[2]["count"] for f in features) == sorted(expected.tolist())
+
+
+def test_tile_bounds_invert_to_the_tile_query_bbox():
+    assert tile_bounds(0, 0, 0) == (-WORLD_SIZE_M / 2, -WORLD_SIZE_M / 2, WORLD_SIZE_M / 2, WORLD_SIZE_M / 2)
+    for lon, lat in [(-0.1, 51.5), (179.9, -85.0), (0.0, 0.0)]:
+        x, y = mercator_xy(lon, lat)
+        np.testing.assert_allclose(mercator_lonlat(float(x), float(y)), (lon, lat))
+    minx, miny, maxx, maxy = tile_bounds(12, 2046, 1362)
+    geometry = tiles._tile_query(12, 2046, 1362)["location"]["$geoWithin"]["$geometry"]
+    ring = np.array(geometry["coordinates"][0])
+    np.testing.assert_allclose([ring[:, 0].min(), ring[:, 1].min(), ring[:, 0].max(), ring[:, 1].max()],
+                               mercator_lonlat(minx, miny) + mercator_lonlat(maxx, maxy))
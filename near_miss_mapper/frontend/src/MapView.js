@@ -8,6 +8,9 @@ import MarkerClusterGroup from 'react-leaflet-cluster';
 import { createEvent, deleteEvent, getNearbyEvents } from './api';
 import ReportButton from './components/ReportButton';
 
+// Events fetched around the user; the server caps a request at 10000
+const NEARBY_FETCH_LIMIT = 10000;
+
 // Fix for default marker icons in React Leaflet
 const defaultIcon = new Icon({
   iconUrl: 'https://unpkg.com/leaflet@1.7.1/dist/images/marker-icon.png',
@@ -58,6 +61,8 @@ function MapView() {
   const [livePosition, setLivePosition] = useState(null);
   const geoWatchIdRef = useRef(null);
   const [showNearLiveOnly, setShowNearLiveOnly] = useState(false);
+  // Set when the nearby fetch hit its limit and only the nearest events are shown
+  const [eventsTruncated, setEventsTruncated] = useState(false);
 
   // Simple in-memory cache for suggestions to avoid redundant Nominatim calls
   const suggestionsCacheRef = useRef(new Map());
@@ -100,12 +105,10 @@ function MapView() {
   const fetchNearbyEvents = async (lng, lat) => {
     try {
       // Use centralized API client to respect baseURL and headers
-      let data = await getNearbyEvents(lat, lng, 10);
+      const { events: data, truncated } = await getNearbyEvents(lat, lng, 10, { limit: NEARBY_FETCH_LIMIT });
       // Ensure we always set an array to prevent runtime errors when mapping
-      if (!Array.isArray(data)) {
-        data = [];
-      }
-      setEvents(data);
+      setEvents(Array.isArray(data) ? data : []);
+      setEventsTruncated(truncated);
     } catch (err) {
       console.error("Error fetching events:", err);
       setError("Failed to load near-miss events. Please try again later.");
@@ -570,6 +573,11 @@ function MapView() {
               <input type="checkbox" checked={showNearLiveOnly} onChange={(e) => setShowNearLiveOnly(e.target.checked)} />
               Show incidents within 5km of my location
             </label>
+            {eventsTruncated && (
+              <span style={{ fontSize: 13, color: '#b45309' }}>
+                Showing the nearest {events.length} incidents only
+              </span>
+            )}
           </div>
         </div>
       </div>
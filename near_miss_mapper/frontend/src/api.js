@@ -12,28 +12,89 @@ const api = axios.create({
 });
 
 // Event endpoints
-export const getEvents = async () => {
+// Fetch one page of events; pass the returned nextCursor as `after` for the next page
+export const getEventsPage = async (params = {}) => {
   try {
-    const response = await api.get('/api/events/');
-    return response.data;
+    const response = await api.get('/api/events/', { params });
+    return { events: response.data, nextCursor: response.headers['x-next-cursor'] || null };
   } catch (error) {
     console.error('Error fetching events:', error);
     throw error;
   }
 };
 
-export const getNearbyEvents = async (lat, lng, radius = 10) => {
+// Fetch all events matching the filters by following the page cursor
+export const getEvents = async (params = {}) => {
+  const events = [];
+  let after = null;
+  do {
+    const page = await getEventsPage({ limit: 1000, ...params, ...(after ? { after } : {}) });
+    events.push(...page.events);
+    after = page.nextCursor;
+  } while (after);
+  return events;
+};
+
+// Events within `radius` km, nearest first: { events, truncated }. The server
+// returns at most `limit` (its own default when omitted); truncated is set
+// when there were more
+export const getNearbyEvents = async (lat, lng, radius = 10, { limit } = {}) => {
   try {
     const response = await api.get('/api/events/nearby', {
-      params: { lat, lng, radius_km: radius }
+      params: { lat, lng, radius_km: radius, ...(limit ? { limit } : {}) }
     });
-    return response.data;
+    return { events: response.data, truncated: response.headers['x-truncated'] === 'true' };
   } catch (error) {
     console.error('Error fetching nearby events:', error);
     throw error;
   }
 };
 
+// Events near many [lng, lat] points in one call (e.g. sampled along a route):
+// { results: [{ ids, distances_m, truncated }, ...], events: { id: event } }
+export const getNearbyEventsBatch = async (points, { radiusM = 100, ...options } = {}) => {
+  try {
+    const response = await api.post('/api/events/nearby/batch', { points, radius_m: radiusM, ...options });
+    return response.data;
+  } catch (error) {
+    console.error('Error fetching nearby events batch:', error);
+    throw error;
+  }
+};
+
+// Pre-clustered counts for a viewport; bounds is [minLng, minLat, maxLng, maxLat].
+// Returns { clustered: true, clusters } or, at high zoom, { clustered: false, events }
+export const getEventClusters = async (bounds, zoom, filters = {}) => {
+  try {
+    const response = await api.get('/api/events/clusters', {
+      params: { bbox: bounds.join(','), zoom, ...filters }
+    });
+    return response.data;
+  } catch (error) {
+    console.error('Error fetching event clusters:', error);
+    throw error;
+  }
+};
+
+// Kernel density heatmap as a PNG object URL plus its [[south, west], [north, east]]
+// bounds, ready for a Leaflet ImageOverlay (revoke the URL when replacing it)
+export const getKdeHeatmap = async (bounds, options = {}) => {
+  try {
+    const response = await api.post('/api/spatial/kde', { bbox: bounds, ...options, format: 'png' }, {
+      responseType: 'blob'
+    });
+    const [west, south, east, north] = response.headers['x-raster-bounds'].split(',').map(Number);
+    return {
+      url: URL.createObjectURL(response.data),
+      bounds: [[south, west], [north, east]],
+      maxValue: Number(response.headers['x-raster-max'])
+    };
+  } catch (error) {
+    console.error('Error fetching KDE heatmap:', error);
+    throw error;
+  }
+};
+
 export const createEvent = async (eventData) => {
   try {
     const response = await api.post('/api/events/', eventData);